@@ -0,0 +1,301 @@
+import contextlib
+import datetime
+import hashlib
+import io
+import os
+import platform
+import shutil
+import sys
+import uuid
+import zipfile
+
+
+# Written into the provenance of every artifact MetaPlex saves
+PLUGIN_VERSION = '1.1.0'
+PLUGIN_WEBSITE = 'https://github.com/NGabry/MetaPlex'
+DEFAULT_FRAMEWORK = '2022.2.0'
+
+_FORMATS = {'FeatureTable[Frequency]': ('BIOMV210DirFmt', 'feature-table.biom'),
+            'FeatureData[Sequence]': ('DNASequencesDirectoryFormat', 'dna-sequences.fasta')}
+
+
+def is_qza(path):
+    return zipfile.is_zipfile(path)
+
+
+def root_dir(qza):
+    '''
+    Name of the top level (UUID) directory of an open qza archive
+    '''
+    return qza.namelist()[0].split('/')[0]
+
+
+def data_names(qza):
+    '''
+    Names of the members under data/ of an open qza archive, relative to data/
+    '''
+    prefix = root_dir(qza) + '/data/'
+    return [n[len(prefix):] for n in qza.namelist() if n.startswith(prefix) and not n.endswith('/')]
+
+
+@contextlib.contextmanager
+def open_data(path, name):
+    '''
+    Opens one file from the data/ directory of a qza archive as a binary stream, without extracting the archive
+
+    path : path to a qza file
+
+    name : file name within data/, e.g. 'feature-table.biom'
+
+    Return : context manager yielding a binary file object
+    '''
+    with zipfile.ZipFile(path) as qza:
+        try:
+            member = qza.open(f'{root_dir(qza)}/data/{name}')
+        except KeyError:
+            raise ValueError(f'{path} has no data/{name}, check to ensure input file is appropriate format')
+        with member:
+            yield member
+
+
+def read_biom(path):
+    '''
+    Loads a feature table from either a .biom file or a FeatureTable[Frequency] qza, read straight out of the archive.
+    qiime2 is only imported if the archive holds something other than a BIOM v2.1 table.
+
+    Return : biom.Table
+    '''
+    import biom
+
+    if not is_qza(path):
+        return biom.load_table(path)
+
+    try:
+        import h5py
+        with open_data(path, 'feature-table.biom') as f:
+            with h5py.File(io.BytesIO(f.read()), 'r') as h5:
+                return biom.Table.from_hdf5(h5)
+    except (ValueError, OSError):
+        from qiime2 import Artifact
+        return Artifact.load(path).view(biom.Table)
+
+
+def iter_fasta(path):
+    '''
+    Streams (ID, sequence) pairs out of a .fasta file or a FeatureData[Sequence] qza, without building SeqRecords
+
+    Return : generator of (ID, sequence) string tuples
+    '''
+    if is_qza(path):
+        with open_data(path, 'dna-sequences.fasta') as f:
+            yield from _parse_fasta(io.TextIOWrapper(f))
+    else:
+        with open(path) as f:
+            yield from _parse_fasta(f)
+
+
+def _parse_fasta(handle):
+    seq_id = None
+    seq = []
+    for line in handle:
+        line = line.rstrip()
+        if line.startswith('>'):
+            if seq_id is not None:
+                yield seq_id, ''.join(seq)
+            seq_id = line[1:].split()[0]
+            seq = []
+        elif line:
+            seq.append(line)
+    if seq_id is not None:
+        yield seq_id, ''.join(seq)
+
+
+def table_bytes(table):
+    '''
+    Serializes a biom.Table to BIOM v2.1 (HDF5) bytes in memory
+    '''
+    import h5py
+
+    buffer = io.BytesIO()
+    with h5py.File(buffer, 'w') as h5:
+        table.to_hdf5(h5, f'MetaPlex {PLUGIN_VERSION}')
+
+    return buffer.getvalue()
+
+
+def fasta_bytes(records):
+    '''
+    Serializes (ID, sequence) pairs to fasta bytes
+    '''
+    return ''.join(f'>{seq_id}\n{seq}\n' for seq_id, seq in records).encode()
+
+
+def write_qza(path, semantic_type, data, action, parameters=None, inputs=None, output_name='filtered_table'):
+    '''
+    Writes a QIIME2 archive (version 5) directly, including checksums and a provenance record of the MetaPlex action
+    that produced it. The provenance of every input artifact is carried over, so the history of the data can still
+    be traced in qiime2.
+
+    path          : output path, '.qza' is appended if missing
+
+    semantic_type : 'FeatureTable[Frequency]' or 'FeatureData[Sequence]'
+
+    data          : contents of the single data file (bytes)
+
+    action        : name of the MetaPlex function that produced the data
+
+    parameters    : dictionary of the parameters the action was called with
+
+    inputs        : dictionary of {input name: path to input qza}
+
+    output_name   : name of the action output the data was produced as
+
+    Return : LazyArtifact for the written file
+    '''
+    if not path.endswith('.qza'):
+        path += '.qza'
+    fmt, data_name = _FORMATS[semantic_type]
+    inputs = {k: v for k, v in (inputs or {}).items() if v is not None and is_qza(v)}
+    artifact_uuid = str(uuid.uuid4())
+    now = datetime.datetime.now().astimezone().isoformat()
+
+    # Parent provenance: each input's own record, and everything it descends from
+    framework = DEFAULT_FRAMEWORK
+    parent_files = {}
+    input_uuids = {}
+    for name, input_path in inputs.items():
+        with zipfile.ZipFile(input_path) as qza:
+            root = root_dir(qza)
+            input_uuids[name] = root
+            version = qza.read(f'{root}/VERSION').decode()
+            for line in version.splitlines():
+                if line.startswith('framework:'):
+                    framework = line.split(':', 1)[1].strip()
+            prefix = f'{root}/provenance/'
+            for n in qza.namelist():
+                if not n.startswith(prefix) or n.endswith('/'):
+                    continue
+                rel = n[len(prefix):]
+                if rel.startswith('artifacts/'):
+                    parent_files['provenance/' + rel] = qza.read(n)
+                else:
+                    parent_files[f'provenance/artifacts/{root}/{rel}'] = qza.read(n)
+
+    version = f'QIIME 2\narchive: 5\nframework: {framework}\n'.encode()
+    metadata = f'uuid: {artifact_uuid}\ntype: {semantic_type}\nformat: {fmt}\n'.encode()
+    action_yaml = _action_yaml(now, action, parameters or {}, input_uuids, output_name, framework).encode()
+
+    files = {'VERSION': version,
+             'metadata.yaml': metadata,
+             f'data/{data_name}': data,
+             'provenance/VERSION': version,
+             'provenance/metadata.yaml': metadata,
+             'provenance/citations.bib': b'',
+             'provenance/action/action.yaml': action_yaml}
+    files.update(parent_files)
+    checksums = ''.join(f'{hashlib.md5(v).hexdigest()}  {k}\n' for k, v in files.items()).encode()
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as qza:
+        qza.writestr(f'{artifact_uuid}/checksums.md5', checksums)
+        for k, v in files.items():
+            qza.writestr(f'{artifact_uuid}/{k}', v)
+
+    return LazyArtifact(path)
+
+
+def _action_yaml(now, action, parameters, input_uuids, output_name, framework):
+    inputs = ''.join(f'    -   {k}: {v}\n' for k, v in input_uuids.items()) or '    []\n'
+    params = ''.join(f'    -   {k}: {_yaml_value(v)}\n' for k, v in parameters.items()) or '    []\n'
+    python = sys.version.replace('\n', '\n        ')
+
+    return (f'execution:\n'
+            f'    uuid: {uuid.uuid4()}\n'
+            f'    runtime:\n'
+            f'        start: {now}\n'
+            f'        end: {now}\n'
+            f'        duration: 0 microseconds\n'
+            f'\n'
+            f'action:\n'
+            f'    type: method\n'
+            f'    plugin: !ref \'environment:plugins:metaplex\'\n'
+            f'    action: {action}\n'
+            f'    inputs:\n{inputs}'
+            f'    parameters:\n{params}'
+            f'    output-name: {output_name}\n'
+            f'\n'
+            f'environment:\n'
+            f'    platform: {platform.platform()}\n'
+            f'    python: |-\n'
+            f'        {python}\n'
+            f'    framework:\n'
+            f'        version: {framework}\n'
+            f'        website: https://qiime2.org\n'
+            f'    plugins:\n'
+            f'        metaplex:\n'
+            f'            version: {PLUGIN_VERSION}\n'
+            f'            website: {PLUGIN_WEBSITE}\n')
+
+
+def _yaml_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        return '[' + ', '.join(_yaml_value(v) for v in value) + ']'
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class LazyArtifact:
+    '''
+    Stand-in for a saved qiime2.Artifact. Viewing a feature table as a biom.Table, exporting, and saving are served
+    straight from the archive; anything else loads the artifact with qiime2 on first use.
+
+    path : path to a qza file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._artifact = None
+
+    def __repr__(self):
+        return f'LazyArtifact({self.path!r})'
+
+    def view(self, view_type):
+        import biom
+
+        if view_type is biom.Table:
+            return read_biom(self.path)
+        return self._load().view(view_type)
+
+    def export_data(self, output_dir):
+        '''
+        Extracts the data/ directory of the archive into output_dir
+        '''
+        os.makedirs(output_dir, exist_ok=True)
+        with zipfile.ZipFile(self.path) as qza:
+            prefix = root_dir(qza) + '/data/'
+            for n in qza.namelist():
+                if n.startswith(prefix) and not n.endswith('/'):
+                    dest = os.path.join(output_dir, n[len(prefix):])
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    with qza.open(n) as src, open(dest, 'wb') as out:
+                        shutil.copyfileobj(src, out)
+
+    def save(self, filepath):
+        if not filepath.endswith('.qza'):
+            filepath += '.qza'
+        if os.path.abspath(filepath) != os.path.abspath(self.path):
+            shutil.copyfile(self.path, filepath)
+        return filepath
+
+    def _load(self):
+        if self._artifact is None:
+            from qiime2 import Artifact
+            self._artifact = Artifact.load(self.path)
+        return self._artifact
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._load(), name)
@@ -0,0 +1,158 @@
+import struct
+
+from .bgzf import read_blocks
+
+
+_INT32 = struct.Struct('<i')
+# refID, pos, l_read_name, mapq, bin, n_cigar_op, flag, l_seq, next_refID, next_pos, tlen
+_CORE = struct.Struct('<iiBBHHHiiii')
+
+# 4-bit packed bases: each byte holds two bases, high nibble first
+_BASES = b'=ACMGRSVTWYHKDBN'
+_HIGH = bytes(_BASES[i >> 4] for i in range(256))
+_LOW = bytes(_BASES[i & 15] for i in range(256))
+_PHRED = bytes(min(i + 33, 126) for i in range(256))
+_COMPLEMENT = bytes.maketrans(b'ACGTMRWSYKVHDBN=', b'TGCAKYWSRMBDHVN=')
+
+# Reads flagged as secondary or supplementary alignments are skipped, as samtools fastq does
+_SKIP_FLAGS = 0x100 | 0x800
+_REVERSE = 0x10
+
+
+def read_bam_chunks(path, chunk_size=8 << 20, threads=None):
+    '''
+    Streams the alignment records of a BAM file (e.g. an Ion Torrent unmapped BAM) as record-aligned chunks of raw,
+    decompressed BAM bytes. The header is skipped.
+
+    path       : path to a .bam file, or a binary handle of BAM data as returned by streams.open_input
+
+    chunk_size : approximate number of decompressed bytes per chunk
+
+    threads    : number of BGZF decompression threads, defaults to one per CPU
+
+    Return : generator of byte strings, each holding a whole number of BAM records
+    '''
+    pending = []
+    size = 0
+    header_done = False
+    for block in read_blocks(path, threads):
+        pending.append(block)
+        size += len(block)
+        if not header_done:
+            data = b''.join(pending)
+            end = _header_end(data)
+            if end is None:
+                pending = [data]
+                continue
+            pending = [data[end:]]
+            size = len(pending[0])
+            header_done = True
+        if size < chunk_size:
+            continue
+
+        # Blocks are only joined once a chunk's worth has arrived, then split at the last whole record
+        data = b''.join(pending)
+        end = _record_boundary(data)
+        if end:
+            yield data[:end]
+        pending = [data[end:]]
+        size = len(pending[0])
+
+    if not header_done:
+        raise ValueError('Truncated BAM header')
+    data = b''.join(pending)
+    if data:
+        if _record_boundary(data) != len(data):
+            raise ValueError('Truncated BAM file: last record is incomplete')
+        yield data
+
+
+def _header_end(data):
+    '''
+    Offset of the first alignment record, or None if the header is not complete yet
+    '''
+    if len(data) < 12:
+        return None
+    if data[:4] != b'BAM\1':
+        raise ValueError('Not a BAM file: missing BAM magic')
+    l_text = _INT32.unpack_from(data, 4)[0]
+    offset = 8 + l_text
+    if len(data) < offset + 4:
+        return None
+    n_ref = _INT32.unpack_from(data, offset)[0]
+    offset += 4
+    for _ in range(n_ref):
+        if len(data) < offset + 4:
+            return None
+        l_name = _INT32.unpack_from(data, offset)[0]
+        offset += 4 + l_name + 4
+    if len(data) < offset:
+        return None
+    return offset
+
+
+def _record_boundary(data):
+    '''
+    Offset just past the last complete record in data
+    '''
+    offset = 0
+    end = len(data)
+    while offset + 4 <= end:
+        size = _INT32.unpack_from(data, offset)[0] + 4
+        if offset + size > end:
+            break
+        offset += size
+    return offset
+
+
+def iter_bam_records(chunk):
+    '''
+    Decodes raw BAM alignment records into fastq style records
+
+    chunk : bytes holding a whole number of BAM records, as produced by read_bam_chunks
+
+    Return : generator of (header, sequence, plus, quality) byte string tuples
+    '''
+    offset = 0
+    end = len(chunk)
+    while offset < end:
+        size = _INT32.unpack_from(chunk, offset)[0]
+        start = offset + 4
+        offset = start + size
+        (ref, pos, l_name, mapq, bin_, n_cigar, flag, l_seq,
+         next_ref, next_pos, tlen) = _CORE.unpack_from(chunk, start)
+        if flag & _SKIP_FLAGS:
+            continue
+
+        p = start + _CORE.size
+        name = chunk[p:p + l_name - 1]
+        p += l_name + 4 * n_cigar
+        packed = chunk[p:p + (l_seq + 1) // 2]
+        p += (l_seq + 1) // 2
+        qual = chunk[p:p + l_seq]
+
+        # Unpack both nibbles at C speed and interleave them
+        seq = bytearray(2 * len(packed))
+        seq[0::2] = packed.translate(_HIGH)
+        seq[1::2] = packed.translate(_LOW)
+        seq = bytes(seq[:l_seq])
+        if l_seq and qual[0] == 0xFF:
+            # Quality not stored, filled with samtools' default of 1
+            qual = b'"' * l_seq
+        else:
+            qual = qual.translate(_PHRED)
+        if flag & _REVERSE:
+            seq = seq.translate(_COMPLEMENT)[::-1]
+            qual = qual[::-1]
+
+        yield b'@' + name, seq, b'+', qual
+
+
+def read_bam(path, threads=None):
+    '''
+    Streams fastq style records out of a BAM file without an intermediate fastq
+
+    Return : generator of (header, sequence, plus, quality) byte string tuples
+    '''
+    for chunk in read_bam_chunks(path, threads=threads):
+        yield from iter_bam_records(chunk)
@@ -0,0 +1,159 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+from . import cli, metrics
+from .index_jump import cached_false_reads, record_stats
+
+
+# Columns of a batch manifest, one line per sequencing run
+MANIFEST_COLUMNS = ['run', 'demultiplexed_seqs', 'sample_map', 'calibrator_tag_pairs']
+
+
+def read_manifest(manifest):
+    '''
+    Reads a tab delimited manifest of sequencing runs
+
+    manifest: path to a manifest with the columns
+                run                 : name of the run
+                demultiplexed_seqs  : demultiplexed qza, or remultiplexed_counts.tsv, of the run
+                sample_map          : sample map of the run
+                calibrator_tag_pairs: calibrator tag pairs of the run, ex: 01,11 02,12, or empty for none
+              Relative paths are taken relative to the manifest.
+
+    Return: list of (run, demultiplexed_seqs, sample_map, calibrator_tag_pairs) tuples
+    '''
+    df = pd.read_csv(manifest, sep='\t', dtype=str, keep_default_na=False)
+    missing = set(MANIFEST_COLUMNS) - set(df.columns)
+    if missing:
+        raise ValueError(f'Manifest {manifest} is missing the columns {sorted(missing)}')
+    if df['run'].duplicated().any():
+        raise ValueError(f'Run names in {manifest} are not unique')
+
+    base = os.path.dirname(os.path.abspath(manifest))
+    runs = []
+    for run, demultiplexed_seqs, sample_map, pairs in df[MANIFEST_COLUMNS].itertuples(index=False):
+        calibrators = [tuple(pair.split(',')) for pair in pairs.split()] or None
+        runs.append((run, os.path.join(base, demultiplexed_seqs), os.path.join(base, sample_map), calibrators))
+
+    return runs
+
+
+def _calculate_run(job):
+    '''
+    Worker process body: the expected false reads of one run. Failures are returned rather than raised, so that one
+    bad run does not stop the batch.
+    '''
+    (run, demultiplexed_seqs, sample_map, calibrators), work_dir, confidence, replicates, seed = job
+    try:
+        with metrics.stage('calculate', run=run, demultiplexed_seqs=demultiplexed_seqs) as stage:
+            # One worker per run already keeps every CPU busy, so reads are counted in the worker itself
+            out_df, jump_rate, total_read_count = cached_false_reads(demultiplexed_seqs, sample_map, calibrators, stage,
+                                                                     work_dir, confidence, replicates, seed, workers=1)
+            record_stats(stage, out_df, jump_rate, total_read_count)
+    except Exception as e:
+        return run, None, None, None, f'{type(e).__name__}: {e}'
+
+    return run, out_df, jump_rate, total_read_count, None
+
+
+def calculate_batch(manifest, workers=None, output_dir='.', work_dir=None, confidence=None, replicates=10000,
+                    seed=None):
+    '''
+    Calculate Index Jump Rates and expected false reads for many sequencing runs at once, in a pool of worker
+    processes
+
+    manifest: path to a tab delimited manifest of runs (see read_manifest)
+
+    workers: number of runs processed at the same time, defaults to one per CPU
+
+    output_dir: directory the outputs are written to, created if missing
+
+    work_dir: directory for temporary files, the system temporary directory by default
+
+    confidence, replicates, seed: as in index_jump.calculate, applied to every run
+
+    Return: pandas DataFrame with one row per run: jump rate, total and expected false read counts, and the error of
+            runs that failed
+    Output: Expected_False_Reads_Per_Run.csv, the expected false reads of every sample of every run, next to the jump
+            rate of its run
+            Run_Summary.csv, the returned per-run summary
+            batch_log.txt, summary statistics of the jump rates across runs
+    '''
+    runs = read_manifest(manifest)
+    workers = min(workers or os.cpu_count(), max(len(runs), 1))
+    print(f'Calculating expected false reads of {len(runs)} runs with {workers} workers')
+
+    jobs = [(run, work_dir, confidence, replicates, seed) for run in runs]
+    with ProcessPoolExecutor(workers) as pool:
+        results = list(pool.map(_calculate_run, jobs))
+
+    tables = []
+    summary = []
+    for run, out_df, jump_rate, total_read_count, error in results:
+        if error is not None:
+            print(f'Run {run} failed: {error}')
+            summary.append({'Run': run, 'Error': error})
+            continue
+        out_df.insert(0, 'Run', run)
+        out_df.insert(1, 'Jump Rate', jump_rate)
+        tables.append(out_df)
+        false_read_count = out_df['Expected False Reads'].sum()
+        row = {'Run': run,
+               'Jump Rate': jump_rate,
+               'Total Reads': total_read_count,
+               'Expected False Reads': false_read_count,
+               'Percent False Reads': false_read_count / total_read_count * 100,
+               'Max False Reads': out_df['Expected False Reads'].max()}
+        if 'Expected False Reads Upper' in out_df:
+            row['Max False Reads Upper'] = out_df['Expected False Reads Upper'].max()
+        summary.append(row)
+
+    summary = pd.DataFrame(summary)
+    if 'Error' not in summary:
+        summary['Error'] = None
+
+    os.makedirs(output_dir, exist_ok=True)
+    if tables:
+        pd.concat(tables, ignore_index=True).to_csv(os.path.join(output_dir, 'Expected_False_Reads_Per_Run.csv'),
+                                                    index=False)
+    summary.to_csv(os.path.join(output_dir, 'Run_Summary.csv'), index=False)
+    write_batch_log(summary, os.path.join(output_dir, 'batch_log.txt'))
+
+    return summary
+
+
+def write_batch_log(summary, path):
+    '''
+    Writes summary statistics of the jump rates across runs to a text file
+
+    summary: per-run summary as returned by calculate_batch
+    '''
+    done = summary[summary['Error'].isna()]
+    with open(path, 'w') as out:
+        print(f'Runs: {len(summary)}, failed: {len(summary) - len(done)}', file=out)
+        if len(done):
+            rates = done.set_index('Run')['Jump Rate']
+            print(f'Mean jump rate: {rates.mean()}', file=out)
+            print(f'Median jump rate: {rates.median()}', file=out)
+            print(f'Standard deviation of the jump rate: {rates.std(ddof=0)}', file=out)
+            print(f'Lowest jump rate: {rates.min()} ({rates.idxmin()})', file=out)
+            print(f'Highest jump rate: {rates.max()} ({rates.idxmax()})', file=out)
+
+            # Runs far from the rest, by median absolute deviation
+            deviation = (rates - rates.median()).abs()
+            mad = deviation.median()
+            outliers = rates[deviation > 3 * mad] if mad > 0 else rates.iloc[:0]
+            print(f'Runs with an outlying jump rate: {", ".join(outliers.index) or "none"}', file=out)
+            print(f'Total percent of false reads: '
+                  f'{done["Expected False Reads"].sum() / done["Total Reads"].sum() * 100:.3f}%', file=out)
+        for run, error in summary.loc[summary['Error'].notna(), ['Run', 'Error']].itertuples(index=False):
+            print(f'Failed run {run}: {error}', file=out)
+
+
+def main():
+    cli.standalone('calculate-batch')
+
+
+if __name__ == '__main__':
+    main()
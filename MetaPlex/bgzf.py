@@ -0,0 +1,157 @@
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+# gzip member header with the BGZF 'BC' extra subfield holding the compressed block size
+_HEADER = struct.Struct('<4BI2BH2BHH')
+
+# Uncompressed bytes per block, small enough that the compressed block always fits the 16 bit block size
+BLOCK_SIZE = 0xff00
+
+# Empty block that marks the end of a BGZF file
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def iter_raw_blocks(f, end=None):
+    '''
+    Reads BGZF blocks out of a binary file handle without decompressing them
+
+    end : file offset to stop at, the end of the file by default
+
+    Return : generator of (deflate payload, uncompressed size) tuples
+    '''
+    while end is None or f.tell() < end:
+        header = f.read(_HEADER.size)
+        if not header:
+            return
+        if len(header) < _HEADER.size:
+            raise ValueError('Truncated BGZF block header')
+        id1, id2, cm, flg, mtime, xfl, os_, xlen, si1, si2, slen, bsize = _HEADER.unpack(header)
+        if (id1, id2, si1, si2) != (31, 139, 66, 67):
+            raise ValueError('Not a BGZF file: missing BC extra subfield')
+
+        # Any extra subfields beyond BC are skipped along with the deflate payload and trailer
+        size = bsize + 1 - _HEADER.size
+        rest = f.read(size)
+        if len(rest) < size:
+            raise ValueError('Truncated BGZF block')
+        payload = rest[xlen - 6:-8]
+        crc, isize = struct.unpack('<II', rest[-8:])
+        yield payload, isize
+
+
+def _inflate(block):
+    payload, isize = block
+    data = zlib.decompress(payload, -15)
+    if len(data) != isize:
+        raise ValueError('Corrupt BGZF block: uncompressed size does not match')
+    return data
+
+
+def read_blocks(path, threads=None, start=0, end=None):
+    '''
+    Decompresses a BGZF file (e.g. a BAM) block by block. zlib releases the GIL, so blocks are inflated in parallel by
+    a pool of threads while the results are yielded in file order.
+
+    path    : path to a BGZF compressed file, or a binary handle to read it from front to back (e.g. stdin)
+
+    threads : number of decompression threads, defaults to one per CPU
+
+    start   : file offset of the first block to read, e.g. from a sample index written by BgzfWriter
+
+    end     : file offset to stop reading at, the end of the file by default
+
+    Return : generator of decompressed byte blocks
+    '''
+    threads = threads or os.cpu_count()
+    with (open(path, 'rb') if isinstance(path, (str, os.PathLike)) else path) as f, ThreadPoolExecutor(threads) as pool:
+        if start:
+            f.seek(start)
+        pending = deque()
+        for block in iter_raw_blocks(f, end):
+            pending.append(pool.submit(_inflate, block))
+            if len(pending) >= 4 * threads:
+                data = pending.popleft().result()
+                if data:
+                    yield data
+        while pending:
+            data = pending.popleft().result()
+            if data:
+                yield data
+
+
+def _deflate(data, compresslevel):
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    payload = compressor.compress(data) + compressor.flush()
+    header = _HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, _HEADER.size + len(payload) + 8 - 1)
+
+    return b''.join((header, payload, struct.pack('<II', zlib.crc32(data), len(data))))
+
+
+class BgzfWriter:
+    '''
+    Writes a BGZF file: a series of gzip members of at most 64 KB each, which any gzip reader can decompress as one
+    stream. Blocks are compressed in parallel by a pool of threads and written in order.
+
+    path          : output path
+
+    threads       : number of compression threads, defaults to one per CPU
+
+    compresslevel : gzip compression level
+
+    offsets lists the file offset of every block once the writer is closed, with the size of the file last.
+    '''
+
+    def __init__(self, path, threads=None, compresslevel=6):
+        self.handle = open(path, 'wb')
+        self.threads = threads or os.cpu_count()
+        self.compresslevel = compresslevel
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.offsets = [0]
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BLOCK_SIZE:
+            self._submit(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+
+    def flush(self):
+        '''
+        Ends the current block, so that the next write starts a new one
+
+        Return : number of the block the next write goes into
+        '''
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+
+        return len(self.offsets) - 1 + len(self.pending)
+
+    def _submit(self, data):
+        self.pending.append(self.pool.submit(_deflate, data, self.compresslevel))
+        # Bounded number of blocks in flight, so a slow disk holds up the caller rather than filling memory
+        if len(self.pending) >= 4 * self.threads:
+            self._write_block(self.pending.popleft().result())
+
+    def _write_block(self, block):
+        self.handle.write(block)
+        self.offsets.append(self.offsets[-1] + len(block))
+
+    def close(self):
+        self.flush()
+        while self.pending:
+            self._write_block(self.pending.popleft().result())
+        self.pool.shutdown()
+        self.handle.write(EOF_BLOCK)
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from .metrics import json_default
+
+
+# Cache directory and size limit. Set from the environment so that every entry point can use the cache without new
+# command line arguments, or from Python with configure(). Caching is off while no directory is set.
+_config = {'path': os.environ.get('METAPLEX_CACHE'),
+           'max_size': os.environ.get('METAPLEX_CACHE_SIZE')}
+
+# Bumped whenever a stage's outputs change for the same inputs, so stale entries are never reused
+VERSION = 1
+
+_UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def configure(path=None, max_size=None):
+    '''
+    Turns on the stage cache for this process
+
+    path     : cache directory, None turns caching off
+
+    max_size : size limit of the cache in bytes, or a string such as '20G'. The least recently used entries are
+               evicted once it is exceeded.
+    '''
+    _config['path'] = path
+    _config['max_size'] = max_size
+
+
+def enabled():
+    return bool(_config['path'])
+
+
+def parse_size(size):
+    '''
+    Converts a size such as 500M or 20G (or a plain number of bytes) to bytes
+    '''
+    if size is None or isinstance(size, int):
+        return size
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in _UNITS:
+        return int(float(size[:-1]) * _UNITS[size[-1]])
+    return int(size)
+
+
+def key(stage, files, parameters):
+    '''
+    Content-addressed key of a stage run: a hash of the stage name, the contents of its input files and its
+    parameters
+
+    stage      : name of the stage, e.g. 'remultiplex'
+
+    files      : list of input file paths. Anything that is not a path (e.g. an in-memory table) makes the run
+                 uncacheable.
+
+    parameters : dictionary of JSON serializable parameters
+
+    Return : hex digest, or None if caching is off or the run can't be cached
+    '''
+    if not enabled():
+        return None
+    if not all(isinstance(f, (str, os.PathLike)) and os.path.isfile(f) for f in files):
+        return None
+
+    h = hashlib.blake2b(digest_size=20)
+    h.update(json.dumps([stage, VERSION, parameters], sort_keys=True, default=json_default).encode())
+    for f in files:
+        h.update(file_digest(f).encode())
+
+    return h.hexdigest()
+
+
+def file_digest(path):
+    '''
+    Hash of a file's contents. Digests are remembered by path, size and modification time, so a large sequence file
+    is only read again once it changes.
+    '''
+    stat = os.stat(path)
+    memo_key = f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'
+    memo_path = os.path.join(_config['path'], 'digests.json')
+    memo = _read_json(memo_path) or {}
+    if memo_key in memo:
+        return memo[memo_key]
+
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(4 << 20), b''):
+            h.update(block)
+    memo[memo_key] = h.hexdigest()
+    os.makedirs(_config['path'], exist_ok=True)
+    _write_json(memo_path, memo)
+
+    return memo[memo_key]
+
+
+def restore(entry, files=(), dest='.'):
+    '''
+    Copies the stored outputs of a cache entry into dest
+
+    entry : key as returned by key()
+
+    files : names of the output files to restore
+
+    dest  : directory the files are copied to
+
+    Return : dictionary of the values stored with the outputs, or None on a cache miss
+    '''
+    if entry is None:
+        return None
+    path = os.path.join(_config['path'], entry)
+    meta = _read_json(os.path.join(path, 'meta.json'))
+    if meta is None or not all(os.path.exists(os.path.join(path, 'files', f)) for f in files):
+        return None
+
+    for f in files:
+        target = os.path.join(dest, f)
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+        shutil.copyfile(os.path.join(path, 'files', f), target)
+
+    # The modification time of the entry is its last use, for LRU eviction
+    os.utime(path)
+
+    return meta['values']
+
+
+def store(entry, files=(), values=None, src='.'):
+    '''
+    Stores the outputs of a stage run under its key, then evicts least recently used entries beyond the size limit
+
+    entry  : key as returned by key()
+
+    files  : names of the output files, relative to src
+
+    values : dictionary of JSON serializable values to return with the files on a hit
+
+    src    : directory the files are in
+    '''
+    if entry is None:
+        return
+    os.makedirs(_config['path'], exist_ok=True)
+
+    # Entries are assembled in a temporary directory and renamed into place, so a reader never sees half of one
+    temp = tempfile.mkdtemp(prefix='.tmp_', dir=_config['path'])
+    size = 0
+    for f in files:
+        target = os.path.join(temp, 'files', f)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(os.path.join(src, f), target)
+        size += os.path.getsize(target)
+    _write_json(os.path.join(temp, 'meta.json'), {'created': time.time(), 'size': size, 'files': list(files),
+                                                  'values': values or {}})
+
+    path = os.path.join(_config['path'], entry)
+    shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.rename(temp, path)
+    except OSError:
+        # Another process stored the same entry first
+        shutil.rmtree(temp, ignore_errors=True)
+
+    evict(parse_size(_config['max_size']))
+
+
+def evict(max_size):
+    '''
+    Deletes the least recently used entries until the cache holds at most max_size bytes
+    '''
+    if max_size is None or not enabled() or not os.path.isdir(_config['path']):
+        return
+
+    entries = []
+    for name in os.listdir(_config['path']):
+        meta = _read_json(os.path.join(_config['path'], name, 'meta.json'))
+        if meta is not None:
+            entries.append((os.path.getmtime(os.path.join(_config['path'], name)), meta['size'], name))
+
+    total = sum(size for used, size, name in entries)
+    for used, size, name in sorted(entries):
+        if total <= max_size:
+            break
+        shutil.rmtree(os.path.join(_config['path'], name), ignore_errors=True)
+        total -= size
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, value):
+    temp = path + f'.{os.getpid()}.tmp'
+    with open(temp, 'w') as f:
+        json.dump(value, f, default=json_default)
+    os.replace(temp, path)
@@ -0,0 +1,225 @@
+import argparse
+import os
+import sys
+
+
+# Only the standard library is imported up front: pandas, numpy, biom and scipy are imported by the subcommand that
+# runs, so that --help, argument errors and dry runs of workflow engines return immediately.
+
+
+def _remultiplex_arguments(parser):
+    parser.add_argument('sequenceFile', help="raw sequence file of type .fastq, .fastq.gz, or .bam, or '-' for stdin")
+    parser.add_argument('indexFile', help='.csv containing all the index tag sequences in the sequencing pool')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='number of worker processes, 0 for one per CPU (default: 1)')
+    parser.add_argument('-m', '--max-mismatches', type=int, default=0,
+                        help='maximum number of substitutions tolerated in each index tag (default: 0)')
+    parser.add_argument('--output-dir', default='.', help='directory the outputs are written to (default: .)')
+    parser.add_argument('--work-dir', default=None, help='directory for temporary files (default: system temp)')
+    parser.add_argument('-o', '--output', default=None,
+                        help="stream the reads to this path or named pipe as they are produced, '-' for stdout, "
+                             "instead of writing a sample sorted remultiplexed_seqs.fastq.gz")
+    parser.add_argument('--trim-primers', action='store_true',
+                        help='trim the MetaPlex library prep primers (LCO1490 / CO1-CFMRa) off every read')
+    parser.add_argument('--primers', nargs=2, default=None, metavar=('FORWARD', 'REVERSE'),
+                        help='trim this primer pair instead, both 5\' to 3\' as synthesized')
+    parser.add_argument('--min-length', type=int, default=None, help='drop reads shorter than this after trimming')
+    parser.add_argument('--primer-error-rate', type=float, default=0.1,
+                        help='maximum fraction of mismatched primer bases (default: 0.1)')
+    parser.add_argument('--memory', type=int, default=256,
+                        help='MB of reads held in memory while sorting them by sample (default: 256)')
+
+
+def _remultiplex(args):
+    from .primers import ANML_PRIMERS
+    from .remultiplexing import remultiplex
+
+    primers = args.primers or (ANML_PRIMERS if args.trim_primers else None)
+    try:
+        remultiplex(args.sequenceFile, args.indexFile, workers=args.workers, max_mismatches=args.max_mismatches,
+                    output_dir=args.output_dir, work_dir=args.work_dir, output=args.output, primers=primers,
+                    min_length=args.min_length, primer_error_rate=args.primer_error_rate, memory=args.memory << 20)
+    except BrokenPipeError:
+        # The reader downstream stopped early, e.g. head. Silence the final flush of stdout on exit.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+
+
+def _bounds_arguments(parser, help):
+    parser.add_argument('--confidence', type=float, default=None, help=help)
+    parser.add_argument('--replicates', type=int, default=10000,
+                        help='Monte Carlo replicates for the bounds (default: 10000)')
+    parser.add_argument('--seed', type=int, default=None, help='random seed for the bounds')
+
+
+def _calculate_arguments(parser):
+    parser.add_argument('demultiplexed_seqs', help='demultiplexed qza, or remultiplexed_counts.tsv')
+    parser.add_argument('sample_map', help='tab delimited QIIME2 sample map')
+    parser.add_argument('calibrator_tag_pairs', nargs='*', help='calibrator tag pairs, ex: 01,11 02,12')
+    parser.add_argument('--output-dir', default='.', help='directory the outputs are written to (default: .)')
+    parser.add_argument('--work-dir', default=None, help='directory for temporary files (default: system temp)')
+    _bounds_arguments(parser, 'add per-sample bounds of the expected false reads at this confidence level, ex: 0.95')
+
+
+def _calculate(args):
+    from .index_jump import calculate
+
+    c_tags_list = [tuple(pair.split(',')) for pair in args.calibrator_tag_pairs] or None
+    calculate(args.demultiplexed_seqs, args.sample_map, c_tags_list, output_dir=args.output_dir,
+              work_dir=args.work_dir, confidence=args.confidence, replicates=args.replicates, seed=args.seed)
+
+
+def _calculate_batch_arguments(parser):
+    parser.add_argument('manifest', help='tab delimited manifest with run, demultiplexed_seqs, sample_map and '
+                                         'calibrator_tag_pairs columns')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of runs processed at the same time (default: one per CPU)')
+    parser.add_argument('--output-dir', default='.', help='directory the outputs are written to (default: .)')
+    parser.add_argument('--work-dir', default=None, help='directory for temporary files (default: system temp)')
+    _bounds_arguments(parser, 'add per-sample bounds of the expected false reads at this confidence level, ex: 0.95')
+
+
+def _calculate_batch(args):
+    from .batch import calculate_batch
+
+    calculate_batch(args.manifest, workers=args.workers, output_dir=args.output_dir, work_dir=args.work_dir,
+                    confidence=args.confidence, replicates=args.replicates, seed=args.seed)
+
+
+def _per_sample_filter_arguments(parser):
+    parser.add_argument('feature_table', help='FeatureTable[Frequency] qza or .biom table')
+    # Exactly one of a filtering integer / csv and a jump rate, checked by argparse like any other bad argument
+    thresholds = parser.add_mutually_exclusive_group(required=True)
+    thresholds.add_argument('filtering_integer', nargs='?', default=None,
+                            help='integer for even filtering across samples, or path to '
+                                 'Expected_False_Reads_Per_Index.csv')
+    thresholds.add_argument('--jump-rate', type=float, default=None,
+                            help='filter each feature at its own expected false reads at this jump rate, instead of a '
+                                 'filtering integer or csv')
+    parser.add_argument('--output-dir', default='.', help='directory the output is written to (default: .)')
+    parser.add_argument('--upper-bound', action='store_true',
+                        help='filter at the upper bound of the expected false reads in the csv')
+
+
+def _per_sample_filter(args):
+    from .per_sample_filtering import per_sample_filter
+
+    filtering_integer = args.filtering_integer
+    if filtering_integer is not None and not filtering_integer.endswith('.csv'):
+        filtering_integer = int(filtering_integer)
+    per_sample_filter(args.feature_table, filtering_integer, output_dir=args.output_dir, upper_bound=args.upper_bound,
+                      jump_rate=args.jump_rate)
+
+
+def _length_filter_arguments(parser):
+    parser.add_argument('feature_table', help='FeatureTable[Frequency] qza')
+    parser.add_argument('representative_sequences', help='FeatureData[Sequence] qza')
+    parser.add_argument('length_to_filter', type=int, nargs='+',
+                        help='minimum sequence length, several lengths sweep every threshold')
+    parser.add_argument('--output-dir', default='.', help='directory the outputs are written to (default: .)')
+
+
+def _length_filter(args):
+    from .length_filtering import length_filter
+
+    thresholds = args.length_to_filter
+    length_filter(args.feature_table, args.representative_sequences,
+                  thresholds if len(thresholds) > 1 else thresholds[0], output_dir=args.output_dir)
+
+
+# Output names of the pipeline, kept here so that its --outputs choices don't need the pipeline module
+PIPELINE_OUTPUTS = ['false_reads', 'log', 'freq_filt_table', 'table', 'seqs']
+
+
+def _run_arguments(parser):
+    parser.add_argument('demultiplexed_seqs', help='demultiplexed qza, or remultiplexed_counts.tsv')
+    parser.add_argument('sample_map', help='tab delimited QIIME2 sample map')
+    parser.add_argument('feature_table', help='FeatureTable[Frequency] qza')
+    parser.add_argument('representative_sequences', help='FeatureData[Sequence] qza')
+    parser.add_argument('-c', '--calibrators', nargs='+', default=None,
+                        help='calibrator tag pairs, ex: 01,11 02,12')
+    parser.add_argument('-f', '--filtering-integer', type=int, default=None,
+                        help='filter every sample at this read count instead of its expected false reads')
+    parser.add_argument('-l', '--length', type=int, default=None, help='minimum sequence length')
+    parser.add_argument('-o', '--outputs', nargs='+', default=['table', 'seqs'], choices=PIPELINE_OUTPUTS,
+                        help='files to write (default: table seqs)')
+    parser.add_argument('--output-dir', default='.', help='directory the outputs are written to (default: .)')
+    parser.add_argument('--work-dir', default=None, help='directory for temporary files (default: system temp)')
+    _bounds_arguments(parser, 'filter each sample at the upper bound of its expected false reads at this '
+                              'confidence level, ex: 0.95')
+    parser.add_argument('--per-feature', action='store_true',
+                        help='filter each feature at its own expected false reads instead of those of its sample')
+
+
+def _run(args):
+    from .pipeline import run
+
+    calibrators = [tuple(pair.split(',')) for pair in args.calibrators] if args.calibrators else None
+    run(args.demultiplexed_seqs, args.sample_map, args.feature_table, args.representative_sequences,
+        calibrator_tag_pairs=calibrators, filtering_integer=args.filtering_integer, length_to_filter=args.length,
+        outputs=args.outputs, output_dir=args.output_dir, work_dir=args.work_dir, confidence=args.confidence,
+        replicates=args.replicates, seed=args.seed, per_feature=args.per_feature)
+
+
+# Subcommand: (standalone console script, description, argument definitions, handler)
+COMMANDS = {
+    'remultiplex': ('Metaplex-remultiplex',
+                    "Takes dual-indexed reads, trims the 5' and 3' ends of the reads past the indexes, and moves the "
+                    "3' index to immediately follow the 5' index (i.e. ['MultiplexedSingleEndBarcodeInSequence'] "
+                    "format)",
+                    _remultiplex_arguments, _remultiplex),
+    'calculate': ('Metaplex-calculate-IJR',
+                  'Calculate Index Jump Rate based off calibrator Tags',
+                  _calculate_arguments, _calculate),
+    'calculate-batch': ('Metaplex-calculate-IJR-batch',
+                        'Calculate Index Jump Rates of many sequencing runs listed in a manifest',
+                        _calculate_batch_arguments, _calculate_batch),
+    'per-sample-filter': ('Metaplex-per-sample-filter',
+                          'Filters reads out of a QIIME2 feature table per sample',
+                          _per_sample_filter_arguments, _per_sample_filter),
+    'length-filter': ('Metaplex-length-filter',
+                      'Length filter of QIIME2 feature table and representative sequences',
+                      _length_filter_arguments, _length_filter),
+    'run': ('Metaplex-run',
+            'Runs index jump calculation, per-sample filtering and length filtering in one go, without '
+            'intermediate files',
+            _run_arguments, _run),
+}
+
+
+def build_parser():
+    '''
+    Return : argparse.ArgumentParser of the metaplex command, with one subcommand per MetaPlex tool
+    '''
+    parser = argparse.ArgumentParser(prog='metaplex',
+                                     description='Read Processing and Quality Control Toolkit for Dual-Indexed '
+                                                 'Metabarcoding')
+    subparsers = parser.add_subparsers(dest='command', metavar='command', required=True)
+    for name, (script, description, add_arguments, handler) in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=description, description=description)
+        add_arguments(subparser)
+        subparser.set_defaults(handler=handler)
+
+    return parser
+
+
+def main(argv=None):
+    '''
+    Entry point of the metaplex command, ex: metaplex calculate counts.tsv Sample_Map.txt 01,11
+    '''
+    args = build_parser().parse_args(argv)
+    args.handler(args)
+
+
+def standalone(name, argv=None):
+    '''
+    Runs one subcommand as its own console script, ex: Metaplex-calculate-IJR
+    '''
+    script, description, add_arguments, handler = COMMANDS[name]
+    parser = argparse.ArgumentParser(prog=script, description=description)
+    add_arguments(parser)
+    handler(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+import csv
+
+from .bgzf import BgzfWriter, read_blocks
+from .streams import QueueWriter, open_input
+
+
+def open_sequence_file(sequenceFile):
+    '''
+    Opens a .fastq or .fastq.gz file, '-' for stdin or a named pipe for binary reading, decompressing it if it is
+    gzipped. A binary handle that is already open is returned as is.
+    '''
+    if hasattr(sequenceFile, 'read'):
+        return sequenceFile
+    kind, handle = open_input(sequenceFile)
+    if kind != 'fastq':
+        handle.close()
+        raise ValueError(f'{sequenceFile} is a BAM file, not a fastq')
+    return handle
+
+
+def read_fastq(sequenceFile, block_size=1 << 20):
+    '''
+    Streams records out of a .fastq or .fastq.gz file, reading it in fixed size blocks so that memory use is
+    independent of file size
+
+    sequenceFile : path to a .fastq or .fastq.gz file
+
+    block_size   : number of (decompressed) bytes read at a time
+
+    Return : generator of (header, sequence, plus, quality) byte string tuples
+    '''
+    with open_sequence_file(sequenceFile) as f:
+        yield from iter_fastq_blocks(iter(lambda: f.read(block_size), b''))
+
+
+def read_fastq_chunks(sequenceFile, chunk_size=8 << 20):
+    '''
+    Splits a .fastq or .fastq.gz file into record-aligned chunks of raw bytes, suitable for handing to worker
+    processes without parsing them first
+
+    sequenceFile : path to a .fastq or .fastq.gz file, '-' for stdin, or a binary handle of fastq data
+
+    chunk_size   : approximate number of (decompressed) bytes per chunk
+
+    Return : generator of byte strings, each holding a whole number of fastq records
+    '''
+    with open_sequence_file(sequenceFile) as f:
+        remainder = b''
+        while True:
+            block = f.read(chunk_size)
+            if not block:
+                break
+            data = remainder + block
+            end = _record_boundary(data)
+            remainder = data[end:]
+            if end:
+                yield data[:end]
+
+        if remainder.strip():
+            if not remainder.endswith(b'\n'):
+                remainder += b'\n'
+            if remainder.count(b'\n') % 4:
+                raise ValueError('Truncated fastq file: last record does not have four lines')
+            yield remainder
+
+
+def read_index(path):
+    '''
+    Reads the sample index written by FastqWriter.write_index
+
+    Return : dictionary of {sample ID: (start offset, end offset, record count)}
+    '''
+    with open(path, newline='') as f:
+        return {row['sample ID']: (int(row['start']), int(row['end']), int(row['records']))
+                for row in csv.DictReader(f, delimiter='\t')}
+
+
+def read_sample(sequenceFile, index, sample, threads=None):
+    '''
+    Streams the records of one sample out of a sample sorted fastq written by FastqWriter, seeking straight to the
+    sample instead of decompressing the file from the start
+
+    sequenceFile : path to the .fastq or .fastq.gz file
+
+    index        : path to its sample index, or the dictionary returned by read_index
+
+    sample       : sample ID, ex: 'F01R11'
+
+    threads      : number of decompression threads for .gz files
+
+    Return : generator of (header, sequence, plus, quality) byte string tuples
+    '''
+    if not isinstance(index, dict):
+        index = read_index(index)
+    if sample not in index:
+        return
+    start, end, records = index[sample]
+
+    if sequenceFile.endswith('.gz'):
+        yield from iter_fastq_blocks(read_blocks(sequenceFile, threads, start, end))
+    else:
+        with open(sequenceFile, 'rb') as f:
+            f.seek(start)
+            yield from iter_fastq_blocks([f.read(end - start)])
+
+
+def _record_boundary(data):
+    '''
+    Offset just past the last complete four line record in data
+    '''
+    newlines = data.count(b'\n')
+    end = len(data)
+    # Step back over the newlines of the trailing partial record (plus the partial last line)
+    for _ in range(newlines % 4 + 1):
+        end = data.rfind(b'\n', 0, end)
+    return end + 1
+
+
+def iter_fastq_blocks(blocks):
+    '''
+    Splits a stream of arbitrary byte blocks into fastq records
+
+    blocks : iterable of byte strings which, concatenated, form a fastq file
+
+    Return : generator of (header, sequence, plus, quality) byte string tuples
+    '''
+    remainder = b''
+    for block in blocks:
+        lines = (remainder + block).split(b'\n')
+        # Anything after the last complete record is carried into the next block
+        complete = (len(lines) - 1) - (len(lines) - 1) % 4
+        remainder = b'\n'.join(lines[complete:])
+        yield from _records(lines, complete)
+
+    lines = remainder.split(b'\n')
+    if lines[-1] == b'':
+        lines.pop()
+    if len(lines) % 4:
+        raise ValueError('Truncated fastq file: last record does not have four lines')
+    yield from _records(lines, len(lines))
+
+
+def _records(lines, stop):
+    for i in range(0, stop, 4):
+        header, seq, plus, qual = lines[i:i + 4]
+        if header.endswith(b'\r'):
+            header, seq, plus, qual = header[:-1], seq[:-1], plus[:-1], qual[:-1]
+        yield header, seq, plus, qual
+
+
+class FastqWriter:
+    '''
+    Buffered fastq writer that compresses records as they are written, so the uncompressed output never lands on disk.
+    Records are collected into byte blocks of roughly block_size before being handed to the compressor.
+
+    .gz output is block gzip (BGZF) compressed by a pool of threads. Marking where each sample starts with
+    start_sample begins it on a fresh block, and write_index then records the offsets of every sample so that
+    read_sample can seek straight to it.
+
+    path          : output path, compressed if it ends in .gz, or '-' for uncompressed fastq on stdout. Uncompressed
+                    output is written by a background thread, so writing to a pipe overlaps with producing records.
+
+    block_size    : number of bytes buffered before each write
+
+    compresslevel : gzip compression level
+
+    threads       : number of compression threads, defaults to one per CPU
+    '''
+
+    def __init__(self, path, block_size=4 << 20, compresslevel=6, threads=None):
+        self.bgzf = path.endswith('.gz')
+        if self.bgzf:
+            self.handle = BgzfWriter(path, threads=threads, compresslevel=compresslevel)
+        else:
+            self.handle = QueueWriter(path)
+        self.block_size = block_size
+        self.buffer = []
+        self.buffered = 0
+        self.lines = 0
+        self.samples = []
+
+    def write(self, data):
+        '''
+        Adds fastq data (bytes holding newline terminated lines) to the output
+        '''
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.lines += data.count(b'\n')
+        if self.buffered >= self.block_size:
+            self.flush()
+
+    @property
+    def records(self):
+        return self.lines // 4
+
+    def flush(self):
+        if self.buffer:
+            self.handle.write(b''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def start_sample(self, sample):
+        '''
+        Marks the start of a sample's records. Samples must be written one after another.
+        '''
+        self.flush()
+        # Block number in BGZF output, as block offsets are only known once compressed, or file offset otherwise
+        self.samples.append((sample, self.handle.flush() if self.bgzf else self.handle.tell(), self.records))
+
+    def close(self):
+        self.flush()
+        if not self.bgzf:
+            self.size = self.handle.tell()
+        self.handle.close()
+
+    def write_index(self, path):
+        '''
+        Writes the sample index, a tab delimited file of the start and end offsets and record count of every sample
+        marked with start_sample. Only valid once the writer is closed.
+        '''
+        offsets = self.handle.offsets if self.bgzf else None
+        ends = self.samples[1:] + [(None, None, self.records)]
+        with open(path, 'w') as out:
+            print('sample ID\tstart\tend\trecords', file=out)
+            for (sample, start, first), (_, end, last) in zip(self.samples, ends):
+                if self.bgzf:
+                    start, end = offsets[start], offsets[-1] if end is None else offsets[end]
+                elif end is None:
+                    end = self.size
+                print(f'{sample}\t{start}\t{end}\t{last - first}', file=out)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,201 +1,444 @@
-import pathlib
-import math
-import sys
-import shutil
-import tempfile
 import os
+import tempfile
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
-from qiime2 import Artifact
-from qiime2.plugins.demux.visualizers import summarize
 
+from . import artifacts, cache, cli, metrics
+from .tags import TagRegistry
 
-def calculate(demultiplexed_seqs, sample_map, calibrator_tag_pairs):
+
+def read_counts(counts_file):
     '''
-    Calculate Index Jump Rate based off calibrator Tags
+    Reads per-sample read counts from either the Forward x Reverse count matrix written by remultiplexing.remultiplex
+    (remultiplexed_counts.tsv, or the DataFrame it returns), or a QIIME2 per-sample-fastq-counts.tsv
+
+    Return: pandas DataFrame with 'sample ID' and 'forward sequence count' columns
+    '''
+    if isinstance(counts_file, pd.DataFrame):
+        counts = counts_file
+    else:
+        counts = pd.read_csv(counts_file, sep='\t', index_col=0)
+    if 'forward sequence count' in counts.columns:
+        return counts.reset_index()[['sample ID', 'forward sequence count']]
+
+    # Count matrix: one row per Forward index, one column per Reverse index
+    long_df = counts.stack().reset_index()
+    long_df.columns = ['Fwd', 'Rev', 'forward sequence count']
+    long_df['sample ID'] = long_df['Fwd'].astype(str) + long_df['Rev'].astype(str)
+
+    return long_df[['sample ID', 'forward sequence count']]
+
+
+def count_demux_reads(demultiplexed_seqs, workers=None):
+    '''
+    Counts the reads of every sample in a demultiplexed QIIME2 artifact by streaming its per-sample .fastq.gz members
+    straight out of the qza archive, without loading the artifact or running the demux summarize visualizer
 
     demultiplexed_seqs: path to demultiplexed QIIME2 qza file of data type SampleData[SequencesWithQuality]
 
-    sample_map: path to tab delimited QIIME2 sample map file
+    workers: number of worker processes that samples are spread across, defaults to one per CPU
 
-    calibrator_tag_pairs: pairs of calibrator tags, input as either a tuple, or list of tuples, with
-                          each index being a 2 digit zero padded string.
-                          ex: [('01', '11')] or [('01', '11'), ('02','12')]
+    Return: pandas DataFrame with 'sample ID' and 'forward sequence count' columns, as in the demux summarize
+            per-sample-fastq-counts.tsv
+    '''
+    with zipfile.ZipFile(demultiplexed_seqs) as qza:
+        names = artifacts.data_names(qza)
+
+    if 'MANIFEST' in names:
+        with artifacts.open_data(demultiplexed_seqs, 'MANIFEST') as f:
+            manifest_df = pd.read_csv(f, comment='#')
+        manifest_df = manifest_df[manifest_df['direction'] == 'forward']
+        members = dict(zip(manifest_df['filename'], manifest_df['sample-id']))
+    else:
+        # Casava file names: {sample ID}_{n}_L001_R1_001.fastq.gz
+        members = {n: n.rsplit('_', 4)[0] for n in names if n.endswith('_R1_001.fastq.gz')}
 
-    Return: Integer value of maximum number of index jumps (false reads) expected in a single sample
-    Output: Expected_False_Reads_Per_Index.csv file containing number of false reads expected in EACH sample
-            log.txt file containing summary statistics
+    workers = workers or os.cpu_count()
+    jobs = [(demultiplexed_seqs, member) for member in members]
+    if workers == 1:
+        record_counts = list(map(_count_member, jobs))
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            record_counts = list(pool.map(_count_member, jobs, chunksize=max(len(jobs) // (4 * workers), 1)))
+
+    return pd.DataFrame({'sample ID': list(members.values()), 'forward sequence count': record_counts})
+
+
+def _count_member(job, block_size=4 << 20):
+    '''
+    Counts fastq records in one gzipped member of a qza archive by counting newlines over large decompressed blocks
+    '''
+    path, member = job
+    lines = 0
+    last = b'\n'
+    with artifacts.open_data(path, member) as f:
+        inflate = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        for block in iter(lambda: f.read(block_size), b''):
+            while block:
+                data = inflate.decompress(block)
+                if data:
+                    lines += data.count(b'\n')
+                    last = data[-1:]
+                if not inflate.eof:
+                    break
+                # Concatenated gzip members each need a fresh decompressor
+                block = inflate.unused_data
+                inflate = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+    if last != b'\n':
+        lines += 1
+
+    return lines // 4
+
+
+def count_matrix(df):
     '''
+    Pivots per-sample read counts into a Forward x Reverse count matrix
 
-    def extract_tsvs(viz, dest):
-        '''
-        Extracts useful TSV from QIIME artifact files
-        '''
-        with tempfile.TemporaryDirectory() as temp:
-            viz.export_data(temp)
-            temp_pathlib = pathlib.Path(temp)
-            for file in temp_pathlib.iterdir():
-                if file.suffix == '.tsv':
-                    shutil.copy(file, dest)
+    df: pandas DataFrame with 'Fwd', 'Rev' and 'forward sequence count' columns
 
-    # Load in sample_map as pandas df
-    meta_df = pd.read_csv(sample_map, sep='\t')
+    Return: pandas DataFrame indexed by Forward index, with one column per Reverse index. Combinations without any
+            reads are 0.
+    '''
+    counts = df.pivot_table(index='Fwd', columns='Rev', values='forward sequence count', aggfunc='sum', fill_value=0)
+    counts.columns.name = None
 
-    # Load in demultiplexed sequences from path and Summarize
-    demux = Artifact.load(demultiplexed_seqs)
-    print('Demultiplexed sequences loaded... Extracting per sample summaries to tsvs directory \n . \n . \n .')
-    demux_summary = summarize(demux)
-    demux_viz = demux_summary.visualization
+    return counts
 
-    # Make directory, extract tsvs, read in per-sample tsv, set as df
-    os.makedirs('tsvs', exist_ok=True)
-    extract_tsvs(demux_viz, 'tsvs')
-    per_sample_df = pd.read_csv("./tsvs/per-sample-fastq-counts.tsv", sep="\t")
-    df = per_sample_df
 
-    # Establishing variables and altering dataframes
-    # Create FWD index column
-    df['Fwd']     = df['sample ID'].str[1:3]
+def expected_false_reads(counts, jump_rate):
+    '''
+    Expected number of false (index jumped) reads in every Forward x Reverse combination, taking into account the
+    abundance of each individual tag in the sample pool
+
+    counts:    Forward x Reverse read count matrix, as returned by count_matrix
+
+    jump_rate: index jump rate of the sequencing run
+
+    Return: Forward x Reverse matrix (pandas DataFrame) of expected false reads, rounded up to whole reads
+    '''
+    n = counts.to_numpy(dtype=float)
+    total = n.sum()
+
+    # Marginal sums: No. of reads with each FWD index (rows), and with each REV index (columns)
+    i_seqs = n.sum(axis=1)[:, None]
+    j_seqs = n.sum(axis=0)[None, :]
+
+    # No. of j reads with an expected false i index, and of i reads with an expected false j index
+    i_to_j = (i_seqs * jump_rate) * ((j_seqs - n) / total)
+    j_to_i = (j_seqs * jump_rate) * ((i_seqs - n) / total)
 
-    # Create REV index column
-    df['Rev']     = df['sample ID'].str[4:6]
-    df            = df.sort_values(['sample ID'])
-    df.reset_index(inplace=True)
+    return pd.DataFrame(np.ceil(i_to_j + j_to_i).astype(int), index=counts.index, columns=counts.columns)
 
-    # Add in True_False coding
-    df['True_False'] = meta_df['True_False']
 
+def calibrator_counts(counts, true_false, registry, calibrator_tag_pairs):
+    '''
+    Read counts that the jump rate is estimated from: the false reads of each calibrator tag and the total reads
+    with that tag
+
+    counts: Forward x Reverse read count array, indexed by tag code
+
+    true_false: Forward x Reverse array of the sample map's True_False coding, -1 for combinations not in the map
+
+    registry: tags.TagRegistry the arrays are indexed by
+
+    calibrator_tag_pairs: pairs of calibrator tags as in calculate, or None to use every false read in the pool
+
+    Return: numpy array of false read counts
+            numpy array of the read counts they were observed among
+            scale of each ratio, so that the jump rate is the mean of scale * false / total
+    '''
     if calibrator_tag_pairs is None:
         print('No calibrator tags given. Calculating index jump rate based on 0s in Sample Map.\n '
               '*NOTE* This calculation method is less accurate than when using calibrator tags!\n'
               'Jump rate estimates will be lower than the true rate and may result in retaining\n'
               'false reads within the sample pool.')
 
-        all_false_reads = df[df["True_False"] == 0]
-        summed_false = all_false_reads['forward sequence count'].sum()
-        jump_rate = (summed_false/(df['forward sequence count'].sum()))*2
+        summed_false = counts[true_false == 0].sum()
+        if counts.sum() == 0:
+            raise ValueError('No reads in the samples of the sample map, the index jump rate cannot be calculated.')
+
+        # Each false read carries two jumped indexes
+        return np.array([summed_false]), np.array([counts.sum()]), 2
+
+    # Error flagging for Calibrator Tag input: Scripting / Jupyter-Notebook
+    print('Validating Calibrator Tag input... \n . \n . \n .')
+    if not all(isinstance(item, tuple) for item in calibrator_tag_pairs):
+        raise TypeError(
+            'Calibrator Tag Index identifiers are not input in proper format. Should be List of Tuples.')
+
+    # Error flagging for Calibrator Tag input: Command Line input
+    for i, j in calibrator_tag_pairs:
+        if type(i) != str or type(j) != str:
+            raise TypeError('Calibrator Tag Index identifiers are not of proper type. Should be type String.')
+
+    # False reads of every calibrator tag, out of all reads with that tag
+    false_counts = []
+    tag_counts = []
+    for fwd, rev in calibrator_tag_pairs:
+
+        # Row of the Forward tag and column of the Reverse tag. Unknown tags raise a ValueError.
+        fwd_code = registry.code(fwd, 'F')
+        rev_code = registry.code(rev, 'R')
+        fwd_counts, fwd_true_false = counts[fwd_code], true_false[fwd_code]
+        rev_counts, rev_true_false = counts[:, rev_code], true_false[:, rev_code]
+
+        # Validity check for calibrator tags
+        assert (fwd_true_false == 1).sum() == 1, \
+                                                  f'Specified tag pair {fwd, rev} does not meet requirements for ' \
+                                                  f'usage as calibrator tags. Should only have one true sequence ' \
+                                                  f'specified in sample map.'
+        assert (rev_true_false == 1).sum() == 1, \
+                                                  f'Specified tag pair {fwd, rev} does not meet requirements for ' \
+                                                  f'usage as calibrator tags. Should only have one true sequence ' \
+                                                  f'specified in sample map.'
+
+        # A calibrator tag without reads has no jump rate, and would make every estimate NaN
+        for tag, tag_reads in ((registry.fwd_names[fwd_code], fwd_counts), (registry.rev_names[rev_code], rev_counts)):
+            if tag_reads.sum() == 0:
+                raise ValueError(f'Calibrator tag {tag} of tag pair {fwd, rev} has no reads, the index jump rate '
+                                 f'cannot be calculated from it. Leave this tag pair out of the calibrator tags.')
+
+        print(f'All checks passed! Calculating Index Jump rate based off calibrator tags {fwd, rev}')
+        false_counts += [fwd_counts[fwd_true_false == 0].sum(), rev_counts[rev_true_false == 0].sum()]
+        tag_counts += [fwd_counts.sum(), rev_counts.sum()]
+
+    return np.array(false_counts), np.array(tag_counts), 1
+
+
+def jump_rate_bounds(false_counts, tag_counts, scale=1, confidence=0.95, replicates=10000, seed=None):
+    '''
+    Monte Carlo confidence interval of the jump rate. The false read count of every calibrator tag is resampled
+    from a binomial distribution at its observed rate, and the jump rate is recalculated for every replicate.
+
+    false_counts, tag_counts, scale: as returned by calibrator_counts
+
+    confidence: two sided confidence level of the interval, ex: 0.95
+
+    replicates: number of resampled jump rates
+
+    seed: seed of the random number generator, for reproducible bounds
+
+    Return: lower and upper jump rate bounds
+    '''
+    rng = np.random.default_rng(seed)
+
+    # All replicates of all calibrator tags in one draw: a replicates x tags array
+    draws = rng.binomial(tag_counts, false_counts / tag_counts, size=(replicates, len(tag_counts)))
+    rates = (scale * draws / tag_counts).mean(axis=1)
+
+    # Order statistics, so that each bound is one of the resampled jump rates
+    alpha = (1 - confidence) / 2
+    lower, upper = np.quantile(rates, [alpha, 1 - alpha], method='inverted_cdf')
+
+    return float(lower), float(upper)
+
+
+def false_reads_per_index(demultiplexed_seqs, sample_map, calibrator_tag_pairs, confidence=None, replicates=10000,
+                          seed=None, workers=None):
+    '''
+    Calculate Index Jump Rate based off calibrator Tags, and the number of false reads expected in each sample,
+    without writing anything to disk
+
+    demultiplexed_seqs: path to demultiplexed QIIME2 qza file of data type SampleData[SequencesWithQuality], to
+                        the remultiplexed_counts.tsv read count matrix written by remultiplexing.remultiplex, or the
+                        count matrix (pandas DataFrame) returned by remultiplexing.remultiplex
+
+    sample_map: path to tab delimited QIIME2 sample map file
+
+    calibrator_tag_pairs: pairs of calibrator tags, input as either a tuple, or list of tuples, with
+                          each index being a string ID from the sample map, of any width.
+                          ex: [('01', '11')] or [('01', '11'), ('02','12')]
+
+    confidence: if given, a confidence level such as 0.95. The calibrator counts are resampled (see
+                jump_rate_bounds) and lower and upper bounds of the expected false reads are added for each sample.
+
+    replicates: number of Monte Carlo replicates used for the bounds
+
+    seed: seed of the random number generator used for the bounds
+
+    workers: number of worker processes counting the reads of a demultiplexed qza, defaults to one per CPU
+
+    Return: pandas DataFrame with 'SampleIndex' and 'Expected False Reads' columns, plus 'Expected False Reads Lower'
+            and 'Expected False Reads Upper' columns if a confidence level is given
+            Calculated average jump rate
+            Total read count of the samples in the sample map
+    '''
+
+    # Load in sample_map as pandas df
+    meta_df = pd.read_csv(sample_map, sep='\t')
+    registry = TagRegistry.from_sample_map(meta_df)
+
+    if isinstance(demultiplexed_seqs, pd.DataFrame) or os.fspath(demultiplexed_seqs).endswith('.tsv'):
+        # Read counts taken during remultiplexing, limited to the samples in the sample map as demux would be
+        print('Loading per-sample read counts...')
+        df = read_counts(demultiplexed_seqs)
+        df = df[df['sample ID'].isin(meta_df['#SampleID'])]
 
     else:
-        # Error flagging for Calibrator Tag input: Scripting / Jupyter-Notebook
-        print('Validating Calibrator Tag input... \n . \n . \n .')
-        if not all(isinstance(item, tuple) for item in calibrator_tag_pairs):
-            raise TypeError(
-                'Calibrator Tag Index identifiers are not input in proper format. Should be List of Tuples.')
-
-        # Error flagging for Calibrator Tag input: Command Line input
-        for i, j in calibrator_tag_pairs:
-            if type(i) != str or type(j) != str:
-                raise TypeError('Calibrator Tag Index identifiers are not of proper type. Should be type String.')
-
-            if len(i) != 2 or len(j) != 2:
-                raise ValueError('Calibrator Tag Index identifiers are not of proper length. Should be 2 digit inputs.')
-
-        # Calculating the jump_rate of the sequencing run based off of indicated calibrator tags
-        individual_jump_rates = []
-        for fwd, rev in calibrator_tag_pairs:
-
-            fwd_df          = df[df['Fwd'] == fwd]
-            rev_df          = df[df['Rev'] == rev]
-
-            # Validity check for calibrator tags
-            fwd_True       = fwd_df[fwd_df['True_False'] == 1]
-            assert fwd_True['True_False'].sum() == 1, \
-                                                      f'Specified tag pair {fwd, rev} does not meet requirements for ' \
-                                                      f'usage as calibrator tags. Should only have one true sequence ' \
-                                                      f'specified in sample map.'
-            rev_True       = rev_df[rev_df['True_False'] == 1]
-            assert rev_True['True_False'].sum() == 1, \
-                                                      f'Specified tag pair {fwd, rev} does not meet requirements for ' \
-                                                      f'usage as calibrator tags. Should only have one true sequence ' \
-                                                      f'specified in sample map.'
-
-            print(f'All checks passed! Calculating Index Jump rate based off calibrator tags {fwd, rev}')
-            # Calculations
-            fwd_False       = fwd_df[fwd_df['True_False'] == 0]
-            fwd_jump_rate   = (fwd_False['forward sequence count'].sum())/(fwd_df['forward sequence count'].sum())
-            rev_False       = rev_df[rev_df['True_False'] == 0]
-            rev_jump_rate   = (rev_False['forward sequence count'].sum())/(rev_df['forward sequence count'].sum())
-
-            individual_jump_rates.append(fwd_jump_rate)
-            individual_jump_rates.append(rev_jump_rate)
-
-        # Calculate Average Jump rate for ALL calibrator tags
-        jump_series = pd.Series(individual_jump_rates)
-        jump_rate = jump_series.sum()/len(jump_series)
-
-    # Preparing lists for calculations
-    Indexes       = df['sample ID'].tolist()
-    Seq_counts    = df['forward sequence count'].tolist()
-
-    Fwds          = df['Fwd'].tolist()
-    Fwds          = list(set(Fwds))
-    Fwds.sort()
-
-    Revs          = df['Rev'].tolist()
-    Revs          = list(set(Revs))
-    Revs.sort()
+        # Count the reads of each sample straight out of the demultiplexed qza
+        print('Counting demultiplexed reads per sample... \n . \n . \n .')
+        df = count_demux_reads(demultiplexed_seqs, workers)
+
+    # Read counts and True_False coding as Forward x Reverse arrays, indexed by tag code. Samples of tags that are
+    # not in the sample map are left out, and combinations missing from the demux output are counted as 0.
+    fwd, rev = registry.codes(df['sample ID'])
+    counts = registry.matrix(fwd, rev, df['forward sequence count'].to_numpy())
+    fwd, rev = registry.codes(meta_df['#SampleID'])
+    true_false = registry.matrix(fwd, rev, meta_df['True_False'].to_numpy(), fill=-1)
+
+    false_counts, tag_counts, scale = calibrator_counts(counts, true_false, registry, calibrator_tag_pairs)
+
+    # Average jump rate of ALL calibrator tags (or of the whole pool without calibrators)
+    jump_rate = (scale * false_counts / tag_counts).mean()
+
+    counts = registry.frame(counts)
+    total_read_count = counts.to_numpy().sum()
 
     # Calculating each Indexes expected # of False reads
-    indexes_exp_false = []
-    total_read_count = df['forward sequence count'].sum()
+    exp_false = expected_false_reads(counts, jump_rate)
+    out_df = exp_false.stack().reset_index()
+    out_df.columns = ['Fwd', 'Rev', 'Expected False Reads']
+    out_df.insert(0, 'SampleIndex', out_df['Fwd'] + out_df['Rev'])
+    out_df = out_df[['SampleIndex', 'Expected False Reads']]
+
+    if confidence is not None:
+        lower, upper = jump_rate_bounds(false_counts, tag_counts, scale, confidence, replicates, seed)
+        print(f'{confidence:.0%} confidence interval of the jump rate: {lower} - {upper}')
 
-    count = 0
-    for i in Fwds:
-        temp_df = df[df['Fwd'] == i]
+        # The expected false reads of a sample only grow with the jump rate, so the bounds of every sample are its
+        # expected false reads at the bounds of the jump rate. No replicates x samples array is ever needed.
+        out_df['Expected False Reads Lower'] = expected_false_reads(counts, lower).to_numpy().ravel()
+        out_df['Expected False Reads Upper'] = expected_false_reads(counts, upper).to_numpy().ravel()
 
-        # No. of reads with i FWD index
-        i_seqs = temp_df['forward sequence count'].sum()
-        i_seqs_no_j = i_seqs - Seq_counts[count]
+    return out_df, jump_rate, total_read_count
 
-        for j in Revs:
-            temp_df2 = df[df['Rev'] == j]
-            # No. of reads with j REV index
-            j_seqs = temp_df2['forward sequence count'].sum()
-            j_seqs_no_i = j_seqs-Seq_counts[count]
 
-            # No. of j reads with an expected false i index
-            i_jumps = i_seqs * jump_rate
-            i_to_j = i_jumps * (j_seqs_no_i / total_read_count)
+def calculate(demultiplexed_seqs, sample_map, calibrator_tag_pairs, output_dir='.', work_dir=None, confidence=None,
+              replicates=10000, seed=None):
+    '''
+    Calculate Index Jump Rate based off calibrator Tags
 
-            # No. of i reads with an expected false j index
-            j_jumps = j_seqs * jump_rate
-            j_to_i = j_jumps * (i_seqs_no_j / total_read_count)
+    demultiplexed_seqs: path to demultiplexed QIIME2 qza file of data type SampleData[SequencesWithQuality], or to
+                        the remultiplexed_counts.tsv read count matrix written by remultiplexing.remultiplex
+
+    sample_map: path to tab delimited QIIME2 sample map file
+
+    calibrator_tag_pairs: pairs of calibrator tags, input as either a tuple, or list of tuples, with
+                          each index being a string ID from the sample map, of any width.
+                          ex: [('01', '11')] or [('01', '11'), ('02','12')]
 
-            # Sum for total i-j pair false read count
-            indiv_tag_jump_count = math.ceil((i_to_j + j_to_i))
+    output_dir: directory the outputs are written to, created if missing
 
-            # Append to list for data table output
-            to_add = (Indexes[count], indiv_tag_jump_count)
-            indexes_exp_false.append(to_add)
-            count += 1
+    work_dir: directory for temporary files, the system temporary directory by default
 
-    # Export csv with expected false reads per sample
-    out_df = pd.DataFrame(indexes_exp_false, columns=['SampleIndex', 'Expected False Reads'])
-    print('Exporting recommended per-sample filtering levels to Expected_False_Reads_Per_Index.csv')
-    out_df.to_csv('Expected_False_Reads_Per_Index.csv', index=False)
+    confidence: if given, a confidence level such as 0.95 to add per-sample bounds of the expected false reads
 
-    # Text output to log.txt of some summary statistics
+    replicates: number of Monte Carlo replicates used for the bounds
+
+    seed: seed of the random number generator used for the bounds
+
+    Return: Integer value of maximum number of index jumps (false reads) expected in a single sample
+    Output: Expected_False_Reads_Per_Index.csv file containing number of false reads expected in EACH sample, with
+            their lower and upper bounds if a confidence level is given
+            log.txt file containing summary statistics
+    '''
+    with metrics.stage('calculate', demultiplexed_seqs=demultiplexed_seqs) as stage:
+        out_df, jump_rate, total_read_count = cached_false_reads(demultiplexed_seqs, sample_map, calibrator_tag_pairs,
+                                                                 stage, work_dir, confidence, replicates, seed)
+
+        # Export csv with expected false reads per sample
+        print('Exporting recommended per-sample filtering levels to Expected_False_Reads_Per_Index.csv')
+        os.makedirs(output_dir, exist_ok=True)
+        out_df.to_csv(os.path.join(output_dir, 'Expected_False_Reads_Per_Index.csv'), index=False)
+
+        # Text output to log.txt of some summary statistics
+        max_IJR = write_log(out_df, jump_rate, total_read_count, os.path.join(output_dir, 'log.txt'))
+        record_stats(stage, out_df, jump_rate, total_read_count)
+
+    return max_IJR
+
+
+def record_stats(stage, out_df, jump_rate, total_read_count):
+    '''
+    Adds the read counts and jump rate of an index jump calculation to its metrics stage
+    '''
+    stage.records_in = int(total_read_count)
+    stage.info.update(jump_rate=float(jump_rate), samples=len(out_df),
+                      expected_false_reads=int(out_df['Expected False Reads'].sum()),
+                      max_false_reads=int(out_df['Expected False Reads'].max()))
+    if 'Expected False Reads Upper' in out_df:
+        stage.info.update(expected_false_reads_upper=int(out_df['Expected False Reads Upper'].sum()),
+                          max_false_reads_upper=int(out_df['Expected False Reads Upper'].max()))
+
+
+def cached_false_reads(demultiplexed_seqs, sample_map, calibrator_tag_pairs, stage=None, work_dir=None,
+                       confidence=None, replicates=10000, seed=None, workers=None):
+    '''
+    false_reads_per_index, served from the stage cache when the demultiplexed sequences, sample map and calibrator
+    tags are unchanged since an earlier run
+
+    stage: metrics stage that the cache hit or miss is recorded on
+
+    work_dir: directory for temporary files, the system temporary directory by default
+
+    workers: number of worker processes counting the reads of a demultiplexed qza, defaults to one per CPU
+
+    Return: same as false_reads_per_index
+    '''
+    parameters = {'calibrator_tag_pairs': calibrator_tag_pairs}
+    if confidence is not None:
+        parameters.update(confidence=confidence, replicates=replicates, seed=seed)
+    entry = cache.key('calculate', [demultiplexed_seqs, sample_map], parameters)
+    with tempfile.TemporaryDirectory(prefix='metaplex_', dir=work_dir) as temp:
+        values = cache.restore(entry, ['Expected_False_Reads_Per_Index.csv'], dest=temp)
+        if values is not None:
+            print('Expected false reads restored from cache')
+            out_df = pd.read_csv(os.path.join(temp, 'Expected_False_Reads_Per_Index.csv'))
+            jump_rate, total_read_count = values['jump_rate'], values['total_read_count']
+        else:
+            out_df, jump_rate, total_read_count = false_reads_per_index(demultiplexed_seqs, sample_map,
+                                                                        calibrator_tag_pairs, confidence,
+                                                                        replicates, seed, workers)
+            if entry is not None:
+                out_df.to_csv(os.path.join(temp, 'Expected_False_Reads_Per_Index.csv'), index=False)
+                cache.store(entry, ['Expected_False_Reads_Per_Index.csv'],
+                            {'jump_rate': jump_rate, 'total_read_count': total_read_count}, src=temp)
+
+    if stage is not None and entry is not None:
+        stage.info['cache'] = 'miss' if values is None else 'hit'
+
+    return out_df, jump_rate, total_read_count
+
+
+def write_log(out_df, jump_rate, total_read_count, path):
+    '''
+    Writes summary statistics of the expected false reads to a text file
+
+    Return: Integer value of maximum number of index jumps (false reads) expected in a single sample
+    '''
     max_IJR = out_df['Expected False Reads'].max()
     false_read_count = out_df['Expected False Reads'].sum()
 
-    with open('log.txt', 'w') as out:
+    with open(path, 'w') as out:
         print(f'Calculated Average jump rate: {jump_rate}', file=out)
         print(f'Total number of false reads: {false_read_count} / {total_read_count}', file=out)
         print(f'Total percent of false reads: {(false_read_count/total_read_count)*100:.3f}%', file=out)
         print(f'Maximum number of false reads expected in a single sample: {max_IJR}', file=out)
+        if 'Expected False Reads Upper' in out_df:
+            print(f'Upper bound of the total number of false reads: {out_df["Expected False Reads Upper"].sum()}',
+                  file=out)
+            print(f'Upper bound of the false reads in a single sample: {out_df["Expected False Reads Upper"].max()}',
+                  file=out)
 
     return max_IJR
 
 
 def main():
-    if len(sys.argv) < 4:
-        calculate(sys.argv[1], sys.argv[2], calibrator_tag_pairs=None)
-
-    else:
-        c_tags_list = []
-        for i in range(3, len(sys.argv)):
-            c_tag_pair = (tuple(sys.argv[i].split(',')))
-            c_tags_list.append(c_tag_pair)
-            calculate(sys.argv[1], sys.argv[2], c_tags_list)
+    cli.standalone('calculate')
 
 
 if __name__ == '__main__':
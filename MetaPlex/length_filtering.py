@@ -1,17 +1,19 @@
 import os
-import sys
-import pathlib
-import shutil
-import tempfile
-
+from collections import namedtuple
+import numpy as np
 import pandas as pd
-from Bio import SeqIO
-from qiime2 import Artifact, Metadata
-from qiime2.plugins.feature_table.methods import filter_features, filter_seqs
+import biom
+
+from . import artifacts, cache, cli, metrics
+
+
+# Same shape as the Results that qiime2's filter_features / filter_seqs return
+FilterTableResults = namedtuple('FilterTableResults', ['filtered_table'])
+FilterSeqsResults = namedtuple('FilterSeqsResults', ['filtered_data'])
 
 
 # Length filter of rep_seqs
-def length_filter(feature_table, representative_sequences, length_to_filter):
+def length_filter(feature_table, representative_sequences, length_to_filter, output_dir='.'):
     '''
     Length filter of QIIME2 feature table and representative sequences
 
@@ -21,78 +23,140 @@ def length_filter(feature_table, representative_sequences, length_to_filter):
 
     length_to_filter: An integer threshold for sequence length. All sequences shorter than specified
                       length will be removed.
+                      A list of integers sweeps every threshold in a single pass over the inputs.
+
+    output_dir: directory the outputs are written to, created if missing
 
     Return: Frequency filtered QIIME2 feature table of type FeatureTable[Frequency]
             Frequency filtered QIIME2 feature table of type FeatureData[Sequence]
+            For a list of thresholds, a dictionary of {threshold: (table, seqs)}
 
-    Output: 'length_filt_table.qza' QIIME2 artifact of type FeatureTable[Frequency]
-            'length_filt_seqs.qza' QIIME2 artifact of type FeatureData[Sequence]
+    Output: 'length_filt_table_{length}.qza' QIIME2 artifact of type FeatureTable[Frequency]
+            'length_filt_seqs_{length}.qza' QIIME2 artifact of type FeatureData[Sequence]
+            For a list of thresholds, one pair of artifacts per threshold and 'length_filter_summary.csv' with the
+            number of features, reads and samples retained at each threshold
     '''
 
-    # Pull fasta from rep_seqs to use as metadata
-    def extract_fasta(file, dest):
-        with tempfile.TemporaryDirectory() as temp:
-            file.export_data(temp)
-            temp_pathlib = pathlib.Path(temp)
-            for item in temp_pathlib.iterdir():
-                if item.suffix == '.fasta':
-                    shutil.copy(item, dest)
-
-    # QIIME Artifact Loading and error checking
-    try:
-        qza_table = Artifact.load(feature_table)
-    except:
-        print('Could not import feature table, check to ensure input file is appropriate format')
-        exit()
-    try:
-        rep_seqs = Artifact.load(representative_sequences)
-    except:
-        print('Could not import sequences, check to ensure input file is appropriate format')
-        exit()
-
-    print(f'QIIME Artifacts loaded! Filtering reads at a length of {length_to_filter}bp')
-
-    os.makedirs('fastas', exist_ok=True)
-    extract_fasta(rep_seqs, 'fastas')
-
-    # Parse fasta to get IDs and lengths, then send to df and filter IDs by length
-    with open('fastas/dna-sequences.fasta') as fasta_file:
-        featureids = []
-        lengths = []
-        for seq_record in SeqIO.parse(fasta_file, 'fasta'):
-            featureids.append(seq_record.id)
-            lengths.append(len(seq_record.seq))
-
-    rep_seqs_meta = pd.DataFrame({"FeatureID": featureids, "Length": lengths})
-
-    features_to_exclude = rep_seqs_meta[rep_seqs_meta['Length'] < length_to_filter]
-
-    features_to_exclude['FeatureID'].to_csv('Features-to-exclude.csv', index=False)
-
-    exclude = Metadata.load("Features-to-exclude.csv")
-
-    shutil.rmtree('fastas')
+    with metrics.stage('length_filter', feature_table=feature_table,
+                       representative_sequences=representative_sequences) as stage:
+        sweep = isinstance(length_to_filter, (list, tuple))
+        thresholds = list(length_to_filter) if sweep else [length_to_filter]
+
+        # Reruns on the same table, sequences and thresholds reuse the stored outputs
+        outputs = [f'length_filt_{kind}_{threshold}.qza' for threshold in thresholds for kind in ('table', 'seqs')]
+        if sweep:
+            outputs.append('length_filter_summary.csv')
+        entry = cache.key('length_filter', [feature_table, representative_sequences], {'thresholds': thresholds})
+        os.makedirs(output_dir, exist_ok=True)
+        if cache.restore(entry, outputs, dest=output_dir) is not None:
+            print('Length filtered artifacts restored from cache')
+            stage.info['cache'] = 'hit'
+            results = {t: (FilterTableResults(artifacts.LazyArtifact(os.path.join(output_dir,
+                                                                                  f'length_filt_table_{t}.qza'))),
+                           FilterSeqsResults(artifacts.LazyArtifact(os.path.join(output_dir,
+                                                                                 f'length_filt_seqs_{t}.qza'))))
+                       for t in thresholds}
+            return results if sweep else results[length_to_filter]
+
+        # Artifact loading and error checking, read straight out of the qza archives
+        try:
+            working_table = artifacts.read_biom(feature_table)
+        except:
+            print('Could not import feature table, check to ensure input file is appropriate format')
+            exit()
+        try:
+            records = list(artifacts.iter_fasta(representative_sequences))
+        except:
+            print('Could not import sequences, check to ensure input file is appropriate format')
+            exit()
+
+        print(f'QIIME Artifacts loaded! Filtering reads at a length of {", ".join(map(str, thresholds))}bp')
+
+        inputs = {'table': feature_table, 'data': representative_sequences}
+        results = {}
+        summary = []
+        for threshold, table_filt, seqs_filt, stats in filter_lengths(working_table, records, thresholds):
+            parameters = {'length_to_filter': threshold}
+            rep_seqs_filt = artifacts.write_qza(os.path.join(output_dir, f'length_filt_seqs_{threshold}.qza'),
+                                                'FeatureData[Sequence]', artifacts.fasta_bytes(seqs_filt),
+                                                'length_filter', parameters, inputs, output_name='filtered_data')
+            table_filt = artifacts.write_qza(os.path.join(output_dir, f'length_filt_table_{threshold}.qza'),
+                                             'FeatureTable[Frequency]', artifacts.table_bytes(table_filt),
+                                             'length_filter', parameters, inputs)
+            results[threshold] = (FilterTableResults(table_filt), FilterSeqsResults(rep_seqs_filt))
+            summary.append(stats)
+
+        stage.records_in = int(working_table.sum())
+        stage.info['thresholds'] = summary
+        if sweep:
+            print('Exporting per-threshold summary to length_filter_summary.csv')
+            pd.DataFrame(summary).to_csv(os.path.join(output_dir, 'length_filter_summary.csv'), index=False)
+        else:
+            stage.records_out = summary[0]['Retained Reads']
+
+        if entry is not None:
+            cache.store(entry, outputs, src=output_dir)
+            stage.info['cache'] = 'miss'
+
+        return results if sweep else results[length_to_filter]
+
+
+def filter_lengths(table, records, thresholds):
+    '''
+    Length filters an in-memory feature table and its representative sequences at one or more thresholds. Features
+    are sorted by length once, so the features retained at any threshold are a suffix of that order.
 
-    # Filter rep-seqs based on seqs_to_exclude
-    rep_seqs_filt = filter_seqs(rep_seqs,
-                               metadata = exclude,
-                               exclude_ids = True)
+    table     : biom.Table of feature frequencies (features x samples)
 
-    # Filter table based on seqs_to_exclude
-    table_filt = filter_features(qza_table,
-                                metadata = exclude,
-                                exclude_ids = True)
+    records   : list of (ID, sequence) tuples, as produced by artifacts.iter_fasta
 
-    rep_seqs_filt.filtered_data.save(f'length_filt_seqs_{length_to_filter}.qza')
-    table_filt.filtered_table.save(f'length_filt_table_{length_to_filter}.qza')
+    thresholds: list of integer length thresholds. Sequences shorter than a threshold are removed.
 
-    return table_filt, rep_seqs_filt
+    Return: generator of (threshold, filtered biom.Table, filtered (ID, sequence) list, summary dictionary) tuples
+    '''
+    # Lengths of every sequence, and of every feature in the table. Features without a sequence are never filtered.
+    seq_lengths = np.array([len(seq) for seq_id, seq in records])
+    length_by_id = dict(zip((seq_id for seq_id, seq in records), seq_lengths))
+    feature_ids = table.ids(axis='observation')
+    sample_ids = table.ids()
+    feature_lengths = np.array([length_by_id.get(i, np.inf) for i in feature_ids], dtype=float)
+
+    # The summary for each threshold is a binary search into cumulative sums over the sorted features
+    order = np.argsort(feature_lengths, kind='stable')
+    sorted_lengths = feature_lengths[order]
+    feature_reads = np.asarray(table.sum(axis='observation'), dtype=float)[order]
+    reads_from = np.concatenate([np.cumsum(feature_reads[::-1])[::-1], [0]])
+    total_reads = reads_from[0]
+
+    matrix = table.matrix_data.tocsr()
+    for threshold in thresholds:
+        start = np.searchsorted(sorted_lengths, threshold, side='left')
+        keep = np.zeros(len(feature_ids), dtype=bool)
+        keep[order[start:]] = True
+
+        # Filter table based on the retained features, dropping samples left empty as filter_features does
+        sub = matrix[keep]
+        non_empty = np.asarray(sub.sum(axis=0)).ravel() > 0
+        table_filt = biom.Table(sub[:, non_empty], feature_ids[keep], sample_ids[non_empty],
+                                observation_metadata=None, sample_metadata=None)
+
+        # Filter rep-seqs in their original order
+        seqs_filt = [record for record, length in zip(records, seq_lengths) if length >= threshold]
+
+        retained_reads = float(reads_from[start])
+        stats = {'Length Threshold': threshold,
+                 'Retained Features': int(len(feature_ids) - start),
+                 'Retained Sequences': len(seqs_filt),
+                 'Retained Reads': int(retained_reads),
+                 'Percent Reads Retained': round(retained_reads / total_reads * 100, 3) if total_reads else 0.0,
+                 'Retained Samples': int(non_empty.sum())}
+
+        yield threshold, table_filt, seqs_filt, stats
 
 
 def main():
-    length_filter(sys.argv[1], sys.argv[2], int(sys.argv[3]))
+    cli.standalone('length-filter')
 
 
 if __name__ == '__main__':
     main()
-
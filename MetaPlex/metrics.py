@@ -0,0 +1,150 @@
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import resource
+import time
+import uuid
+
+
+# Where stage records are appended, and where profiles are dumped. Set from the environment so that every entry point
+# can be instrumented without new command line arguments, or from Python with configure().
+_config = {'report': os.environ.get('METAPLEX_METRICS'),
+           'profile': os.environ.get('METAPLEX_PROFILE'),
+           'run': os.environ.get('METAPLEX_RUN_ID') or uuid.uuid4().hex}
+
+
+def configure(report=None, profile=None, run=None):
+    '''
+    Turns on metrics for the stages run by this process
+
+    report  : path to a JSON lines file that every stage appends one record to
+
+    profile : directory that a cProfile dump (.prof) of every stage is written to
+
+    run     : identifier shared by the records of one run, a random one by default
+    '''
+    _config['report'] = report
+    _config['profile'] = profile
+    if run is not None:
+        _config['run'] = run
+
+
+class Stage:
+    '''
+    Measurements of one stage. Stages fill in records_in / records_out (and discarded, if it is not simply the
+    difference) and may add anything else worth reporting to info.
+    '''
+
+    def __init__(self, name, info):
+        self.name = name
+        self.records_in = None
+        self.records_out = None
+        self.discarded = None
+        self.info = info
+
+    def record(self, start, wall, cpu, status):
+        discarded = self.discarded
+        if discarded is None and self.records_in is not None and self.records_out is not None:
+            discarded = self.records_in - self.records_out
+        record = {'run': _config['run'],
+                  'stage': self.name,
+                  'status': status,
+                  'start': start,
+                  'wall_seconds': round(wall, 6),
+                  'cpu_seconds': round(cpu, 6),
+                  'peak_rss_mb': round(peak_rss() / (1 << 20), 3),
+                  'records_in': self.records_in,
+                  'records_out': self.records_out,
+                  'records_discarded': discarded}
+        record.update(self.info)
+
+        return record
+
+
+@contextlib.contextmanager
+def stage(name, **info):
+    '''
+    Measures a stage: wall time, CPU time (including waited-on worker processes), the peak memory of the process, and
+    the records the stage counted. A record is appended to the metrics report, if one is configured, and the stage
+    is run under cProfile if profiling is on.
+
+    name : name of the stage, e.g. 'remultiplex'
+
+    info : extra fields for the record, e.g. input file names
+
+    Return : context manager yielding the Stage
+    '''
+    current = Stage(name, info)
+    profiler = cProfile.Profile() if _config['profile'] else None
+    start = datetime.datetime.now().astimezone().isoformat()
+    wall = time.perf_counter()
+    cpu = _cpu_time()
+    status = 'error'
+    if profiler:
+        profiler.enable()
+    try:
+        yield current
+        status = 'ok'
+    finally:
+        if profiler:
+            profiler.disable()
+            os.makedirs(_config['profile'], exist_ok=True)
+            profiler.dump_stats(os.path.join(_config['profile'], f'{name}-{_config["run"]}-{os.getpid()}.prof'))
+        if _config['report']:
+            record = current.record(start, time.perf_counter() - wall, _cpu_time() - cpu, status)
+            write_record(record, _config['report'])
+
+
+def write_record(record, path):
+    '''
+    Appends one record to a JSON lines file. Each record is a single write, so concurrent runs can share a report.
+    '''
+    line = json.dumps(record, default=json_default) + '\n'
+    with open(path, 'a') as out:
+        out.write(line)
+
+
+def read_report(path):
+    '''
+    Return : list of the records in a JSON lines metrics report
+    '''
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def json_default(value):
+    '''
+    JSON encoding of the values json can't encode, shared by the metrics records and the cache so that both write
+    numpy scalars and paths the same way
+    '''
+    # numpy scalars and the like
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def _cpu_time():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def peak_rss():
+    '''
+    Peak resident memory in bytes of this process, or of any worker process it waited on if that was larger
+    '''
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if os.uname().sysname == 'Darwin' else 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    try:
+        # ru_maxrss survives exec, so a spawned process would report the peak of the process that launched it. VmHWM
+        # starts over with the new address space.
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return max(int(line.split()[1]) * 1024, children)
+    except OSError:
+        pass
+
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale, children)
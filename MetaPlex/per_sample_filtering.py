@@ -1,90 +1,209 @@
-import sys
+import os
 import biom
+import numpy as np
 import pandas as pd
-from qiime2 import Artifact
+from scipy import sparse
 
+from . import artifacts, cache, cli, metrics
+from .tags import TagRegistry
 
-def per_sample_filter(feature_table, filtering_integer):
+
+def filter_table(table, thresholds, inclusive=False):
+    '''
+    Zeroes out low frequency features of each sample directly on the sparse data of a biom table, without ever
+    densifying it
+
+    table     : biom.Table of feature frequencies (features x samples)
+
+    thresholds: a single number applied to every sample, a pandas Series of {sample ID: threshold}, or a sparse
+                matrix of a threshold for every stored value of the table, as returned by feature_false_reads.
+                Samples missing from the Series are not filtered.
+
+    inclusive : if True, values equal to the threshold are filtered out too
+
+    Return: filtered biom.Table
+    '''
+    sample_ids = table.ids(axis='sample')
+    matrix = table.matrix_data.tocsc(copy=True)
+    if sparse.issparse(thresholds):
+        # Laid out as the CSC data of the table, so its data array already lines up with every stored value
+        thresholds = thresholds.tocsc()
+        if (thresholds.shape != matrix.shape or not np.array_equal(thresholds.indptr, matrix.indptr)
+                or not np.array_equal(thresholds.indices, matrix.indices)):
+            raise ValueError('Sparse thresholds must have a value for every stored value of the table, laid out as '
+                             'its CSC data, as returned by feature_false_reads')
+        limits = thresholds.data
+    else:
+        if isinstance(thresholds, pd.Series):
+            per_sample = thresholds.reindex(sample_ids).fillna(-np.inf).to_numpy(dtype=float)
+        else:
+            per_sample = np.full(len(sample_ids), float(thresholds))
+
+        # CSC layout keeps each sample's values in one contiguous slice of the data array, so expanding the
+        # per-sample thresholds over the column pointers lines them up with every stored value
+        limits = np.repeat(per_sample, np.diff(matrix.indptr))
+
+    if inclusive:
+        matrix.data[matrix.data <= limits] = 0
+    else:
+        matrix.data[matrix.data < limits] = 0
+    matrix.eliminate_zeros()
+
+    return biom.Table(matrix, table.ids(axis='observation'), sample_ids,
+                      observation_metadata=table.metadata(axis='observation'),
+                      sample_metadata=table.metadata(axis='sample'))
+
+
+def feature_false_reads(table, jump_rate):
+    '''
+    Expected number of false (index jumped) reads of every feature in every sample. Reads of a feature jump into a
+    sample from the samples sharing its Forward tag, and from those sharing its Reverse tag, in proportion to the
+    abundance of the feature there, as expected_false_reads in index_jump does for whole samples. Summed over every
+    feature, present in the sample or not, this is that sample's expected false reads before rounding.
+
+    table    : biom.Table of feature frequencies (features x samples), with merged sample IDs, ex: F01R11
+
+    jump_rate: index jump rate of the sequencing run
+
+    Return: sparse matrix of the expected false reads at every stored value of the table, rounded up to whole reads,
+            laid out as the CSC data of the table. Values not stored in the table are never needed, so the
+            features x samples matrix is never densified. Samples without a tag pair are given 0.
     '''
-    Filters reads out of a QIIME2 feature table according to a minimum read count requirement *per sample*
+    matrix = table.matrix_data.tocsc()
+    n_features, n_samples = matrix.shape
+    registry = TagRegistry.from_sample_ids(table.ids(axis='sample'))
+    fwd, rev = registry.codes(table.ids(axis='sample'))
+    known = np.flatnonzero((fwd >= 0) & (rev >= 0))
+
+    # Sample x tag indicator matrices, grouping the samples by Forward and by Reverse tag
+    ones = np.ones(len(known))
+    by_fwd = sparse.csr_matrix((ones, (known, fwd[known])), shape=(n_samples, registry.shape[0]))
+    by_rev = sparse.csr_matrix((ones, (known, rev[known])), shape=(n_samples, registry.shape[1]))
+
+    # Reads of every sample, of every tag, and of every feature with every tag
+    sample_seqs = np.asarray(matrix.sum(axis=0), dtype=float).ravel()
+    i_seqs = by_fwd.T @ sample_seqs
+    j_seqs = by_rev.T @ sample_seqs
+    total = sample_seqs[known].sum()
+    feature_i_seqs = (matrix @ by_fwd).tocsr()
+    feature_j_seqs = (matrix @ by_rev).tocsr()
+
+    # Feature and sample of every stored value
+    features = matrix.indices
+    samples = np.repeat(np.arange(n_samples), np.diff(matrix.indptr))
+    tagged = (fwd[samples] >= 0) & (rev[samples] >= 0)
+    features, samples = features[tagged], samples[tagged]
+    i, j = fwd[samples], rev[samples]
+    n = sample_seqs[samples]
+
+    # Reads of the feature with tag i with an expected false j index, and with tag j with an expected false i index
+    i_to_j = (np.asarray(feature_i_seqs[features, i]).ravel() * jump_rate) * ((j_seqs[j] - n) / total)
+    j_to_i = (np.asarray(feature_j_seqs[features, j]).ravel() * jump_rate) * ((i_seqs[i] - n) / total)
+
+    data = np.zeros(matrix.nnz)
+    data[tagged] = np.ceil(i_to_j + j_to_i)
+
+    return sparse.csc_matrix((data, matrix.indices, matrix.indptr), shape=matrix.shape)
+
+
+def per_sample_filter(feature_table, filtering_integer=None, output_dir='.', upper_bound=False, jump_rate=None):
+    '''
+    Filters reads out of a QIIME2 feature table according to a minimum read count requirement *per sample*, or
+    *per feature in each sample* given the jump rate
 
     feature_table    : path to QIIME2 feature table
 
     filtering_integer: Either an integer for even filtering across samples, or path to the
-                       Expected_False_Reads_Per_Index.csv output by index_jump.py
+                       Expected_False_Reads_Per_Index.csv output by index_jump.py. Not used with jump_rate.
+
+    output_dir       : directory the output is written to, created if missing
+
+    upper_bound      : if True, each sample is filtered at the upper bound of its expected false reads, which
+                       index_jump.calculate writes when given a confidence level
+
+    jump_rate        : if given, the index jump rate of the run (see the log.txt of index_jump.calculate). Each feature
+                       is then filtered out of each sample at its own expected false reads (see feature_false_reads),
+                       so that rare features of samples sharing a tag with a very abundant sample are not lost.
 
     Return: Frequency filtered QIIME2 feature table of type FeatureTable[Frequency]
 
     Output: 'freq_filt_table.qza' QIIME2 artifact of type FeatureTable[Frequency]
     '''
 
-    # Importing from a biom table
-    try:
-        working_table = biom.load_table(feature_table)
-    except:
-        print('Could not import from biom table, trying from qza...')
+    with metrics.stage('per_sample_filter', feature_table=feature_table,
+                       filtering_integer=filtering_integer) as stage:
+        if (filtering_integer is None) == (jump_rate is None):
+            raise ValueError('Give either a filtering integer / Expected_False_Reads_Per_Index.csv or a jump rate')
+
+        # Reruns on the same table and thresholds reuse the stored output
+        if jump_rate is not None:
+            entry = cache.key('per_sample_filter', [feature_table], {'jump_rate': jump_rate})
+        elif type(filtering_integer) == int:
+            entry = cache.key('per_sample_filter', [feature_table], {'filtering_integer': filtering_integer})
+        else:
+            entry = cache.key('per_sample_filter', [feature_table, filtering_integer], {'upper_bound': upper_bound})
+        os.makedirs(output_dir, exist_ok=True)
+        if cache.restore(entry, ['freq_filt_table.qza'], dest=output_dir) is not None:
+            print('Filtered table restored from cache')
+            stage.info['cache'] = 'hit'
+            return artifacts.LazyArtifact(os.path.join(output_dir, 'freq_filt_table.qza'))
+
+        # Importing from a biom table, or straight out of a qza
         try:
-            # Importing from imported qza
-            qza_table = Artifact.load(feature_table)
-            working_table = qza_table.view(biom.Table)
+            working_table = artifacts.read_biom(feature_table)
         except:
-            print('Could not import from qiime artifact, check to ensure input file is appropriate format')
+            print('Could not import from biom table or qiime artifact, '
+                  'check to ensure input file is appropriate format')
             exit()
 
-    # Convert table to df
-    biom_df = working_table.to_dataframe()
-
-    # Filtering if integer is specified
-    if type(filtering_integer) == int:
-
-        print('File loaded! Filtering at '+str(filtering_integer)+' occurrences per feature')
+        # Filtering every feature of every sample at its own expected false reads
+        if jump_rate is not None:
+            print(f'File loaded! Filtering each feature at its expected false reads for a jump rate of {jump_rate}')
+            freq_filt = filter_table(working_table, feature_false_reads(working_table, jump_rate), inclusive=True)
 
-        # Filter out any feature from a sample if it has less than X reads,
-        biom_df = biom_df._get_numeric_data()
-        biom_dense = biom_df.sparse.to_dense()
+        # Filtering if integer is specified
+        elif type(filtering_integer) == int:
 
-        biom_dense[biom_dense < filtering_integer] = 0
+            print('File loaded! Filtering at '+str(filtering_integer)+' occurrences per feature')
 
-        # Translate the filtered table back into a qza
-        biom_dense = biom_dense.transpose()
-        freq_filt_table = Artifact.import_data("FeatureTable[Frequency]", biom_dense)
+            # Filter out any feature from a sample if it has less than X reads
+            freq_filt = filter_table(working_table, filtering_integer, inclusive=False)
 
-        # Export the new table as a qza for further use in Qiime2
-        freq_filt_table.save('freq_filt_table.qza')
-
-        return freq_filt_table
-
-    # Filtering based on per-sample CSV
-    else:
-        print(f'File loaded! Filtering according to per-sample values specified in {filtering_integer}')
-        per_sample_table = pd.read_csv(filtering_integer, index_col='SampleIndex')
-        per_sample_table_trans = per_sample_table.transpose()
+        # Filtering based on per-sample CSV
+        else:
+            print(f'File loaded! Filtering according to per-sample values specified in {filtering_integer}')
+            per_sample_table = pd.read_csv(filtering_integer, index_col='SampleIndex')
 
-        biom_df = biom_df._get_numeric_data()
-        biom_dense = biom_df.sparse.to_dense()
-
-        for k, v in per_sample_table_trans.iteritems():
-            for column, values in biom_dense.iteritems():
-                if k == column:
-                    working_values = values.tolist()
-                    edited_values = [0 if x <= int(v) else x for x in working_values]
-                    biom_dense[column] = edited_values
-
-        # Translate the filtered table back into a qza
-        biom_dense = biom_dense.transpose()
-        freq_filt_table = Artifact.import_data("FeatureTable[Frequency]", biom_dense)
+            # Filter out any feature from a sample if it has X or fewer reads
+            # Samples missing from the csv are kept as is
+            thresholds = per_sample_table['Expected False Reads Upper' if upper_bound else 'Expected False Reads']
+            freq_filt = filter_table(working_table, thresholds, inclusive=True)
 
         # Export the new table as a qza for further use in Qiime2
-        freq_filt_table.save('freq_filt_table.qza')
-
-        return freq_filt_table
+        if jump_rate is not None:
+            parameters = {'jump_rate': jump_rate}
+        elif type(filtering_integer) == int:
+            parameters = {'filtering_integer': filtering_integer}
+        else:
+            parameters = {'filtering_integer': filtering_integer, 'upper_bound': upper_bound}
+        freq_filt_table = artifacts.write_qza(os.path.join(output_dir, 'freq_filt_table.qza'),
+                                              'FeatureTable[Frequency]', artifacts.table_bytes(freq_filt),
+                                              'per_sample_filter',
+                                              parameters=parameters,
+                                              inputs={'feature_table': feature_table})
+
+        stage.records_in = int(working_table.sum())
+        stage.records_out = int(freq_filt.sum())
+        stage.info['features'] = int(working_table.shape[0])
+        if entry is not None:
+            cache.store(entry, ['freq_filt_table.qza'], src=output_dir)
+            stage.info['cache'] = 'miss'
+
+    return freq_filt_table
 
 
 def main():
-    if sys.argv[2].endswith('.csv'):
-        per_sample_filter(sys.argv[1], sys.argv[2])
-    else:
-        per_sample_filter(sys.argv[1], int(sys.argv[2]))
+    cli.standalone('per-sample-filter')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,165 @@
+import os
+from collections import namedtuple
+
+from . import artifacts, cli, metrics
+from .index_jump import cached_false_reads, record_stats, write_log
+from .length_filtering import filter_lengths
+from .per_sample_filtering import feature_false_reads, filter_table
+
+
+# Files that run() can write, keyed by the names accepted in its outputs argument
+OUTPUT_FILES = {'false_reads': 'Expected_False_Reads_Per_Index.csv',
+                'log': 'log.txt',
+                'freq_filt_table': 'freq_filt_table.qza',
+                'table': 'length_filt_table_{length}.qza',
+                'seqs': 'length_filt_seqs_{length}.qza'}
+
+# Names of the final table and sequences when length filtering is skipped
+UNFILTERED_FILES = {'table': 'filtered_table.qza', 'seqs': 'filtered_seqs.qza'}
+
+PipelineResults = namedtuple('PipelineResults', ['false_reads', 'jump_rate', 'max_false_reads', 'table',
+                                                 'sequences', 'summary'])
+
+
+def run(demultiplexed_seqs, sample_map, feature_table, representative_sequences, calibrator_tag_pairs=None,
+        filtering_integer=None, length_to_filter=None, outputs=('table', 'seqs'), output_dir='.', work_dir=None,
+        confidence=None, replicates=10000, seed=None, per_feature=False):
+    '''
+    Runs index jump calculation, per-sample filtering and length filtering back to back. The expected false reads,
+    the feature table and the representative sequences are handed from stage to stage in memory, and only the
+    requested outputs are written to disk.
+
+    demultiplexed_seqs      : path to demultiplexed QIIME2 qza file of data type SampleData[SequencesWithQuality], to
+                              remultiplexed_counts.tsv, or the count matrix returned by remultiplexing.remultiplex
+
+    sample_map              : path to tab delimited QIIME2 sample map file
+
+    feature_table           : path to QIIME2 qza file of data type FeatureTable[Frequency]
+
+    representative_sequences: path to QIIME2 qza file of data type FeatureData[Sequence]
+
+    calibrator_tag_pairs    : pairs of calibrator tags as in index_jump.calculate, ex: [('01', '11')]
+
+    filtering_integer       : integer for even filtering across samples. If None, each sample is filtered at its own
+                              number of expected false reads.
+
+    length_to_filter        : integer threshold for sequence length, or None to skip length filtering
+
+    outputs                 : names of the files to write, any of 'false_reads', 'log', 'freq_filt_table', 'table'
+                              and 'seqs'. Without length filtering, 'table' and 'seqs' are written as
+                              filtered_table.qza and filtered_seqs.qza.
+
+    output_dir              : directory the outputs are written to, created if missing
+
+    work_dir                : directory for temporary files, the system temporary directory by default
+
+    confidence              : if given, a confidence level such as 0.95. Samples are then filtered at the upper bound
+                              of their expected false reads (see index_jump.jump_rate_bounds) for a conservative
+                              threshold.
+
+    replicates              : number of Monte Carlo replicates used for the bounds
+
+    seed                    : seed of the random number generator used for the bounds
+
+    per_feature             : if True and filtering_integer is None, each feature is filtered out of each sample at
+                              its own expected false reads at the jump rate (see
+                              per_sample_filtering.feature_false_reads) rather than at those of the whole sample.
+                              The jump rate itself is used, not its upper bound.
+
+    Return: PipelineResults with the expected false reads DataFrame, jump rate, maximum expected false reads, the
+            filtered biom.Table, the filtered (ID, sequence) list and the length filter summary dictionary
+    Output: the requested files, named as by the individual MetaPlex functions
+    '''
+    unknown = set(outputs) - set(OUTPUT_FILES)
+    if unknown:
+        raise ValueError(f'Unknown pipeline outputs {sorted(unknown)}, choose from {list(OUTPUT_FILES)}')
+    if outputs:
+        os.makedirs(output_dir, exist_ok=True)
+
+    # Index jump calculation
+    with metrics.stage('calculate', demultiplexed_seqs=demultiplexed_seqs) as stage:
+        false_reads, jump_rate, total_read_count = cached_false_reads(demultiplexed_seqs, sample_map,
+                                                                      calibrator_tag_pairs, stage, work_dir,
+                                                                      confidence, replicates, seed)
+        max_false_reads = false_reads['Expected False Reads'].max()
+        if 'false_reads' in outputs:
+            false_reads.to_csv(os.path.join(output_dir, OUTPUT_FILES['false_reads']), index=False)
+        if 'log' in outputs:
+            write_log(false_reads, jump_rate, total_read_count, os.path.join(output_dir, OUTPUT_FILES['log']))
+        record_stats(stage, false_reads, jump_rate, total_read_count)
+
+    # Per-sample filtering
+    with metrics.stage('per_sample_filter', feature_table=feature_table,
+                       filtering_integer=filtering_integer) as stage:
+        try:
+            table = artifacts.read_biom(feature_table)
+        except:
+            print('Could not import from biom table or qiime artifact, '
+                  'check to ensure input file is appropriate format')
+            exit()
+        stage.records_in = int(table.sum())
+
+        if filtering_integer is None and per_feature:
+            print('Filtering each feature at its expected number of false reads')
+            table = filter_table(table, feature_false_reads(table, jump_rate), inclusive=True)
+        elif filtering_integer is None:
+            if confidence is None:
+                column = 'Expected False Reads'
+                print('Filtering each sample at its expected number of false reads')
+            else:
+                column = 'Expected False Reads Upper'
+                print('Filtering each sample at the upper bound of its expected number of false reads')
+            table = filter_table(table, false_reads.set_index('SampleIndex')[column], inclusive=True)
+        else:
+            print(f'Filtering at {filtering_integer} occurrences per feature')
+            table = filter_table(table, filtering_integer, inclusive=False)
+
+        if filtering_integer is None and per_feature:
+            parameters = {'jump_rate': jump_rate}
+        else:
+            parameters = {'filtering_integer': 'Expected_False_Reads_Per_Index.csv' if filtering_integer is None
+                          else filtering_integer}
+        if 'freq_filt_table' in outputs:
+            artifacts.write_qza(os.path.join(output_dir, OUTPUT_FILES['freq_filt_table']), 'FeatureTable[Frequency]',
+                                artifacts.table_bytes(table), 'per_sample_filter', parameters=parameters,
+                                inputs={'feature_table': feature_table})
+        stage.records_out = int(table.sum())
+
+    # Length filtering
+    with metrics.stage('length_filter', feature_table=feature_table,
+                       representative_sequences=representative_sequences) as stage:
+        try:
+            sequences = list(artifacts.iter_fasta(representative_sequences))
+        except:
+            print('Could not import sequences, check to ensure input file is appropriate format')
+            exit()
+        stage.records_in = int(table.sum())
+
+        summary = None
+        if length_to_filter is not None:
+            print(f'Filtering reads at a length of {length_to_filter}bp')
+            threshold, table, sequences, summary = next(filter_lengths(table, sequences, [length_to_filter]))
+            stage.info['thresholds'] = [summary]
+
+        names = UNFILTERED_FILES if length_to_filter is None else \
+            {k: OUTPUT_FILES[k].format(length=length_to_filter) for k in UNFILTERED_FILES}
+        names = {k: os.path.join(output_dir, v) for k, v in names.items()}
+        inputs = {'table': feature_table, 'data': representative_sequences}
+        parameters = {'length_to_filter': length_to_filter}
+        if 'table' in outputs:
+            artifacts.write_qza(names['table'], 'FeatureTable[Frequency]', artifacts.table_bytes(table),
+                                'length_filter', parameters, inputs)
+        if 'seqs' in outputs:
+            artifacts.write_qza(names['seqs'], 'FeatureData[Sequence]', artifacts.fasta_bytes(sequences),
+                                'length_filter', parameters, inputs, output_name='filtered_data')
+        stage.records_out = int(table.sum())
+
+    return PipelineResults(false_reads, jump_rate, max_false_reads, table, sequences, summary)
+
+
+def main():
+    cli.standalone('run')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import re
+
+
+# LCO1490 forward and CO1-CFMRa reverse primers of the MetaPlex library prep (see library_prep/)
+ANML_PRIMERS = ('GGTCAACAAATCATAAAGATATTGG', 'GGWACTAATCAATTTCCAAATCC')
+
+# Bases matched by each IUPAC code, as a 4 bit mask of A, C, G and T
+_IUPAC = {'A': 1, 'C': 2, 'G': 4, 'T': 8, 'U': 8,
+          'R': 5, 'Y': 10, 'S': 6, 'W': 9, 'K': 12, 'M': 3,
+          'B': 14, 'D': 13, 'H': 11, 'V': 7, 'N': 15}
+_COMPLEMENT = str.maketrans('ACGTURYSWKMBDHVN', 'TGCAAYRSWMKVHDBN')
+
+# Translation table from read bases to the same bit masks. An N in the read matches nothing, as in cutadapt.
+_READ_BITS = bytes(_IUPAC[chr(i).upper()] if chr(i) in 'ACGTacgt' else 0 for i in range(256))
+
+
+def reverse_complement(seq):
+    return seq.upper().translate(_COMPLEMENT)[::-1]
+
+
+def _pattern(seq):
+    '''
+    Regular expression (bytes) matching seq exactly, with every IUPAC code expanded to a character class
+    '''
+    parts = []
+    for code in seq:
+        bases = [b for b in 'ACGT' if _IUPAC[code] & _IUPAC[b]]
+        parts.append(bases[0] if len(bases) == 1 else f'[{"".join(bases)}]')
+    return re.compile(''.join(parts).encode())
+
+
+class Primer:
+    '''
+    Primer matcher tolerating substitutions and degenerate IUPAC bases
+
+    seq        : primer sequence, 5' to 3' as it appears in the read
+
+    error_rate : maximum fraction of mismatched bases, as cutadapt's --error-rate
+    '''
+
+    def __init__(self, seq, error_rate=0.1):
+        self.seq = seq.upper()
+        self.length = len(self.seq)
+        self.max_errors = int(self.length * error_rate)
+        self.exact = _pattern(self.seq)
+
+        # A read base matches when its bit is set in the primer's mask, so ANDing the two as big integers leaves a
+        # zero byte at every mismatch
+        self.mask = int.from_bytes(bytes(_IUPAC[code] for code in self.seq), 'big')
+
+        # Split into max_errors + 1 seeds: any match within max_errors mismatches contains one of them exactly
+        n = self.max_errors + 1
+        bounds = [i * self.length // n for i in range(n + 1)]
+        self.seeds = [(start, _pattern(self.seq[start:end])) for start, end in zip(bounds, bounds[1:])]
+
+    def mismatches(self, window):
+        '''
+        Number of mismatches between the primer and a read window of the same length
+        '''
+        bits = int.from_bytes(window.translate(_READ_BITS), 'big') & self.mask
+        return bits.to_bytes(self.length, 'big').count(0)
+
+    def match_prefix(self, seq, start=0, end=None):
+        '''
+        True if seq[start:end] starts with the primer
+        '''
+        end = len(seq) if end is None else end
+        if end - start < self.length:
+            return False
+        return self.mismatches(seq[start:start + self.length]) <= self.max_errors
+
+    def find(self, seq, start=0, end=None):
+        '''
+        Position of the primer within seq[start:end]: the first exact match, or failing that the first match within
+        max_errors mismatches
+
+        Return : start offset of the match in seq, or -1 if there is none
+        '''
+        end = len(seq) if end is None else end
+        hit = self.exact.search(seq, start, end)
+        if hit is not None:
+            return hit.start()
+
+        best = -1
+        if not self.max_errors:
+            return best
+        for offset, seed in self.seeds:
+            for seed_hit in seed.finditer(seq, start + offset, end):
+                candidate = seed_hit.start() - offset
+                if best != -1 and candidate >= best or candidate + self.length > end:
+                    break
+                if self.mismatches(seq[candidate:candidate + self.length]) <= self.max_errors:
+                    best = candidate
+                    break
+
+        return best
+
+
+class PrimerTrimmer:
+    '''
+    Trims a linked primer pair off the insert of a read, as cutadapt's '^FWD...REV' adapter with
+    --discard-untrimmed: the forward primer is required at the start of the insert, and the reverse complement of
+    the reverse primer is removed with everything after it if it is found. Inserts shorter than min_length after
+    trimming are discarded.
+
+    primers    : (forward primer, reverse primer), both 5' to 3' as synthesized, or None to only filter on length
+
+    min_length : minimum length of the trimmed insert, or None
+
+    error_rate : maximum fraction of mismatched bases in each primer
+    '''
+
+    def __init__(self, primers=ANML_PRIMERS, min_length=None, error_rate=0.1):
+        self.fwd = self.rev = None
+        if primers is not None:
+            self.fwd = Primer(primers[0], error_rate)
+            self.rev = Primer(reverse_complement(primers[1]), error_rate)
+        self.min_length = min_length or 0
+
+    def __call__(self, seq, start, end):
+        '''
+        seq        : read sequence as bytes
+
+        start, end : bounds of the insert between the tags
+
+        Return : (start, end) of the trimmed insert, or None if the read is discarded
+        '''
+        if self.fwd is not None:
+            if not self.fwd.match_prefix(seq, start, end):
+                return None
+            start += self.fwd.length
+            hit = self.rev.find(seq, start, end)
+            if hit != -1:
+                end = hit
+
+        if end - start < self.min_length:
+            return None
+
+        return start, end
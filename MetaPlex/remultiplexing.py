@@ -1,104 +1,402 @@
 import os
-import subprocess
-import pandas as pd
 import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from . import cache, cli, metrics
+from .bam import iter_bam_records, read_bam_chunks
+from .fastq import FastqWriter, iter_fastq_blocks, read_fastq_chunks
+from .primers import PrimerTrimmer
+from .spill import SampleSpill
+from .streams import open_input, prefetch
+from .tags import TagRegistry
+
+
+def load_indexes(indexFile):
+    '''
+    Reads in the indexes csv and splits it into Forward and Reverse index dictionaries
+
+    indexFile : path to .csv containing all the index tag sequences that are present in the sequencing pool
+
+    Return : (fwd_indexes, rev_indexes) dictionaries of {'F01': 'CTAAGGTAACGAT', ...} and {'R11': 'GATTCGAGGA', ...}
+    '''
+    registry = TagRegistry.from_indexes(indexFile)
+
+    return registry.fwd, registry.rev
+
+
+def build_lookup(indexes, max_mismatches=0):
+    '''
+    Builds hash tables from tag sequence to tag identifier for one read end. Tags are grouped by length and by
+    distance so that each read end is classified with a single dictionary hit per distinct tag length.
+
+    When max_mismatches is above 0, every sequence within that Hamming distance of a tag (including N calls) is also
+    mapped to the tag, so reads with sequencing errors in their index are still recovered with one lookup. Sequences
+    that are equally close to two different tags of the same length are ambiguous and mapped to None.
+
+    indexes        : dictionary of {ID: sequence} as returned by load_indexes
+
+    max_mismatches : maximum number of substitutions tolerated in a tag
+
+    Return : list of (distance, tag length, {sequence (bytes): ID or None}) tuples, exact tags first and longest tags
+             first within each distance
+    '''
+    by_length = {}
+    for k, v in indexes.items():
+        table = by_length.setdefault(len(v), {})
+        for neighbour, distance in _neighbours(v.upper().encode(), max_mismatches):
+            best = table.get(neighbour)
+            if best is None or distance < best[0]:
+                table[neighbour] = (distance, k)
+            elif distance == best[0] and best[1] != k:
+                table[neighbour] = (distance, None)
+
+    tables = {}
+    for length, table in by_length.items():
+        for seq, (distance, k) in table.items():
+            tables.setdefault((distance, length), {})[seq] = k
+
+    return sorted(((distance, length, table) for (distance, length), table in tables.items()),
+                  key=lambda t: (t[0], -t[1]))
+
+
+def _neighbours(seq, max_mismatches):
+    '''
+    Every sequence within max_mismatches substitutions of seq, with its distance
+    '''
+    found = {seq: 0}
+    frontier = [seq]
+    for distance in range(1, max_mismatches + 1):
+        next_frontier = []
+        for s in frontier:
+            for i in range(len(s)):
+                for base in b'ACGTN':
+                    if base == seq[i] or base == s[i]:
+                        continue
+                    n = s[:i] + bytes((base,)) + s[i + 1:]
+                    if n not in found:
+                        found[n] = distance
+                        next_frontier.append(n)
+        frontier = next_frontier
+
+    return found.items()
 
 
-def remultiplex(sequenceFile, indexFile):
+def classify(seq, fwd_lookup, rev_lookup):
+    '''
+    Classifies a single read by its 5' (Forward) and 3' (Reverse) tags. Each tag is the closest match across every
+    tag length: an exact match wins over any mismatched one, the longest tag wins between exact matches, and reads
+    equally close to two different mismatched tags are ambiguous.
+
+    seq        : read sequence as bytes
+
+    fwd_lookup : Forward index lookup as returned by build_lookup
+
+    rev_lookup : Reverse index lookup as returned by build_lookup
+
+    Return : (Forward ID, Reverse ID, Forward tag length, Reverse tag length), or None if either tag is missing or
+             ambiguous
+    '''
+    fwd = _match(seq, fwd_lookup, len(seq), True)
+    if fwd is None:
+        return None
+
+    # The Reverse tag must sit entirely within the read remaining after the Forward tag
+    rev = _match(seq, rev_lookup, len(seq) - fwd[1], False)
+    if rev is None:
+        return None
+
+    return fwd[0], rev[0], fwd[1], rev[1]
+
+
+# Marks a sequence missing from a lookup table, as None marks an ambiguous one
+_MISSING = object()
+
+
+def _match(seq, lookup, remaining, start):
+    '''
+    Closest tag at the start (or end) of seq, among tags no longer than remaining
+
+    Return : (ID, tag length), or None if no tag matches or the closest match is ambiguous
+    '''
+    found = None
+    for distance, length, table in lookup:
+        if found is not None and distance > found[0]:
+            break
+        if length > remaining:
+            continue
+        k = table.get(seq[:length] if start else seq[len(seq) - length:], _MISSING)
+        if k is _MISSING:
+            continue
+        if found is None:
+            if distance == 0 and k is not None:
+                return k, length
+            found = (distance, k, length)
+        elif k != found[1]:
+            # As close to another tag of a different length
+            found = (distance, None, length)
+
+    if found is None or found[1] is None:
+        return None
+
+    return found[1], found[2]
+
+
+def remultiplex_records(records, fwd_indexes, rev_indexes, max_mismatches=0, trimmer=None):
+    '''
+    Single pass dual-index demultiplexer. Each record is classified once by both tags, trimmed of its tags, and
+    prepended with the merged Forward + Reverse index.
+
+    records     : iterable of (header, sequence, plus, quality) byte string tuples
+
+    fwd_indexes : dictionary of Forward {ID: sequence}
+
+    rev_indexes : dictionary of Reverse {ID: sequence}
+
+    max_mismatches : maximum number of substitutions tolerated in each tag
+
+    trimmer     : optional primers.PrimerTrimmer, trimming the primers off the insert between the tags and filtering it
+                  on length in the same pass
+
+    Return : generator of (Forward ID, Reverse ID, remultiplexed fastq record as bytes) for every record where both a
+             forward and reverse index were found. The record is None if the trimmer discarded it.
+    '''
+    return _remultiplex_records(records, *_build_engine(fwd_indexes, rev_indexes, max_mismatches, trimmer))
+
+
+def _build_engine(fwd_indexes, rev_indexes, max_mismatches=0, trimmer=None):
+    fwd_lookup = build_lookup(fwd_indexes, max_mismatches)
+    rev_lookup = build_lookup(rev_indexes, max_mismatches)
+    fwd_bytes = {k: v.upper().encode() for k, v in fwd_indexes.items()}
+    rev_bytes = {k: v.upper().encode() for k, v in rev_indexes.items()}
+
+    return fwd_lookup, rev_lookup, fwd_bytes, rev_bytes, trimmer
+
+
+def _remultiplex_records(records, fwd_lookup, rev_lookup, fwd_bytes, rev_bytes, trimmer=None):
+    for header, seq, plus, qual in records:
+        hit = classify(seq, fwd_lookup, rev_lookup)
+        if hit is None:
+            continue
+        fwd, rev, start, rev_len = hit
+        end = len(seq) - rev_len
+        if trimmer is not None:
+            # Reads are still counted against their tags when they are trimmed away
+            bounds = trimmer(seq, start, end)
+            if bounds is None:
+                yield fwd, rev, None
+                continue
+            start, end = bounds
+        merged = fwd_bytes[fwd] + rev_bytes[rev]
+        yield fwd, rev, b''.join((header, b'\n',
+                                  merged, seq[start:end], b'\n',
+                                  b'+\n',
+                                  b'I' * len(merged), qual[start:end], b'\n'))
+
+
+# Per-process engine and chunk parser, set up once by _init_worker rather than shipped with every chunk
+_engine = None
+_parse = None
+
+
+def _init_worker(fwd_indexes, rev_indexes, max_mismatches, bam, trimmer=None):
+    global _engine, _parse
+    _engine = _build_engine(fwd_indexes, rev_indexes, max_mismatches, trimmer)
+    _parse = iter_bam_records if bam else _parse_fastq
+
+
+def _parse_fastq(chunk):
+    return iter_fastq_blocks([chunk])
+
+
+def _remultiplex_chunk(chunk):
+    '''
+    Remultiplexes one record-aligned chunk of fastq or raw BAM bytes
+
+    Return : (number of records in the chunk,
+              dictionary of {(Forward tag code, Reverse tag code): (read count, remultiplexed records as bytes)}).
+              The read count includes reads that were trimmed away.
+    '''
+    records = _parse(chunk)
+    if _parse is _parse_fastq:
+        n_records = chunk.count(b'\n') // 4
+    else:
+        records = list(records)
+        n_records = len(records)
+
+    groups = {}
+    for fwd, rev, record in _remultiplex_records(records, *_engine):
+        groups.setdefault((fwd, rev), []).append(record)
+
+    return n_records, {k: (len(v), b''.join(r for r in v if r is not None)) for k, v in groups.items()}
+
+
+def _ordered_map(func, items, workers, initargs):
+    '''
+    Applies func to every item in a pool of worker processes, yielding results in input order. At most two chunks per
+    worker are in flight at once so that a slow pool does not pull the whole input into memory.
+    '''
+    if workers == 1:
+        _init_worker(*initargs)
+        for item in items:
+            yield func(item)
+        return
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=initargs) as pool:
+        # Start the workers before the first item is read. Items may come from a reader thread (streams.prefetch),
+        # and a worker forked while that thread holds a lock, e.g. on stdin, would deadlock.
+        pool.submit(int).result()
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def remultiplex(sequenceFile, indexFile, workers=1, max_mismatches=0, output_dir='.', work_dir=None, output=None,
+                primers=None, min_length=None, primer_error_rate=0.1, memory=256 << 20):
     '''
     Takes dual-indexed reads, trims the 5' and 3' ends of the reads past the indexes, and moves the 3' index to
     immediately follow the 5' index (i.e. ['MultiplexedSingleEndBarcodeInSequence'] format)
 
-    sequenceFile : path to raw sequence file of type .fastq, .fastq.gz, or .bam
+    sequenceFile : path to raw sequence file of type .fastq, .fastq.gz, or .bam, a named pipe, or '-' for stdin. The
+                   format is recognised from the first bytes of the file.
 
     indexFile    : path to .csv containing all the index tag sequences that are present in the sequencing pool. This .csv
                    should be formatted as specified below (See indexes.csv for reference)
 
-    Return : None
+    workers      : number of worker processes used to remultiplex chunks of the input in parallel, 0 for one per CPU
+
+    max_mismatches : maximum number of substitutions tolerated in each index tag. Reads whose tags are equally close
+                     to two different indexes are discarded.
+
+    output_dir   : directory the outputs are written to, created if missing
+
+    work_dir     : directory for temporary files, the system temporary directory by default
+
+    output       : if given, the remultiplexed reads are streamed to this path (a named pipe, or '-' for stdout) as they
+                   are produced instead of being sorted by sample into remultiplexed_seqs.fastq.gz. Output is gzipped if
+                   the path ends in .gz, and progress messages go to stderr when writing to stdout.
+
+    primers      : optional (forward primer, reverse primer) pair, both 5' to 3' as synthesized, trimmed off the
+                   insert in the same pass, as cutadapt's '^FWD...REV' linked adapter with --discard-untrimmed. Reads
+                   without the forward primer are dropped. IUPAC codes are supported, and primers.ANML_PRIMERS are
+                   the MetaPlex library prep primers.
+
+    min_length   : optional minimum length of the insert (after primer trimming), shorter reads are dropped
+
+    primer_error_rate : maximum fraction of mismatched bases in each primer
+
+    memory       : bytes of remultiplexed reads held in memory while they are grouped by sample. Past this they are
+                   spilled to a few partition files in work_dir.
 
-    Output : remultiplexed_seqs.fastq.gz
+    Return : Forward x Reverse read count matrix (pandas DataFrame), covering every index combination in indexFile
+
+    Output : remultiplexed_seqs.fastq.gz, block gzip (BGZF) compressed and sorted by sample
+             remultiplexed_seqs_index.tsv, the offsets and read count of every sample in remultiplexed_seqs.fastq.gz,
+             for fastq.read_sample
+             remultiplexed_counts.tsv, the read count matrix, which index_jump.calculate accepts in place of the
+             demultiplexed sequences. Reads dropped by primer trimming or the length filter are still counted.
     '''
-    if sequenceFile.endswith('.bam'):
-        convert = str('samtools fastq '+sequenceFile+' > raw_seqs.fastq')
-        subprocess.run(convert, shell=True)
-        sequenceFile = './raw_seqs.fastq'
+    log = sys.stderr if output == '-' else sys.stdout
 
-    else:
-        assert sequenceFile.endswith('.fastq') or sequenceFile.endswith('.gz'), 'Sequence file not of proper format. Should be .bam or .fastq'
-
-    # Read in indexes csv, and convert Forward indexes to dictionary
-    df = pd.read_csv(indexFile, dtype=str)
-    df['ID_ori'] = (df['orientation'] + df['ID'])
-    f_df = df[df['orientation'] == 'F']
-    fwd_indexes = dict(zip(f_df.ID_ori, f_df.seq))
-
-    # Organizing by Forward Index
-    f = open('fwd_sort.txt', 'w')
-    for k in fwd_indexes:
-        fwd_sort = str('cutadapt -g '+fwd_indexes[k]+' --discard-untrimmed -e 0 -j 0 --overlap 10 -o '
-                   +k+'.fastq '+sequenceFile)
-        subprocess.run(fwd_sort, shell=True, stdout=f)
-
-    os.system('find . -type f -size 0 -delete')
-
-    # Convert Reverse barcodes to dictionary
-    r_df = df[df['orientation'] == 'R']
-    rev_indexes = dict(zip(r_df.ID_ori, r_df.seq))
-
-    fastqs = []
-    for file in os.listdir('.'):
-        if len(file) == 9 and file.endswith('fastq'):
-            fastqs.append(file)
-
-    # Iterating over each Forward Index to then organize by Reverse index
-    f = open('rev_sort.txt', 'w')
-    for fastq in fastqs:
-        for k in rev_indexes:
-            rev_sort = str('cutadapt -a '+rev_indexes[k]+'$ --discard-untrimmed -e 0 -j 0 --overlap 10 -o '
-                           +fastq[0:3]+k+'.fastq '+fastq)
-            subprocess.run(rev_sort, shell=True, stdout=f)
-
-    os.system('find . -type f -size 0 -delete')
-
-    # Create dictionary for merged Fwd and Rev idnexes
-    merged_indexes = {}
-    for k_a, v_a in fwd_indexes.items():
-        for k_b, v_b in rev_indexes.items():
-            merged_indexes[k_a + k_b] = v_a + v_b
-
-    fastqs = []
-    for fastq in os.listdir('.'):
-        if len(fastq) == 12 and fastq.endswith('fastq'):
-            fastqs.append(fastq)
-
-    # Prepending each read with the appropriate merged index as indicated by file name
-    fastqs.sort()
-    for fastq in fastqs:
-        for k, v in merged_indexes.items():
-            if fastq[0:6] == k:
-                with open(fastq, 'r') as f, open('remultiplexed_seqs.fastq', 'a+') as out:
-                    count = 0
-                    for idx, line in enumerate(f.read().splitlines()):
-                        count += 1
-                        if count == 2:
-                            print(v+line, file=out)
-                        elif count == 4:
-                            print(''.join(['I']*len(v))+line, file=out)
-                        else:
-                            print(line, file=out)
-                        if count == 4:
-                            count = 0
-            else:
-                continue
+    with metrics.stage('remultiplex', sequence_file=sequenceFile, workers=workers,
+                       max_mismatches=max_mismatches) as stage:
+        # Reruns on the same reads and indexes reuse the stored outputs
+        outputs = ['remultiplexed_seqs.fastq.gz', 'remultiplexed_seqs_index.tsv', 'remultiplexed_counts.tsv']
+        entry = None
+        if not output:
+            parameters = {'max_mismatches': max_mismatches}
+            if primers is not None or min_length:
+                parameters.update(primers=primers, min_length=min_length, primer_error_rate=primer_error_rate)
+            entry = cache.key('remultiplex', [sequenceFile, indexFile], parameters)
+        os.makedirs(output_dir, exist_ok=True)
+        if cache.restore(entry, outputs, dest=output_dir) is not None:
+            print('Remultiplexed reads restored from cache', file=log)
+            counts = pd.read_csv(os.path.join(output_dir, 'remultiplexed_counts.tsv'), sep='\t', index_col=0)
+            stage.records_out = int(counts.to_numpy().sum())
+            stage.info['cache'] = 'hit'
+            return counts
+
+        # Workers classify reads straight to integer tag codes, which index the count array
+        registry = TagRegistry.from_indexes(indexFile)
+        fwd_indexes = dict(enumerate(registry.fwd.values()))
+        rev_indexes = dict(enumerate(registry.rev.values()))
+        workers = workers or os.cpu_count()
+
+        # Unmapped BAMs are decoded in-process, streaming BGZF blocks straight into the engine
+        kind, handle = open_input(sequenceFile)
+        bam = kind == 'bam'
+        if bam:
+            chunks = read_bam_chunks(handle)
+        else:
+            chunks = read_fastq_chunks(handle)
+
+        # Split the reads into record-aligned chunks and remultiplex them in parallel. Chunks are read a few ahead in a
+        # background thread, so reading and decompressing the input overlaps with remultiplexing.
+        counts = np.zeros(registry.shape, dtype=np.int64)
+        records_in = 0
+        trimmer = None
+        if primers is not None or min_length:
+            trimmer = PrimerTrimmer(primers, min_length, primer_error_rate)
+        initargs = (fwd_indexes, rev_indexes, max_mismatches, bam, trimmer)
+        results = _ordered_map(_remultiplex_chunk, prefetch(chunks, 2 * workers), workers, initargs)
+
+        if output:
+            # Each chunk is written out as soon as it is done, without waiting for the rest of the input
+            with FastqWriter(output, threads=workers) as out:
+                for n_records, groups in results:
+                    records_in += n_records
+                    for k, (n, v) in groups.items():
+                        out.write(v)
+                        counts[k] += n
+
+        else:
+            # Each chunk comes back grouped by merged index. Records are buffered per sample within a fixed memory
+            # budget and spilled to a few partition files, so memory and open files don't grow with the number of
+            # index combinations.
+            order = sorted(np.ndindex(registry.shape), key=lambda k: registry.sample_id(*k))
+            ranks = {k: rank for rank, k in enumerate(order)}
+            with SampleSpill(ranks, dir=work_dir, memory=memory) as spill:
+                for n_records, groups in results:
+                    records_in += n_records
+                    for k, (n, v) in groups.items():
+                        spill.write(k, v)
+                        counts[k] += n
+
+                # Merge in sorted merged index order, i.e. grouped by sample. Every sample starts a new block of the
+                # output, compressed in parallel, so it can be read on its own.
+                with FastqWriter(os.path.join(output_dir, 'remultiplexed_seqs.fastq.gz'), threads=workers) as out:
+                    for k, blocks in spill.merge():
+                        out.start_sample(registry.sample_id(*k))
+                        for block in blocks:
+                            out.write(block)
+
+            out.write_index(os.path.join(output_dir, 'remultiplexed_seqs_index.tsv'))
+
+        print(f'{out.records} reads remultiplexed', file=log)
+
+        counts = registry.frame(counts)
+        counts.to_csv(os.path.join(output_dir, 'remultiplexed_counts.tsv'), sep='\t')
 
-    os.system('gzip remultiplexed_seqs.fastq')
+        stage.records_in = records_in
+        stage.records_out = out.records
+        stage.info['per_tag'] = {**counts.sum(axis=1).to_dict(), **counts.sum(axis=0).to_dict()}
+        if trimmer is not None:
+            stage.info['trimmed_away'] = int(counts.to_numpy().sum()) - out.records
+        if entry is not None:
+            cache.store(entry, outputs, src=output_dir)
+            stage.info['cache'] = 'miss'
 
-    os.system('mkdir fastqs')
-    os.system('mv *.fastq fastqs| mv fwd_sort.txt fastqs| mv rev_sort.txt fastqs')
+        return counts
 
 
 def main():
-    remultiplex(sys.argv[1], sys.argv[2])
+    cli.standalone('remultiplex')
 
 
 if __name__ == '__main__':
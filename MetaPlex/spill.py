@@ -0,0 +1,165 @@
+import struct
+import tempfile
+
+
+# Header of every record group in a partition file: rank of the sample and length of the records that follow
+_FRAME = struct.Struct('<IQ')
+
+
+class SampleSpill:
+    '''
+    Groups records by sample within a fixed memory budget. Records are buffered per sample, and whenever the buffers
+    reach the budget they are spilled to a small number of partition files, each holding a contiguous range of
+    samples in output order. merge() then reads each partition file once, sequentially, and regroups its records by
+    sample in memory. A partition too large for the budget is split into smaller ranges with one more sequential
+    pass, so memory and open files stay flat however many reads or sample combinations a run has.
+
+    ranks      : dictionary of {sample key: position of the sample in the output}, positions 0 to len(ranks) - 1
+
+    dir        : directory the partition files are created in, the system temporary directory if None
+
+    memory     : bytes of records held in memory, while buffering and while regrouping a partition
+
+    partitions : number of partition files that a range of samples is split over
+    '''
+
+    def __init__(self, ranks, dir=None, memory=256 << 20, partitions=16):
+        self.ranks = ranks
+        self.keys = sorted(ranks, key=ranks.__getitem__)
+        self.dir = dir
+        self.memory = memory
+        self.partitions = max(partitions, 2)
+        self.buffers = {}
+        self.buffered = 0
+        # Partition files over every sample, created on the first spill
+        self.files = None
+        self.created = 0
+        self._open = []
+
+    def write(self, key, data):
+        if not data:
+            return
+        self.buffers.setdefault(key, []).append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.memory:
+            self.spill()
+
+    def spill(self):
+        '''
+        Appends every buffered sample to the partition file of its range and empties the buffers
+        '''
+        if self.files is None:
+            self.files = [None] * self.partitions
+        for key, blocks in self.buffers.items():
+            rank = self.ranks[key]
+            f = self._file(self.files, self._bucket(rank, 0, len(self.keys), len(self.files)))
+            f.write(_FRAME.pack(rank, sum(map(len, blocks))))
+            f.writelines(blocks)
+        self.buffers = {}
+        self.buffered = 0
+
+    def merge(self, block_size=4 << 20):
+        '''
+        Return : generator of (sample key, generator of its records as bytes blocks), in output order. Each sample's
+                 blocks must be consumed before moving on to the next sample.
+        '''
+        if self.files is None:
+            # Everything fit in memory
+            for key in sorted(self.buffers, key=self.ranks.__getitem__):
+                yield key, iter(self.buffers.pop(key))
+            return
+
+        # Records still in memory came after everything that was spilled, so they go to the end of their partitions
+        self.spill()
+        files, self.files = self.files, None
+        yield from self._merge(files, 0, len(self.keys), block_size)
+
+    def _merge(self, files, lo, hi, block_size):
+        '''
+        Merges partition files that split the samples of ranks lo to hi evenly, in output order
+        '''
+        n = len(files)
+        for p, f in enumerate(files):
+            if f is None:
+                continue
+            # Ranks r with _bucket(r) == p
+            p_lo = lo + -(-p * (hi - lo) // n)
+            p_hi = lo + -(-(p + 1) * (hi - lo) // n)
+            size = f.tell()
+            f.seek(0)
+
+            if size <= self.memory:
+                # One sequential read, regrouped by sample in memory
+                groups = {}
+                for rank, length in _frames(f):
+                    groups.setdefault(rank, []).append(f.read(length))
+                self._close(f)
+                for rank in sorted(groups):
+                    yield self.keys[rank], iter(groups.pop(rank))
+
+            elif p_hi - p_lo == 1:
+                # A single sample larger than the budget, whose records are already in input order
+                yield self.keys[p_lo], self._stream(f, block_size)
+
+            else:
+                # Split the range further with one more sequential pass, then merge the smaller partitions
+                sub = [None] * self.partitions
+                for rank, length in _frames(f):
+                    out = self._file(sub, self._bucket(rank, p_lo, p_hi, len(sub)))
+                    out.write(_FRAME.pack(rank, length))
+                    for block in _read(f, length, block_size):
+                        out.write(block)
+                self._close(f)
+                yield from self._merge(sub, p_lo, p_hi, block_size)
+
+    def _stream(self, f, block_size):
+        for rank, length in _frames(f):
+            yield from _read(f, length, block_size)
+        self._close(f)
+
+    @staticmethod
+    def _bucket(rank, lo, hi, n):
+        return (rank - lo) * n // (hi - lo)
+
+    def _file(self, files, p):
+        if files[p] is None:
+            # Unlinked on creation: nothing is left behind in the scratch directory
+            files[p] = tempfile.TemporaryFile(prefix='metaplex_', dir=self.dir)
+            self._open.append(files[p])
+            self.created += 1
+        return files[p]
+
+    def _close(self, f):
+        f.close()
+        self._open.remove(f)
+
+    def close(self):
+        for f in self._open:
+            f.close()
+        self._open = []
+        self.files = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _frames(f):
+    '''
+    (rank, length) of every record group of a partition file, read from its current position. The caller reads the
+    length bytes of records before the next group.
+    '''
+    while True:
+        header = f.read(_FRAME.size)
+        if not header:
+            return
+        yield _FRAME.unpack(header)
+
+
+def _read(f, length, block_size):
+    while length > 0:
+        block = f.read(min(block_size, length))
+        length -= len(block)
+        yield block
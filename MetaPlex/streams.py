@@ -0,0 +1,198 @@
+import gzip
+import queue
+import struct
+import sys
+import threading
+import zlib
+
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_BAM_MAGIC = b'BAM\1'
+
+# Marks the end of a queue
+_DONE = object()
+
+
+class _Prefixed:
+    '''
+    Binary reader that returns bytes already read off a stream before the rest of the stream, so that a format can be
+    sniffed from a pipe without losing the start of it
+    '''
+
+    def __init__(self, prefix, handle):
+        self.prefix = prefix
+        self.handle = handle
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.handle.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.handle.read(), b''
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        if len(data) < size:
+            data += self.handle.read(size - len(data))
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if self.handle is not sys.stdin.buffer:
+            self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _GzipReader(gzip.GzipFile):
+    '''
+    GzipFile that closes the handle it reads from, which GzipFile leaves open when given a file object
+    '''
+
+    def close(self):
+        fileobj = self.fileobj
+        super().close()
+        if fileobj is not None:
+            fileobj.close()
+
+
+def _read_exactly(handle, size):
+    data = b''
+    while len(data) < size:
+        block = handle.read(size - len(data))
+        if not block:
+            break
+        data += block
+    return data
+
+
+def open_input(sequenceFile):
+    '''
+    Opens a sequence file, '-' for stdin, or a named pipe, telling BAM, gzipped fastq and plain fastq apart by their
+    first bytes rather than by the file name
+
+    Return : ('bam', binary handle of the BGZF compressed BAM) or ('fastq', binary handle of the decompressed fastq)
+    '''
+    handle = sys.stdin.buffer if sequenceFile == '-' else open(sequenceFile, 'rb')
+
+    # A BGZF block header is 18 bytes: the gzip header with the 'BC' extra subfield holding the block size
+    head = _read_exactly(handle, 18)
+    if head[:2] != _GZIP_MAGIC:
+        if head and not head.startswith(b'@'):
+            raise ValueError(f'{sequenceFile} is not of proper format. Should be .bam or .fastq(.gz)')
+        return 'fastq', _Prefixed(head, handle)
+
+    # BAM is always BGZF, so the first block can be inflated on its own to look for the BAM magic
+    if len(head) == 18 and head[3] & 4 and head[12:14] == b'BC':
+        head += _read_exactly(handle, struct.unpack('<H', head[16:18])[0] + 1 - 18)
+        try:
+            if zlib.decompressobj(-15).decompress(head[18:-8], len(_BAM_MAGIC)) == _BAM_MAGIC:
+                return 'bam', _Prefixed(head, handle)
+        except zlib.error:
+            pass
+
+    return 'fastq', _GzipReader(fileobj=_Prefixed(head, handle), mode='rb')
+
+
+def prefetch(iterable, depth=4):
+    '''
+    Runs an iterable (e.g. a reader of input chunks) in a background thread, at most depth items ahead of the
+    consumer. Reading and decompression then overlap with processing, and a slow consumer holds up the reader
+    instead of letting it fill memory.
+
+    Return : generator of the items of iterable, in order
+    '''
+    items = queue.Queue(depth)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                items.put(item)
+        except BaseException as e:
+            items.put(e)
+            return
+        items.put(_DONE)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # Unblock the reader if the consumer stopped early. It checks stop before queueing another item, so one
+        # free slot is enough for it to finish.
+        stop.set()
+        while True:
+            try:
+                items.get_nowait()
+            except queue.Empty:
+                break
+
+
+class QueueWriter:
+    '''
+    Binary writer that hands blocks to a background thread writing them to a file, stdout or a named pipe. At most
+    depth blocks wait in the queue, so a slow reader downstream applies backpressure to the writer.
+
+    path  : output path, or '-' for stdout
+
+    depth : number of blocks that may be queued
+    '''
+
+    def __init__(self, path, depth=8):
+        self.stdout = path == '-'
+        self.handle = sys.stdout.buffer if self.stdout else open(path, 'wb')
+        self.blocks = queue.Queue(depth)
+        self.error = None
+        self.written = 0
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def _drain(self):
+        while True:
+            block = self.blocks.get()
+            if block is _DONE:
+                return
+            if self.error is None:
+                try:
+                    self.handle.write(block)
+                except BaseException as e:
+                    # Handed back to the caller on its next write or on close, e.g. BrokenPipeError
+                    self.error = e
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.blocks.put(data)
+        self.written += len(data)
+
+    def tell(self):
+        return self.written
+
+    def close(self):
+        self.blocks.put(_DONE)
+        self.thread.join()
+        if self.stdout:
+            self.handle.flush()
+        else:
+            self.handle.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
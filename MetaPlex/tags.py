@@ -0,0 +1,147 @@
+import numpy as np
+import pandas as pd
+
+
+# Merged sample IDs are the Forward tag name followed by the Reverse tag name, ex: F01R11 or F001R120
+_SAMPLE_ID = r'^(F.*?)(R.*)$'
+
+
+def _natural(name):
+    # Unpadded IDs sort by number (F2 before F10), zero padded IDs as before
+    return len(name), name
+
+
+class TagRegistry:
+    '''
+    Forward and Reverse tags of a sequencing pool, each given a compact integer code: its position among the tags of
+    its side. Names, sequences and codes are looked up in dictionaries, and per-sample values are held in
+    Forward x Reverse numpy arrays indexed by code, so that nothing depends on the width of the tag IDs or on the
+    number of tags per side.
+
+    fwd : dictionary of Forward {name: sequence}, ex: {'F01': 'CTAAGGTAACGAT', ...}. Sequences are None when only
+          the names are known, as for a registry loaded from a sample map.
+
+    rev : dictionary of Reverse {name: sequence}, ex: {'R11': 'GATTCGAGGA', ...}
+    '''
+
+    def __init__(self, fwd, rev):
+        self.fwd = dict(fwd)
+        self.rev = dict(rev)
+        self.fwd_names = list(self.fwd)
+        self.rev_names = list(self.rev)
+        self.fwd_codes = {name: code for code, name in enumerate(self.fwd_names)}
+        self.rev_codes = {name: code for code, name in enumerate(self.rev_names)}
+        self.shape = (len(self.fwd_names), len(self.rev_names))
+
+    @classmethod
+    def from_indexes(cls, indexFile):
+        '''
+        indexFile : path to .csv containing all the index tag sequences that are present in the sequencing pool, with
+                    ID, seq and orientation columns
+
+        Return : TagRegistry with the tags in the order of the file
+        '''
+        df = pd.read_csv(indexFile, dtype=str)
+        names = df['orientation'] + df['ID']
+        fwd = df['orientation'] == 'F'
+        rev = df['orientation'] == 'R'
+
+        return cls(zip(names[fwd], df['seq'][fwd]), zip(names[rev], df['seq'][rev]))
+
+    @classmethod
+    def from_sample_map(cls, sample_map):
+        '''
+        sample_map : path to tab delimited QIIME2 sample map file, or its pandas DataFrame
+
+        Return : TagRegistry of the tags named in the '#SampleID' column, without sequences
+        '''
+        if not isinstance(sample_map, pd.DataFrame):
+            sample_map = pd.read_csv(sample_map, sep='\t')
+
+        return cls.from_sample_ids(sample_map['#SampleID'])
+
+    @classmethod
+    def from_sample_ids(cls, sample_ids):
+        '''
+        sample_ids : merged sample IDs, ex: the sample IDs of a feature table
+
+        Return : TagRegistry of the tags named in sample_ids, without sequences
+        '''
+        names = split_sample_ids(sample_ids)
+
+        return cls(dict.fromkeys(sorted(set(names['Fwd'].dropna()), key=_natural)),
+                   dict.fromkeys(sorted(set(names['Rev'].dropna()), key=_natural)))
+
+    def code(self, tag, orientation):
+        '''
+        Code of a single tag
+
+        tag         : tag name or ID, ex: 'F01' or '01'
+
+        orientation : 'F' or 'R'
+        '''
+        codes = self.fwd_codes if orientation == 'F' else self.rev_codes
+        for name in (orientation + tag, tag):
+            if name in codes:
+                return codes[name]
+
+        side = 'Forward' if orientation == 'F' else 'Reverse'
+        raise ValueError(f'{tag} is not a {side} tag of this sequencing pool')
+
+    def codes(self, sample_ids):
+        '''
+        sample_ids : merged sample IDs, ex: ['F01R11', 'F01R12']
+
+        Return : numpy arrays of the Forward and Reverse codes of every sample, -1 where a tag is unknown
+        '''
+        names = split_sample_ids(sample_ids)
+        fwd = names['Fwd'].map(self.fwd_codes).fillna(-1).astype(int).to_numpy()
+        rev = names['Rev'].map(self.rev_codes).fillna(-1).astype(int).to_numpy()
+
+        return fwd, rev
+
+    def sample_id(self, fwd, rev):
+        return self.fwd_names[fwd] + self.rev_names[rev]
+
+    def matrix(self, fwd, rev, values, fill=0):
+        '''
+        Scatters per-sample values into a Forward x Reverse array, summing values of the same sample. Samples with an
+        unknown tag (code -1) are left out.
+
+        fwd, rev : Forward and Reverse codes of every sample, as returned by codes
+
+        values   : value of every sample
+
+        fill     : value of the combinations without any samples
+
+        Return : numpy array of shape self.shape
+        '''
+        values = np.asarray(values)
+        known = (fwd >= 0) & (rev >= 0)
+        out = np.zeros(self.shape, dtype=values.dtype)
+        np.add.at(out, (fwd[known], rev[known]), values[known])
+        if fill:
+            seen = np.zeros(self.shape, dtype=bool)
+            seen[fwd[known], rev[known]] = True
+            out[~seen] = fill
+
+        return out
+
+    def frame(self, matrix):
+        '''
+        Return : pandas DataFrame of a Forward x Reverse array, indexed by Forward tag name with one column per Reverse
+                 tag name, as in remultiplexed_counts.tsv
+        '''
+        return pd.DataFrame(matrix, index=pd.Index(self.fwd_names, name='Fwd'), columns=self.rev_names)
+
+
+def split_sample_ids(sample_ids):
+    '''
+    Splits merged sample IDs into their Forward and Reverse tag names, whatever the width of the tag IDs
+
+    Return : pandas DataFrame with 'Fwd' and 'Rev' columns, NaN for IDs not of the form F{ID}R{ID}
+    '''
+    names = pd.Series(sample_ids, dtype=str).str.extract(_SAMPLE_ID)
+    names.columns = ['Fwd', 'Rev']
+
+    return names
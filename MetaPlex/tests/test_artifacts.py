@@ -0,0 +1,42 @@
+import os
+import hashlib
+import tempfile
+import unittest
+import zipfile
+import biom
+from MetaPlex import artifacts
+
+
+class ArtifactsTest(unittest.TestCase):
+    def test_read(self):
+        table = artifacts.read_biom('data/length_artifacts/feature_table.qza')
+        seqs = list(artifacts.iter_fasta('data/length_artifacts/rep_seqs.qza'))
+
+        self.assertEqual(len(seqs), len(table.ids(axis='observation')))
+        self.assertEqual(set(seq_id for seq_id, seq in seqs), set(table.ids(axis='observation')))
+
+    def test_write(self):
+        table = artifacts.read_biom('data/length_artifacts/feature_table.qza')
+        with tempfile.TemporaryDirectory() as temp:
+            out = artifacts.write_qza(os.path.join(temp, 'table'), 'FeatureTable[Frequency]',
+                                      artifacts.table_bytes(table), 'per_sample_filter',
+                                      parameters={'filtering_integer': 5},
+                                      inputs={'feature_table': 'data/length_artifacts/feature_table.qza'})
+
+            self.assertTrue(out.path.endswith('table.qza'))
+            self.assertEqual(out.view(biom.Table).sum(), table.sum())
+
+            with zipfile.ZipFile(out.path) as qza:
+                root = artifacts.root_dir(qza)
+                names = qza.namelist()
+                checksums = qza.read(f'{root}/checksums.md5').decode().splitlines()
+                for line in checksums:
+                    md5, name = line.split('  ')
+                    self.assertEqual(hashlib.md5(qza.read(f'{root}/{name}')).hexdigest(), md5)
+
+        # Provenance of the input table is carried over
+        self.assertIn(f'{root}/provenance/artifacts/069e31c9-8a9e-4b6d-9e03-bb96e6ab717a/action/action.yaml', names)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import gzip
+import struct
+import unittest
+import zlib
+from MetaPlex import bam, remultiplexing
+from test_remultiplexing import FWD, REV, INSERT, TempDirTest, write_indexes
+
+
+def bgzf_compress(data, block_size=1000):
+    out = []
+    for i in range(0, len(data), block_size):
+        block = data[i:i + block_size]
+        c = zlib.compressobj(6, zlib.DEFLATED, -15)
+        payload = c.compress(block) + c.flush()
+        out.append(struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(payload) + 25))
+        out.append(payload + struct.pack('<II', zlib.crc32(block), len(block)))
+    # BGZF end of file marker
+    out.append(bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000'))
+    return b''.join(out)
+
+
+def write_bam(path, reads):
+    codes = {c: i for i, c in enumerate('=ACMGRSVTWYHKDBN')}
+    text = b'@HD\tVN:1.5\tSO:unsorted\n'
+    data = [b'BAM\1', struct.pack('<i', len(text)), text, struct.pack('<i', 0)]
+    for name, seq, flag in reads:
+        padded = seq + '=' * (len(seq) % 2)
+        packed = bytes(codes[padded[i]] << 4 | codes[padded[i + 1]] for i in range(0, len(padded), 2))
+        record = (struct.pack('<iiBBHHHiiii', -1, -1, len(name) + 1, 255, 4680, 0, flag, len(seq), -1, -1, 0)
+                  + name.encode() + b'\0' + packed + bytes([30] * len(seq)))
+        data.append(struct.pack('<i', len(record)) + record)
+    with open(path, 'wb') as f:
+        f.write(bgzf_compress(b''.join(data)))
+
+
+class BamTest(TempDirTest):
+    def test_records(self):
+        write_bam('reads.bam', [('r%d' % n, 'ACGTN' * 20 + 'A' * (n % 2), 4) for n in range(200)]
+                  + [('secondary', 'ACGT', 0x100), ('rev', 'AACG', 0x10)])
+        chunks = list(bam.read_bam_chunks('reads.bam', chunk_size=2000, threads=2))
+        records = [r for chunk in chunks for r in bam.iter_bam_records(chunk)]
+
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(len(records), 201)
+        self.assertEqual(records[1], (b'@r1', b'ACGTN' * 20 + b'A', b'+', b'?' * 101))
+        self.assertEqual(records[-1], (b'@rev', b'CGTT', b'+', b'????'))
+
+    def test_remultiplex_bam(self):
+        write_indexes('indexes.csv')
+        write_bam('raw_seqs.bam', [('r%d' % n, FWD['F01'] + INSERT + REV['R11'], 4) for n in range(10)])
+        remultiplexing.remultiplex('raw_seqs.bam', 'indexes.csv')
+
+        with gzip.open('remultiplexed_seqs.fastq.gz', 'rt') as f:
+            lines = f.read().splitlines()
+        self.assertFalse(os.path.exists('raw_seqs.fastq'))
+        self.assertEqual(len(lines), 40)
+        self.assertEqual(lines[1], FWD['F01'] + REV['R11'] + INSERT)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+from MetaPlex import batch, index_jump
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.data = os.path.abspath('data')
+        self.temp = tempfile.mkdtemp()
+        # Paths in the manifest are relative to it
+        shutil.copy(f'{self.data}/remultiplexed_counts.tsv', self.temp)
+        shutil.copy(f'{self.data}/Sample_Map.txt', self.temp)
+        with open(os.path.join(self.temp, 'manifest.tsv'), 'w') as f:
+            f.write('run\tdemultiplexed_seqs\tsample_map\tcalibrator_tag_pairs\n'
+                    'chip_1\tremultiplexed_counts.tsv\tSample_Map.txt\t01,11\n'
+                    'chip_2\tremultiplexed_counts.tsv\tSample_Map.txt\t\n'
+                    'chip_3\tmissing_counts.tsv\tSample_Map.txt\t01,11\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+    def test_read_manifest(self):
+        runs = batch.read_manifest(os.path.join(self.temp, 'manifest.tsv'))
+        self.assertEqual([run[0] for run in runs], ['chip_1', 'chip_2', 'chip_3'])
+        self.assertEqual(runs[0][1], os.path.join(self.temp, 'remultiplexed_counts.tsv'))
+        self.assertEqual(runs[0][3], [('01', '11')])
+        self.assertIsNone(runs[1][3])
+
+    def test_calculate_batch(self):
+        output_dir = os.path.join(self.temp, 'out')
+        summary = batch.calculate_batch(os.path.join(self.temp, 'manifest.tsv'), workers=2, output_dir=output_dir)
+
+        self.assertEqual(sorted(os.listdir(output_dir)),
+                         ['Expected_False_Reads_Per_Run.csv', 'Run_Summary.csv', 'batch_log.txt'])
+        summary = summary.set_index('Run')
+        self.assertEqual(summary.loc['chip_1', 'Max False Reads'], 5)
+        self.assertTrue(summary.loc['chip_3', 'Error'].startswith('FileNotFoundError'))
+
+        # Same jump rate and expected false reads as a single run
+        single, jump_rate, total = index_jump.false_reads_per_index(f'{self.data}/remultiplexed_counts.tsv',
+                                                                    f'{self.data}/Sample_Map.txt', [('01', '11')])
+        self.assertEqual(summary.loc['chip_1', 'Jump Rate'], jump_rate)
+        per_run = pd.read_csv(os.path.join(output_dir, 'Expected_False_Reads_Per_Run.csv'))
+        chip_1 = per_run[per_run['Run'] == 'chip_1']
+        self.assertEqual(chip_1['Expected False Reads'].tolist(), single['Expected False Reads'].tolist())
+        self.assertEqual(set(per_run['Run']), {'chip_1', 'chip_2'})
+
+        with open(os.path.join(output_dir, 'batch_log.txt')) as f:
+            log = f.read()
+        self.assertIn('Runs: 3, failed: 1', log)
+
+
+if __name__ == '__main__':
+    unittest.main()
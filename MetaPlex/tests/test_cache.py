@@ -0,0 +1,84 @@
+import os
+import unittest
+import numpy as np
+from MetaPlex import cache, metrics, remultiplexing, index_jump
+from test_remultiplexing import FWD, REV, INSERT, TempDirTest, write_fastq, write_indexes
+
+
+class CacheTest(TempDirTest):
+    def setUp(self):
+        self.data = os.path.abspath('data')
+        super().setUp()
+        cache.configure('cache')
+        metrics.configure(report='metrics.jsonl')
+
+    def tearDown(self):
+        cache.configure()
+        metrics.configure()
+        super().tearDown()
+
+    def test_store_restore(self):
+        with open('input.txt', 'w') as f:
+            f.write('reads')
+        entry = cache.key('stage', ['input.txt'], {'threshold': 1})
+        self.assertIsNone(cache.restore(entry, ['out.txt']))
+
+        with open('out.txt', 'w') as f:
+            f.write('result')
+        cache.store(entry, ['out.txt'], {'value': 5})
+        os.remove('out.txt')
+
+        self.assertEqual(cache.restore(entry, ['out.txt']), {'value': 5})
+        with open('out.txt') as f:
+            self.assertEqual(f.read(), 'result')
+
+        # Other parameters, or changed input contents, are different entries
+        self.assertNotEqual(cache.key('stage', ['input.txt'], {'threshold': 2}), entry)
+        # numpy values are keyed as the Python values they hold, as in the metrics records
+        self.assertEqual(cache.key('stage', ['input.txt'], {'threshold': np.int64(1)}), entry)
+        with open('input.txt', 'w') as f:
+            f.write('other reads')
+        self.assertNotEqual(cache.key('stage', ['input.txt'], {'threshold': 1}), entry)
+
+    def test_eviction(self):
+        entries = []
+        for n in range(3):
+            with open('out.bin', 'wb') as f:
+                f.write(b'x' * 1000)
+            entries.append(str(n))
+            cache.store(str(n), ['out.bin'])
+            os.utime(os.path.join('cache', str(n)), (n, n))
+        cache.restore('0', ['out.bin'])
+
+        # Entry 1 is now the least recently used
+        cache.evict(2000)
+        self.assertEqual(sorted(e for e in os.listdir('cache') if e in entries), ['0', '2'])
+
+    def test_remultiplex(self):
+        write_indexes('indexes.csv')
+        write_fastq('raw_seqs.fastq', [FWD[f] + INSERT + REV[r] for f in FWD for r in REV])
+
+        first = remultiplexing.remultiplex('raw_seqs.fastq', 'indexes.csv')
+        os.remove('remultiplexed_seqs.fastq.gz')
+        second = remultiplexing.remultiplex('raw_seqs.fastq', 'indexes.csv')
+
+        self.assertTrue(os.path.exists('remultiplexed_seqs.fastq.gz'))
+        self.assertEqual(first.to_numpy().tolist(), second.to_numpy().tolist())
+        self.assertEqual([r['cache'] for r in metrics.read_report('metrics.jsonl')], ['miss', 'hit'])
+
+    def test_calculate(self):
+        args = (f'{self.data}/remultiplexed_counts.tsv', f'{self.data}/Sample_Map.txt', [('01', '11')])
+        first = index_jump.calculate(*args)
+        with open('log.txt') as f:
+            log = f.read()
+        os.remove('log.txt')
+        second = index_jump.calculate(*args)
+
+        self.assertEqual(first, second)
+        with open('log.txt') as f:
+            self.assertEqual(f.read(), log)
+        self.assertEqual([r['cache'] for r in metrics.read_report('metrics.jsonl')], ['miss', 'hit'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from MetaPlex import cli, pipeline
+
+
+class CliTest(unittest.TestCase):
+    def test_lazy_imports(self):
+        # Parsing arguments and --help never import the heavy dependencies
+        code = ('import sys\n'
+                'from MetaPlex import cli\n'
+                'cli.build_parser().parse_args(["calculate", "counts.tsv", "Sample_Map.txt", "01,11"])\n'
+                'print(sorted(m for m in ("pandas", "numpy", "biom", "scipy") if m in sys.modules))')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, env=env, check=True)
+        self.assertEqual(result.stdout.strip(), '[]')
+
+        result = subprocess.run([sys.executable, '-m', 'MetaPlex', 'length-filter', '--help'], capture_output=True,
+                                text=True, env=env)
+        self.assertEqual(result.returncode, 0)
+        self.assertIn('length_to_filter', result.stdout)
+
+    def test_argument_errors(self):
+        with self.assertRaises(SystemExit):
+            cli.main([])
+        with self.assertRaises(SystemExit):
+            cli.main(['length-filter', 'table.qza', 'seqs.qza', 'long'])
+
+        # Exactly one of a filtering integer and a jump rate
+        with self.assertRaises(SystemExit):
+            cli.main(['per-sample-filter', 'table.qza'])
+        with self.assertRaises(SystemExit):
+            cli.main(['per-sample-filter', 'table.qza', '500', '--jump-rate', '0.01'])
+        args = cli.build_parser().parse_args(['per-sample-filter', 'table.qza', '--jump-rate', '0.01'])
+        self.assertEqual((args.filtering_integer, args.jump_rate), (None, 0.01))
+
+    def test_pipeline_outputs(self):
+        self.assertEqual(cli.PIPELINE_OUTPUTS, list(pipeline.OUTPUT_FILES))
+
+    def test_calculate(self):
+        with tempfile.TemporaryDirectory() as temp:
+            cli.main(['calculate', 'data/remultiplexed_counts.tsv', 'data/Sample_Map.txt', '01,11',
+                      '--output-dir', temp])
+            self.assertEqual(sorted(os.listdir(temp)), ['Expected_False_Reads_Per_Index.csv', 'log.txt'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import gzip
+import tempfile
+import unittest
+from MetaPlex import fastq
+
+
+class FastqTest(unittest.TestCase):
+    def test_block_boundaries(self):
+        data = b''.join(b'@r%d\nACGT\n+\nIIII\n' % n for n in range(50))
+        blocks = [data[i:i + 7] for i in range(0, len(data), 7)]
+        records = list(fastq.iter_fastq_blocks(blocks))
+
+        self.assertEqual(len(records), 50)
+        self.assertEqual(records[49], (b'@r49', b'ACGT', b'+', b'IIII'))
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            list(fastq.iter_fastq_blocks([b'@r0\nACGT\n+\n']))
+
+    def test_chunks(self):
+        with tempfile.TemporaryDirectory() as temp:
+            path = os.path.join(temp, 'in.fastq')
+            with open(path, 'wb') as f:
+                f.write(b''.join(b'@r%d\nACGT\n+\nIIII\n' % n for n in range(100)))
+            chunks = list(fastq.read_fastq_chunks(path, chunk_size=50))
+
+        self.assertTrue(all(chunk.count(b'\n') % 4 == 0 for chunk in chunks))
+        self.assertEqual(len(list(fastq.iter_fastq_blocks(chunks))), 100)
+
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as temp:
+            path = os.path.join(temp, 'out.fastq.gz')
+            with fastq.FastqWriter(path, block_size=64) as out:
+                for n in range(100):
+                    out.write(b'@r%d\nACGT\n+\nIIII\n' % n)
+
+            self.assertEqual(out.records, 100)
+            records = list(fastq.read_fastq(path, block_size=100))
+            with gzip.open(path, 'rb') as f:
+                self.assertEqual(f.read().count(b'\n'), 400)
+
+        self.assertEqual(records[0], (b'@r0', b'ACGT', b'+', b'IIII'))
+
+    def test_sample_index(self):
+        with tempfile.TemporaryDirectory() as temp:
+            for name in ('out.fastq', 'out.fastq.gz'):
+                path = os.path.join(temp, name)
+                with fastq.FastqWriter(path, block_size=64, threads=2) as out:
+                    for sample in ('A', 'B', 'C'):
+                        out.start_sample(sample)
+                        for n in range(20000 if sample == 'B' else 10):
+                            out.write(b'@%s%d\nACGT\n+\nIIII\n' % (sample.encode(), n))
+                out.write_index(path + '.tsv')
+
+                index = fastq.read_index(path + '.tsv')
+                self.assertEqual([v[2] for v in index.values()], [10, 20000, 10])
+                for sample in index:
+                    records = list(fastq.read_sample(path, index, sample))
+                    self.assertEqual(records[0][0], b'@%s0' % sample.encode())
+                    self.assertEqual(len(records), index[sample][2])
+
+            # Still one readable gzip stream
+            with gzip.open(os.path.join(temp, 'out.fastq.gz'), 'rb') as f:
+                self.assertEqual(f.read().count(b'\n'), 4 * 20020)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,14 @@
 import os
+import gzip
 import subprocess
+import tempfile
 import unittest
+import zipfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
 from MetaPlex import index_jump
+from MetaPlex.tags import TagRegistry
 
 
 class IndexJumpTests(unittest.TestCase):
@@ -25,6 +32,93 @@ class IndexJumpTests(unittest.TestCase):
         # Clean up
         os.system('rm Expected_False_Reads_Per_Index.csv | rm -r tsvs | rm log.txt')
 
+    def test_counts_matrix(self):
+        self.val = index_jump.calculate(demultiplexed_seqs='data/remultiplexed_counts.tsv',
+                                        sample_map='data/Sample_Map.txt',
+                                        calibrator_tag_pairs=[('01', '11')])
+
+        self.assertEqual(self.val, 5)
+        # Clean up
+        os.system('rm Expected_False_Reads_Per_Index.csv | rm log.txt')
+
+    def test_confidence_bounds(self):
+        df, jump_rate, total = index_jump.false_reads_per_index('data/remultiplexed_counts.tsv', 'data/Sample_Map.txt',
+                                                                [('01', '11')], confidence=0.95, seed=0)
+
+        # The point estimate is unchanged and lies within the bounds of every sample
+        self.assertEqual(df['Expected False Reads'].max(), 5)
+        self.assertTrue((df['Expected False Reads Lower'] <= df['Expected False Reads']).all())
+        self.assertTrue((df['Expected False Reads'] <= df['Expected False Reads Upper']).all())
+        self.assertGreater(df['Expected False Reads Upper'].sum(), df['Expected False Reads'].sum())
+
+        # The same seed gives the same bounds
+        again = index_jump.false_reads_per_index('data/remultiplexed_counts.tsv', 'data/Sample_Map.txt',
+                                                 [('01', '11')], confidence=0.95, seed=0)[0]
+        pd.testing.assert_frame_equal(df, again)
+
+    def test_jump_rate_bounds(self):
+        lower, upper = index_jump.jump_rate_bounds(np.array([10, 30]), np.array([10000, 10000]), seed=1)
+        self.assertLess(lower, 0.002)
+        self.assertGreater(upper, 0.002)
+
+        # Narrower at a lower confidence level
+        narrow = index_jump.jump_rate_bounds(np.array([10, 30]), np.array([10000, 10000]), confidence=0.5, seed=1)
+        self.assertGreater(narrow[0], lower)
+        self.assertLess(narrow[1], upper)
+
+    def test_missing_combination(self):
+        df = pd.DataFrame({'Fwd': ['01', '01', '02'],
+                           'Rev': ['11', '12', '11'],
+                           'forward sequence count': [1000, 10, 500]})
+        counts = index_jump.count_matrix(df)
+        self.assertEqual(counts.loc['02', '12'], 0)
+
+        exp_false = index_jump.expected_false_reads(counts, 0.01)
+        # F02R12 had no reads: (500 * 0.01) * (10 / 1510) + (10 * 0.01) * (500 / 1510), rounded up
+        self.assertEqual(exp_false.loc['02', '12'], 1)
+        # F01R11: (1010 * 0.01) * (500 / 1510) + (1500 * 0.01) * (10 / 1510), rounded up
+        self.assertEqual(exp_false.loc['01', '11'], 4)
+
+    def test_path_input(self):
+        args = ('data/remultiplexed_counts.tsv', 'data/Sample_Map.txt', [('01', '11')])
+        df, jump_rate, total_read_count = index_jump.false_reads_per_index(*args)
+        from_path = index_jump.false_reads_per_index(Path(args[0]), Path(args[1]), args[2])
+
+        pd.testing.assert_frame_equal(from_path[0], df)
+        self.assertEqual(from_path[1:], (jump_rate, total_read_count))
+
+    def test_calibrator_without_reads(self):
+        registry = TagRegistry.from_sample_ids(['F01R11', 'F01R12', 'F02R11', 'F02R12'])
+        true_false = np.array([[1, 0], [0, 1]])
+
+        # No reads at all with the Forward calibrator tag
+        counts = np.array([[0, 0], [20, 1000]])
+        with self.assertRaisesRegex(ValueError, 'F01'):
+            index_jump.calibrator_counts(counts, true_false, registry, [('01', '11')])
+
+        counts = np.array([[1000, 5], [20, 1000]])
+        false_counts, tag_counts, scale = index_jump.calibrator_counts(counts, true_false, registry, [('01', '11')])
+        self.assertEqual(false_counts.tolist(), [5, 20])
+        self.assertEqual(tag_counts.tolist(), [1005, 1020])
+
+        with self.assertRaises(ValueError):
+            index_jump.calibrator_counts(np.zeros((2, 2), dtype=int), true_false, registry, None)
+
+    def test_count_demux_reads(self):
+        with tempfile.TemporaryDirectory() as temp:
+            path = os.path.join(temp, 'demultiplexed_seqs.qza')
+            with zipfile.ZipFile(path, 'w') as qza:
+                qza.writestr('uuid/data/MANIFEST', 'sample-id,filename,direction\n'
+                                                   'F01R11,F01R11_0_L001_R1_001.fastq.gz,forward\n'
+                                                   'F01R12,F01R12_1_L001_R1_001.fastq.gz,forward\n')
+                qza.writestr('uuid/data/F01R11_0_L001_R1_001.fastq.gz', gzip.compress(b'@r\nACGT\n+\nIIII\n' * 250))
+                # Multi-member gzip without a final newline
+                qza.writestr('uuid/data/F01R12_1_L001_R1_001.fastq.gz',
+                             gzip.compress(b'@r\nACGT\n+\nIIII\n' * 2) + gzip.compress(b'@r\nACGT\n+\nIIII'))
+            df = index_jump.count_demux_reads(path, workers=2)
+
+        self.assertEqual(df.set_index('sample ID')['forward sequence count'].to_dict(), {'F01R11': 250, 'F01R12': 3})
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -5,6 +5,7 @@ import tempfile
 import shutil
 import biom
 import unittest
+import pandas as pd
 from MetaPlex import length_filtering
 
 
@@ -48,6 +49,24 @@ class LengthFilterTest(unittest.TestCase):
         # Clean up
         os.system('rm length_filt_table_150.qza length_filt_seqs_150.qza Features-to-exclude.csv')
 
+    def test_sweep(self):
+        results = length_filtering.length_filter(feature_table='data/length_artifacts/feature_table.qza',
+                                                 representative_sequences='data/length_artifacts/rep_seqs.qza',
+                                                 length_to_filter=[100, 150])
+
+        self.assertEqual(sorted(results), [100, 150])
+        table, seqs = results[150]
+        self.assertEqual(table.filtered_table.view(biom.Table).sum(), 368114)
+
+        summary = pd.read_csv('length_filter_summary.csv', index_col='Length Threshold')
+        self.assertEqual(summary.loc[150, 'Retained Reads'], 368114)
+        self.assertEqual(summary.loc[150, 'Retained Sequences'], 3662 // 2)
+        self.assertGreaterEqual(summary.loc[100, 'Retained Reads'], summary.loc[150, 'Retained Reads'])
+
+        # Clean up
+        os.system('rm length_filt_table_100.qza length_filt_seqs_100.qza length_filt_table_150.qza '
+                  'length_filt_seqs_150.qza length_filter_summary.csv')
+
 
 if __name__ == '__main__':
     unittest.main()
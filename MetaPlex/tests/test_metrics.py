@@ -0,0 +1,49 @@
+import os
+import unittest
+from MetaPlex import metrics, remultiplexing
+from test_remultiplexing import FWD, REV, INSERT, TempDirTest, write_fastq, write_indexes
+
+
+class MetricsTest(TempDirTest):
+    def tearDown(self):
+        metrics.configure()
+        super().tearDown()
+
+    def test_stage(self):
+        metrics.configure(report='metrics.jsonl', run='test')
+        with metrics.stage('example', input='x') as stage:
+            stage.records_in = 10
+            stage.records_out = 7
+        with self.assertRaises(KeyError):
+            with metrics.stage('failing'):
+                raise KeyError
+
+        example, failing = metrics.read_report('metrics.jsonl')
+        self.assertEqual(example['run'], 'test')
+        self.assertEqual(example['status'], 'ok')
+        self.assertEqual(example['records_discarded'], 3)
+        self.assertEqual(example['input'], 'x')
+        self.assertGreater(example['peak_rss_mb'], 0)
+        self.assertEqual(failing['status'], 'error')
+
+    def test_disabled(self):
+        with metrics.stage('example'):
+            pass
+        self.assertEqual(os.listdir('.'), [])
+
+    def test_remultiplex(self):
+        metrics.configure(report='metrics.jsonl', profile='profiles')
+        write_indexes('indexes.csv')
+        seqs = [FWD['F01'] + INSERT + REV['R11']] * 3 + [FWD['F02'] + INSERT + REV['R12'], INSERT]
+        write_fastq('raw_seqs.fastq', seqs)
+        remultiplexing.remultiplex('raw_seqs.fastq', 'indexes.csv')
+
+        record, = metrics.read_report('metrics.jsonl')
+        self.assertEqual(record['stage'], 'remultiplex')
+        self.assertEqual((record['records_in'], record['records_out'], record['records_discarded']), (5, 4, 1))
+        self.assertEqual(record['per_tag'], {'F01': 3, 'F02': 1, 'R11': 3, 'R12': 1})
+        self.assertEqual(len(os.listdir('profiles')), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
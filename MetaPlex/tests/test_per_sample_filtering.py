@@ -1,6 +1,11 @@
 import os
 import biom
+import tempfile
 import unittest
+import zipfile
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
 
 
 from MetaPlex import per_sample_filtering
@@ -31,6 +36,58 @@ class PerSampleFilterTest(unittest.TestCase):
         # Clean up
         os.system('rm freq_filt_table.qza')
 
+    def test_sparse(self):
+        table = biom.Table(csr_matrix(np.array([[1, 5, 0], [3, 2, 9]])), ['ASV1', 'ASV2'], ['F01R11', 'F01R12', 'F02R11'])
+
+        filtered = per_sample_filtering.filter_table(table, 3)
+        self.assertEqual(filtered.matrix_data.toarray().tolist(), [[0, 5, 0], [3, 0, 9]])
+
+        thresholds = pd.Series({'F01R11': 3, 'F01R12': 1})
+        filtered = per_sample_filtering.filter_table(table, thresholds, inclusive=True)
+        self.assertEqual(filtered.matrix_data.toarray().tolist(), [[0, 5, 0], [0, 2, 9]])
+        self.assertEqual(filtered.matrix_data.nnz, 3)
+
+    def test_feature_false_reads(self):
+        # ASV1 jumps out of the very abundant F01R11 into F01R12, next to the rare but real ASV2
+        table = biom.Table(csr_matrix(np.array([[10000, 12, 4, 0], [0, 10, 0, 0], [0, 0, 2000, 2000]])),
+                           ['ASV1', 'ASV2', 'ASV3'], ['F01R11', 'F01R12', 'F02R11', 'F02R12'])
+
+        thresholds = per_sample_filtering.feature_false_reads(table, 0.01)
+        self.assertEqual(thresholds.nnz, table.matrix_data.nnz)
+        self.assertEqual(thresholds[0, 1], 15)
+        self.assertEqual(thresholds[1, 1], 1)
+
+        filtered = per_sample_filtering.filter_table(table, thresholds, inclusive=True)
+        self.assertEqual(filtered.matrix_data.toarray().tolist(),
+                         [[10000, 0, 0, 0], [0, 10, 0, 0], [0, 0, 2000, 2000]])
+
+        # Other sparse formats are laid out as CSC first
+        again = per_sample_filtering.filter_table(table, thresholds.tocsr(), inclusive=True)
+        self.assertEqual(again.matrix_data.toarray().tolist(), filtered.matrix_data.toarray().tolist())
+
+        # Thresholds that don't line up with the stored values of the table
+        with self.assertRaises(ValueError):
+            per_sample_filtering.filter_table(table, csr_matrix(np.full((3, 4), 5)))
+
+    def test_csv_provenance(self):
+        table = biom.Table(np.array([[1, 5], [3, 2]]), ['ASV1', 'ASV2'], ['F01R11', 'F01R12'])
+        with tempfile.TemporaryDirectory() as temp:
+            with open(os.path.join(temp, 'table.biom'), 'w') as f:
+                f.write(table.to_json('test'))
+            pd.DataFrame({'SampleIndex': ['F01R11', 'F01R12'], 'Expected False Reads': [1, 1],
+                          'Expected False Reads Upper': [3, 3]}).to_csv(os.path.join(temp, 'false_reads.csv'),
+                                                                        index=False)
+            per_sample_filtering.per_sample_filter(os.path.join(temp, 'table.biom'),
+                                                   os.path.join(temp, 'false_reads.csv'), output_dir=temp,
+                                                   upper_bound=True)
+
+            with zipfile.ZipFile(os.path.join(temp, 'freq_filt_table.qza')) as qza:
+                action, = [n for n in qza.namelist() if n.endswith('/provenance/action/action.yaml')]
+                action = qza.read(action).decode()
+
+        # Filtered at the upper bound, which is recorded next to the csv
+        self.assertIn('upper_bound: true', action)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,57 @@
+import os
+import unittest
+import biom
+from MetaPlex import pipeline, index_jump, per_sample_filtering, length_filtering
+from test_remultiplexing import TempDirTest
+
+
+class PipelineTest(TempDirTest):
+    def setUp(self):
+        self.data = os.path.abspath('data')
+        super().setUp()
+
+    def run_pipeline(self, outputs, **kwargs):
+        return pipeline.run(f'{self.data}/remultiplexed_counts.tsv', f'{self.data}/Sample_Map.txt',
+                            f'{self.data}/length_artifacts/feature_table.qza',
+                            f'{self.data}/length_artifacts/rep_seqs.qza',
+                            calibrator_tag_pairs=[('01', '11')], length_to_filter=150, outputs=outputs, **kwargs)
+
+    def test_in_memory(self):
+        results = self.run_pipeline(outputs=())
+
+        # Nothing is written unless asked for
+        self.assertEqual(os.listdir('.'), [])
+        self.assertEqual(results.max_false_reads, 5)
+        self.assertEqual(len(results.sequences), 1831)
+        self.assertEqual(results.summary['Retained Reads'], results.table.sum())
+
+    def test_matches_stages(self):
+        results = self.run_pipeline(outputs=('table', 'false_reads'))
+        self.assertEqual(sorted(os.listdir('.')), ['Expected_False_Reads_Per_Index.csv', 'length_filt_table_150.qza'])
+
+        # Same table as running each stage through files
+        index_jump.calculate(f'{self.data}/remultiplexed_counts.tsv', f'{self.data}/Sample_Map.txt', [('01', '11')])
+        per_sample_filtering.per_sample_filter(f'{self.data}/length_artifacts/feature_table.qza',
+                                               'Expected_False_Reads_Per_Index.csv')
+        table, seqs = length_filtering.length_filter('freq_filt_table.qza', f'{self.data}/length_artifacts/rep_seqs.qza',
+                                                     150)
+
+        self.assertEqual(table.filtered_table.view(biom.Table), results.table)
+
+    def test_output_dir(self):
+        os.mkdir('work')
+        self.run_pipeline(outputs=('table', 'false_reads', 'log'), output_dir='run_1', work_dir='work')
+
+        # Outputs only go to the output directory and scratch files are cleaned up
+        self.assertEqual(sorted(os.listdir('.')), ['run_1', 'work'])
+        self.assertEqual(sorted(os.listdir('run_1')),
+                         ['Expected_False_Reads_Per_Index.csv', 'length_filt_table_150.qza', 'log.txt'])
+        self.assertEqual(os.listdir('work'), [])
+
+    def test_unknown_output(self):
+        with self.assertRaises(ValueError):
+            self.run_pipeline(outputs=('tables',))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,43 @@
 import os
+import gzip
+import shutil
 import subprocess
+import tempfile
 import unittest
-from MetaPlex import remultiplexing
+from MetaPlex import fastq, primers, remultiplexing
+
+
+FWD = {'F01': 'CTAAGGTAACGAT', 'F02': 'TAAGGAGAACGAT'}
+REV = {'R11': 'GATTCGAGGA', 'R12': 'GAACCACCTA'}
+INSERT = 'GGTCAACAAATCATAAAGATATTGGAACATTATAT'
+
+
+def write_fastq(path, seqs):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt') as f:
+        for n, seq in enumerate(seqs):
+            f.write(f'@read{n}\n{seq}\n+\n{"#" * len(seq)}\n')
+
+
+def write_indexes(path):
+    with open(path, 'w') as f:
+        f.write('ID,seq,orientation\n')
+        for name, seq in list(FWD.items()) + list(REV.items()):
+            f.write(f'{name[1:]},{seq},{name[0]}\n')
+
+
+class TempDirTest(unittest.TestCase):
+    '''
+    Runs every test in its own temporary working directory, removed afterwards
+    '''
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.temp = tempfile.mkdtemp()
+        os.chdir(self.temp)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.temp)
 
 
 class RemuxTest(unittest.TestCase):
@@ -21,5 +57,125 @@ class RemuxTest(unittest.TestCase):
         os.system('rm -r fastqs')
 
 
+class SinglePassTest(unittest.TestCase):
+    def test_records(self):
+        records = [(b'@a', (FWD['F01'] + INSERT + REV['R12']).encode(), b'+', b'#' * 58),
+                   (b'@b', (FWD['F02'] + INSERT).encode(), b'+', b'#' * 48),
+                   (b'@c', ('A' + FWD['F02'] + INSERT + REV['R11']).encode(), b'+', b'#' * 59)]
+        out = list(remultiplexing.remultiplex_records(records, FWD, REV))
+
+        self.assertEqual(len(out), 1)
+        fwd, rev, record = out[0]
+        self.assertEqual((fwd, rev), ('F01', 'R12'))
+        self.assertEqual(record.split(b'\n')[1], (FWD['F01'] + REV['R12'] + INSERT).encode())
+        self.assertEqual(record.split(b'\n')[3], b'I' * 23 + b'#' * len(INSERT))
+
+    def test_mismatches(self):
+        lookup = {(distance, length): table for distance, length, table
+                  in remultiplexing.build_lookup({'R01': 'AAAA', 'R02': 'AATT'}, max_mismatches=1)}
+
+        self.assertEqual(lookup[0, 4][b'AAAA'], 'R01')
+        self.assertEqual(lookup[1, 4][b'NATT'], 'R02')
+        # One substitution away from both tags
+        self.assertIsNone(lookup[1, 4][b'AAAT'])
+
+        read = ('CTAAGGTAACGTT' + INSERT + 'GATTCGAGGA').encode()
+        records = [(b'@a', read, b'+', b'#' * len(read))]
+        self.assertEqual(list(remultiplexing.remultiplex_records(records, FWD, REV)), [])
+        fwd, rev, record = next(remultiplexing.remultiplex_records(records, FWD, REV, max_mismatches=2))
+        self.assertEqual((fwd, rev), ('F01', 'R11'))
+        self.assertEqual(record.split(b'\n')[1], (FWD['F01'] + REV['R11'] + INSERT).encode())
+
+    def test_mismatches_across_lengths(self):
+        rev_lookup = remultiplexing.build_lookup({'R1': 'GGGG'})
+        read = b'ACGTACGA' + b'T' * 20 + b'GGGG'
+
+        # An exact hit on a shorter tag wins over a mismatched hit on a longer one
+        fwd_lookup = remultiplexing.build_lookup({'F1': 'ACGTACGT', 'F2': 'ACGTAC'}, max_mismatches=1)
+        self.assertEqual(remultiplexing.classify(read, fwd_lookup, rev_lookup), ('F2', 'R1', 6, 4))
+
+        # One substitution away from tags of both lengths
+        fwd_lookup = remultiplexing.build_lookup({'F1': 'ACGTACGT', 'F2': 'ACGTAG'}, max_mismatches=1)
+        self.assertIsNone(remultiplexing.classify(read, fwd_lookup, rev_lookup))
+
+        # The longest tag still wins between exact hits
+        fwd_lookup = remultiplexing.build_lookup({'F1': 'ACGTACGA', 'F2': 'ACGTAC'}, max_mismatches=1)
+        self.assertEqual(remultiplexing.classify(read, fwd_lookup, rev_lookup), ('F1', 'R1', 8, 4))
+
+    def test_primer_trimming(self):
+        fwd_primer, rev_primer = primers.ANML_PRIMERS
+        # The reverse spacer (ATC) sits between the reverse primer and the Reverse tag
+        amplicon = 'A' * 180
+        tail = 'GGATTTGGAAATTGATTAGTACCATC'
+        reads = {'exact': fwd_primer + amplicon + tail,
+                 'degenerate': fwd_primer + amplicon + tail.replace('GTACC', 'GTTCC'),
+                 'mismatches': 'GGTCAACAAATCTTAAAGATATTCG' + amplicon + tail.replace('GGATTT', 'GGCTTT'),
+                 'no_rev_primer': fwd_primer + amplicon,
+                 'no_fwd_primer': amplicon + tail,
+                 'short': fwd_primer + 'A' * 100 + tail}
+        records = [(b'@' + name.encode(), (FWD['F01'] + insert + REV['R11']).encode(), b'+',
+                    b'#' * (len(insert) + 23)) for name, insert in reads.items()]
+        trimmer = primers.PrimerTrimmer(primers.ANML_PRIMERS, min_length=170)
+        out = list(remultiplexing.remultiplex_records(records, FWD, REV, trimmer=trimmer))
+
+        # Every read is still reported against its tags
+        self.assertEqual(len(out), 6)
+        kept = {r.split(b'\n')[0]: r.split(b'\n')[1] for fwd, rev, r in out if r is not None}
+        merged = (FWD['F01'] + REV['R11']).encode()
+        self.assertEqual(sorted(kept), [b'@degenerate', b'@exact', b'@mismatches', b'@no_rev_primer'])
+        self.assertEqual(kept[b'@exact'], merged + amplicon.encode())
+        self.assertEqual(kept[b'@degenerate'], merged + amplicon.encode())
+        self.assertEqual(kept[b'@mismatches'], merged + amplicon.encode())
+
+
+class RemultiplexFilesTest(TempDirTest):
+    def setUp(self):
+        super().setUp()
+        write_indexes('indexes.csv')
+
+    def test_remultiplex(self):
+        seqs = [FWD[f] + INSERT + REV[r] for f in FWD for r in REV] + [INSERT]
+        write_fastq('raw_seqs.fastq.gz', seqs)
+        counts = remultiplexing.remultiplex('raw_seqs.fastq.gz', 'indexes.csv')
+
+        with gzip.open('remultiplexed_seqs.fastq.gz', 'rt') as f:
+            lines = f.read().splitlines()
+        self.assertTrue(os.path.exists('remultiplexed_counts.tsv'))
+        self.assertEqual(counts.to_numpy().tolist(), [[1, 1], [1, 1]])
+        self.assertEqual(len(lines), 16)
+        self.assertEqual(lines[1], FWD['F01'] + REV['R11'] + INSERT)
+
+    def test_workers(self):
+        seqs = [FWD[f] + INSERT + REV[r] for r in REV for f in FWD] * 500
+        write_fastq('raw_seqs.fastq', seqs)
+        outputs = []
+        # The last run spills to partition files from a tiny memory budget
+        for workers, memory in ((1, 256 << 20), (2, 256 << 20), (1, 4096)):
+            remultiplexing.remultiplex('raw_seqs.fastq', 'indexes.csv', workers=workers, memory=memory)
+            with gzip.open('remultiplexed_seqs.fastq.gz', 'rb') as f:
+                outputs.append(f.read())
+
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], outputs[2])
+        headers = outputs[0].split(b'\n')[0::4]
+        # Sample sorted: every F01R11 read first, in input order
+        self.assertEqual(headers[:3], [b'@read0', b'@read4', b'@read8'])
+
+    def test_sample_index(self):
+        seqs = [FWD[f] + INSERT + REV[r] for r in REV for f in FWD] * 5000
+        write_fastq('raw_seqs.fastq', seqs)
+        remultiplexing.remultiplex('raw_seqs.fastq', 'indexes.csv', workers=2)
+
+        index = fastq.read_index('remultiplexed_seqs_index.tsv')
+        records = list(fastq.read_sample('remultiplexed_seqs.fastq.gz', index, 'F02R12'))
+        self.assertEqual(list(index), ['F01R11', 'F01R12', 'F02R11', 'F02R12'])
+        self.assertEqual([v[2] for v in index.values()], [5000] * 4)
+        # Samples follow each other without gaps
+        self.assertEqual(index['F01R12'][0], index['F01R11'][1])
+        self.assertEqual(len(records), 5000)
+        self.assertEqual(records[0][0], b'@read3')
+        self.assertTrue(all(r[1].startswith((FWD['F02'] + REV['R12']).encode()) for r in records))
+
+
 if __name__ == '__main__':
     unittest.main()
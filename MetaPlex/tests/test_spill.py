@@ -0,0 +1,50 @@
+import unittest
+from MetaPlex.spill import SampleSpill
+
+
+class SampleSpillTest(unittest.TestCase):
+    def test_merge(self):
+        keys = [(f, r) for f in range(10) for r in range(10)]
+        # Output order is the reverse of the key order
+        ranks = {k: len(keys) - 1 - n for n, k in enumerate(keys)}
+        expected = {k: [] for k in keys}
+        with SampleSpill(ranks, memory=64, partitions=4) as spill:
+            for n in range(20):
+                for k in keys[n % 7::7]:
+                    record = b'%d,%d:%d\n' % (*k, n)
+                    spill.write(k, record)
+                    expected[k].append(record)
+            spill.write(keys[0], b'')
+
+            # Every spill went to one of the partition files
+            self.assertEqual(spill.created, 4)
+            merged = [(k, b''.join(blocks)) for k, blocks in spill.merge(block_size=5)]
+            # Partitions over the budget were split further, and every file was closed once merged
+            self.assertGreater(spill.created, 4)
+            self.assertEqual(spill._open, [])
+
+        self.assertEqual([k for k, v in merged], sorted(keys, key=ranks.get))
+        self.assertEqual(dict(merged), {k: b''.join(v) for k, v in expected.items()})
+
+    def test_in_memory(self):
+        # Below the memory budget nothing is written to disk
+        with SampleSpill({'b': 0, 'a': 1}) as spill:
+            spill.write('a', b'1')
+            spill.write('b', b'2')
+            spill.write('a', b'3')
+            self.assertIsNone(spill.files)
+            self.assertEqual([(k, b''.join(v)) for k, v in spill.merge()], [('b', b'2'), ('a', b'13')])
+
+    def test_large_sample(self):
+        # One sample alone is larger than the budget, and is streamed back in input order
+        with SampleSpill({'a': 0, 'b': 1}, memory=100, partitions=2) as spill:
+            for n in range(100):
+                spill.write('a', b'%03d' % n)
+            spill.write('b', b'x')
+            merged = [(k, b''.join(blocks)) for k, blocks in spill.merge(block_size=7)]
+
+        self.assertEqual(merged, [('a', b''.join(b'%03d' % n for n in range(100))), ('b', b'x')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import gzip
+import subprocess
+import sys
+import threading
+import unittest
+from MetaPlex import bgzf, streams
+from test_bam import write_bam
+from test_remultiplexing import TempDirTest, write_indexes
+
+
+FWD = 'CTAAGGTAACGAT'
+REV = 'GATTCGAGGA'
+INSERT = 'GGTCAACAAATCATAAAGATATTGG'
+FASTQ = b''.join(b'@r%d\n%s\n+\n%s\n' % (n, (FWD + INSERT + REV).encode(), b'#' * 48) for n in range(100))
+
+
+class StreamsTest(TempDirTest):
+    def test_open_input(self):
+        # No file extensions: the format comes from the first bytes
+        with open('plain', 'wb') as f:
+            f.write(FASTQ)
+        with gzip.open('gzip', 'wb') as f:
+            f.write(FASTQ)
+        with bgzf.BgzfWriter('bgzf', threads=1) as f:
+            f.write(FASTQ)
+        write_bam('bam', [('r0', 'ACGT', 4)])
+        with open('other', 'wb') as f:
+            f.write(b'>r0\nACGT\n')
+
+        for name in ('plain', 'gzip', 'bgzf'):
+            kind, handle = streams.open_input(name)
+            with handle:
+                self.assertEqual((kind, handle.read()), ('fastq', FASTQ))
+        kind, handle = streams.open_input('bam')
+        handle.close()
+        self.assertEqual(kind, 'bam')
+        with self.assertRaises(ValueError):
+            streams.open_input('other')
+
+    def test_prefetch(self):
+        self.assertEqual(list(streams.prefetch(iter(range(100)), depth=2)), list(range(100)))
+
+        def failing():
+            yield 1
+            raise ValueError('bad chunk')
+        with self.assertRaises(ValueError):
+            list(streams.prefetch(failing()))
+
+    def test_pipe(self):
+        write_indexes('indexes.csv')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        result = subprocess.run([sys.executable, '-m', 'MetaPlex.remultiplexing', '-', 'indexes.csv', '-o', '-',
+                                 '--output-dir', 'out'],
+                                input=gzip.compress(FASTQ), capture_output=True, env=env, check=True)
+        os.mkfifo('reads.fastq')
+
+        def write_fifo():
+            with open('reads.fastq', 'wb') as f:
+                f.write(FASTQ)
+        writer = threading.Thread(target=write_fifo)
+        writer.start()
+        subprocess.run([sys.executable, '-m', 'MetaPlex.remultiplexing', 'reads.fastq', 'indexes.csv',
+                        '--output-dir', 'fifo'], capture_output=True, env=env, check=True)
+        writer.join()
+        with gzip.open('fifo/remultiplexed_seqs.fastq.gz', 'rb') as f:
+            from_fifo = f.read()
+
+        lines = result.stdout.split(b'\n')
+        self.assertEqual(len(lines), 401)
+        self.assertEqual(lines[1], (FWD + REV + INSERT).encode())
+        self.assertIn(b'100 reads remultiplexed', result.stderr)
+        self.assertEqual(from_fifo, result.stdout)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from MetaPlex import index_jump
+from MetaPlex.tags import TagRegistry
+
+
+class TagRegistryTests(unittest.TestCase):
+
+    def test_from_indexes(self):
+        registry = TagRegistry.from_indexes('data/indexes.csv')
+        self.assertEqual(registry.fwd['F01'], 'CTAAGGTAACGAT')
+        self.assertEqual(registry.fwd_codes['F01'], 0)
+        self.assertEqual(registry.sample_id(0, 0), 'F01R11')
+
+    def test_wide_ids(self):
+        # A 96 x 96 plate with 3 digit tag IDs
+        fwd = [f'F{n:03d}' for n in range(1, 97)]
+        rev = [f'R{n:03d}' for n in range(101, 197)]
+        sample_ids = [f + r for f in fwd for r in rev]
+        sample_map = pd.DataFrame({'#SampleID': sample_ids,
+                                   'True_False': [int(i % 97 == 0) for i in range(len(sample_ids))]})
+        registry = TagRegistry.from_sample_map(sample_map)
+        self.assertEqual(registry.shape, (96, 96))
+
+        fwd_codes, rev_codes = registry.codes(['F001R101', 'F096R196', 'F097R101', 'F01R11'])
+        np.testing.assert_array_equal(fwd_codes, [0, 95, -1, -1])
+        np.testing.assert_array_equal(rev_codes, [0, 95, 0, -1])
+        self.assertEqual(registry.code('096', 'F'), 95)
+        with self.assertRaises(ValueError):
+            registry.code('97', 'F')
+
+        matrix = registry.matrix(np.array([0, 0, 95]), np.array([0, 0, -1]), [5, 7, 1])
+        self.assertEqual(matrix[0, 0], 12)
+        self.assertEqual(matrix.sum(), 12)
+
+    def test_wide_calibrators(self):
+        # 120 Forward tags, so IDs need 3 digits. Every Forward tag has one true Reverse tag.
+        fwd = [f'{n:03d}' for n in range(1, 121)]
+        rev = [f'{n:03d}' for n in range(201, 321)]
+        sample_ids = [f'F{f}R{r}' for f in fwd for r in rev]
+        true = [i // 120 == i % 120 for i in range(len(sample_ids))]
+        sample_map = pd.DataFrame({'#SampleID': sample_ids, 'True_False': np.array(true, dtype=int)})
+        counts = pd.DataFrame({'sample ID': sample_ids, 'forward sequence count': np.where(true, 10000, 1)})
+
+        with tempfile.TemporaryDirectory() as temp:
+            path = os.path.join(temp, 'Sample_Map.txt')
+            sample_map.to_csv(path, sep='\t', index=False)
+            df, jump_rate, total = index_jump.false_reads_per_index(counts.set_index('sample ID'), path,
+                                                                    [('001', '201'), ('120', '320')])
+
+        # Each calibrator tag has 119 false reads out of 10119
+        self.assertAlmostEqual(jump_rate, 119 / 10119)
+        self.assertEqual(len(df), 120 * 120)
+        self.assertEqual(df['SampleIndex'].iloc[-1], 'F120R320')
+        self.assertEqual(total, 120 * 10000 + 120 * 119)
+
+
+if __name__ == '__main__':
+    unittest.main()
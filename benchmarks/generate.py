@@ -0,0 +1,236 @@
+import argparse
+import csv
+import gzip
+import io
+import os
+import uuid
+import zipfile
+import numpy as np
+import pandas as pd
+import biom
+
+from MetaPlex import artifacts
+
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INDEXES = os.path.join(REPO, 'reference_files', 'indexes.csv')
+COMBOS = os.path.join(REPO, 'library_prep', 'METAPLEX_INDEXED_PRIMERS_2304_COMBOS.csv')
+
+_COMPLEMENT = str.maketrans('ACGTRYKMBVDHSWN', 'TGCAYRMKVBHDSWN')
+_IUPAC = {'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+          'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT'}
+_BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+_CODES = np.zeros(256, dtype=np.uint8)
+_CODES[_BASES] = np.arange(4)
+
+
+def reverse_complement(seq):
+    return seq.translate(_COMPLEMENT)[::-1]
+
+
+def load_design(indexFile=INDEXES, combos_file=COMBOS, all_combos=False):
+    '''
+    Reads the tags and primers of the MetaPlex library
+
+    indexFile   : indexes.csv of the tags in the pool, as passed to remultiplexing.remultiplex
+
+    combos_file : METAPLEX_INDEXED_PRIMERS_*_COMBOS.csv, the source of the primer sequences
+
+    all_combos  : if True, every barcode of combos_file is used instead of indexFile. Forward tags are the barcode
+                  plus spacer, Reverse tags the reverse complement of the barcode, as in indexes.csv.
+
+    Return : (fwd_tags, rev_tags, fwd_primer, rev_primer) with tags as {ID: sequence} dictionaries
+    '''
+    with open(combos_file, encoding='utf-8-sig') as f:
+        rows = [row for row in csv.reader(f)][2:]
+    rows = [row for row in rows if row and row[4]]
+    fwd_primer, rev_primer = rows[0][6], rows[0][14]
+
+    if all_combos:
+        fwd_tags = {f'F{n:02d}': row[4] + row[5] for n, row in enumerate(rows, 1)}
+        rev_tags = {f'R{n:02d}': reverse_complement(row[12]) for n, row in enumerate(rows, len(rows) + 1)}
+    else:
+        df = pd.read_csv(indexFile, dtype=str)
+        fwd_tags = {'F' + i: s for i, s, o in zip(df['ID'], df['seq'], df['orientation']) if o == 'F'}
+        rev_tags = {'R' + i: s for i, s, o in zip(df['ID'], df['seq'], df['orientation']) if o == 'R'}
+
+    return fwd_tags, rev_tags, fwd_primer, rev_primer
+
+
+def write_indexes(path, fwd_tags, rev_tags):
+    '''
+    Writes tags in the indexes.csv layout read by remultiplexing.load_indexes
+    '''
+    rows = [(k[1:], v, 'F') for k, v in fwd_tags.items()] + [(k[1:], v, 'R') for k, v in rev_tags.items()]
+    pd.DataFrame(rows, columns=['ID', 'seq', 'orientation']).to_csv(path, index=False)
+
+
+def _resolve(seq, rng):
+    return ''.join(rng.choice(list(_IUPAC[b])) if b in _IUPAC else b for b in seq)
+
+
+def simulate(path, n_reads=100000, read_length=200, jump_rate=0.001, error_rate=0.001, n_features=200,
+             short_fraction=0.05, all_combos=False, seed=0, chunk_size=100000):
+    '''
+    Generates a synthetic dual-indexed Ion Torrent run, together with the QIIME2 artifacts that demux and denoising
+    would produce from it
+
+    path           : output directory
+
+    n_reads        : number of reads
+
+    read_length    : typical read length, including tags and primers
+
+    jump_rate      : probability that a read end carries the tag of another sample
+
+    error_rate     : per-base substitution rate
+
+    n_features     : number of distinct amplicon sequences (ASVs) in the pool
+
+    short_fraction : fraction of ASVs that are truncated to half length, for length filtering to remove
+
+    all_combos     : use every tag of the 2304 combination primer set instead of reference_files/indexes.csv
+
+    seed           : random seed, the same seed always produces the same files
+
+    Return : dictionary of the paths written
+    Output : raw_seqs.fastq.gz, indexes.csv, Sample_Map.txt, demux.qza, feature_table.qza and rep_seqs.qza in path
+    '''
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    fwd_tags, rev_tags, fwd_primer, rev_primer = load_design(all_combos=all_combos)
+    fwd_ids, rev_ids = list(fwd_tags), list(rev_tags)
+
+    # True samples: the first Forward / Reverse pair is a calibrator, with neither tag used by any other sample. Every
+    # other Forward tag is paired with about half the remaining Reverse tags.
+    true_pairs = [(0, 0)]
+    for f in range(1, len(fwd_ids)):
+        for r in range(1, len(rev_ids)):
+            if rng.random() < 0.5:
+                true_pairs.append((f, r))
+    true_pairs = np.array(true_pairs)
+    sample_weights = rng.lognormal(0, 0.5, len(true_pairs))
+    sample_weights /= sample_weights.sum()
+
+    # ASVs, each sample holding a handful of them
+    fixed = len(fwd_primer) + len(rev_primer) + 3
+    insert_length = max(read_length - fixed - len(next(iter(fwd_tags.values()))) - len(next(iter(rev_tags.values()))),
+                        20)
+    lengths = rng.integers(insert_length - 10, insert_length + 10, n_features)
+    lengths[rng.random(n_features) < short_fraction] //= 2
+    asvs = [''.join(rng.choice(list('ACGT'), n)) for n in lengths]
+    asv_ids = [uuid.UUID(bytes=rng.bytes(16)).hex for _ in asvs]
+    sample_asvs = [rng.choice(n_features, size=min(5, n_features), replace=False) for _ in true_pairs]
+
+    head = {k: v + _resolve(fwd_primer, rng) for k, v in fwd_tags.items()}
+    tail = {k: reverse_complement(_resolve(rev_primer, rng)) + 'ATC' + v for k, v in rev_tags.items()}
+
+    table = np.zeros((n_features, len(fwd_ids), len(rev_ids)), dtype=np.int64)
+    demux = {}
+    with gzip.open(os.path.join(path, 'raw_seqs.fastq.gz'), 'wb', compresslevel=1) as out:
+        for start in range(0, n_reads, chunk_size):
+            n = min(chunk_size, n_reads - start)
+            sample = rng.choice(len(true_pairs), n, p=sample_weights)
+            fwd = true_pairs[sample, 0].copy()
+            rev = true_pairs[sample, 1].copy()
+            asv = np.array([sample_asvs[s][i] for s, i in zip(sample, rng.integers(0, len(sample_asvs[0]), n))])
+
+            # Index jumps: the tag of a read end is replaced by that of another read in the pool
+            jump = rng.random(n) < jump_rate / 2
+            fwd[jump] = rng.permutation(fwd)[jump]
+            jump = rng.random(n) < jump_rate / 2
+            rev[jump] = rng.permutation(rev)[jump]
+            np.add.at(table, (asv, fwd, rev), 1)
+
+            seqs = [head[fwd_ids[f]] + asvs[a] + tail[rev_ids[r]] for f, r, a in zip(fwd, rev, asv)]
+
+            # Substitution errors over the sequence lines only
+            block = np.frombuffer('\n'.join(seqs).encode(), dtype=np.uint8).copy()
+            errors = (rng.random(len(block)) < error_rate) & (block != ord('\n'))
+            block[errors] = _BASES[(_CODES[block[errors]] + rng.integers(1, 4, errors.sum())) % 4]
+            seqs = block.tobytes().split(b'\n')
+
+            records = []
+            for i, (seq, f, r, a) in enumerate(zip(seqs, fwd, rev, asv)):
+                name = f'@read{start + i}'.encode()
+                qual = b'I' * len(seq)
+                records.append(b'%s\n%s\n+\n%s\n' % (name, seq, qual))
+                trimmed = len(head[fwd_ids[f]]) - len(fwd_primer)
+                key = fwd_ids[f] + rev_ids[r]
+                demux.setdefault(key, []).append(b'%s\n%s\n+\n%s\n' % (name, seq[trimmed:], qual[trimmed:]))
+            out.write(b''.join(records))
+
+    files = {'sequences': os.path.join(path, 'raw_seqs.fastq.gz'),
+             'indexes': os.path.join(path, 'indexes.csv'),
+             'sample_map': os.path.join(path, 'Sample_Map.txt'),
+             'demux': os.path.join(path, 'demux.qza'),
+             'feature_table': os.path.join(path, 'feature_table.qza'),
+             'rep_seqs': os.path.join(path, 'rep_seqs.qza')}
+
+    write_indexes(files['indexes'], fwd_tags, rev_tags)
+
+    # Sample map covering every tag combination, with the true samples marked 1
+    true_set = set(map(tuple, true_pairs))
+    with open(files['sample_map'], 'w') as f:
+        print('#SampleID\tBarcodeSequence\tFwd_Index\tRev_Index\tTrue_False', file=f)
+        for i, fi in enumerate(fwd_ids):
+            for j, ri in enumerate(rev_ids):
+                print(f'{fi}{ri}\t{fwd_tags[fi]}{rev_tags[ri]}\t{int(fi[1:])}\t{int(ri[1:])}\t{int((i, j) in true_set)}',
+                      file=f)
+
+    write_demux_qza(files['demux'], demux)
+
+    # Feature table of every sample with reads, and the ASVs as rep-seqs
+    flat = table.reshape(n_features, -1)
+    sample_ids = [fi + ri for fi in fwd_ids for ri in rev_ids]
+    present = flat.sum(axis=0) > 0
+    feature_table = biom.Table(flat[:, present], asv_ids, [s for s, p in zip(sample_ids, present) if p])
+    artifacts.write_qza(files['feature_table'], 'FeatureTable[Frequency]', artifacts.table_bytes(feature_table),
+                        'simulate', parameters={'seed': seed}, output_name='table')
+    artifacts.write_qza(files['rep_seqs'], 'FeatureData[Sequence]', artifacts.fasta_bytes(zip(asv_ids, asvs)),
+                        'simulate', parameters={'seed': seed}, output_name='representative_sequences')
+
+    return files
+
+
+def write_demux_qza(path, samples):
+    '''
+    Writes a minimal SampleData[SequencesWithQuality] archive with one Casava named fastq.gz per sample and a MANIFEST,
+    enough for index_jump.count_demux_reads
+    '''
+    root = str(uuid.uuid4())
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as qza:
+        qza.writestr(f'{root}/VERSION', 'QIIME 2\narchive: 5\nframework: 2022.2.0\n')
+        qza.writestr(f'{root}/metadata.yaml', f'uuid: {root}\ntype: SampleData[SequencesWithQuality]\n'
+                                             f'format: SingleLanePerSampleSingleEndFastqDirFmt\n')
+        manifest = ['sample-id,filename,direction']
+        for n, (sample, records) in enumerate(sorted(samples.items()), 1):
+            name = f'{sample}_{n}_L001_R1_001.fastq.gz'
+            manifest.append(f'{sample},{name},forward')
+            buffer = io.BytesIO()
+            with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=1) as f:
+                f.write(b''.join(records))
+            qza.writestr(f'{root}/data/{name}', buffer.getvalue())
+        qza.writestr(f'{root}/data/MANIFEST', '\n'.join(manifest) + '\n')
+        qza.writestr(f'{root}/data/metadata.yml', '{phred-offset: 33}\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates a synthetic dual-indexed run and matching QIIME2 artifacts')
+    parser.add_argument('path', help='output directory')
+    parser.add_argument('-n', '--reads', type=int, default=100000, help='number of reads (default: 100000)')
+    parser.add_argument('-l', '--read-length', type=int, default=200, help='read length (default: 200)')
+    parser.add_argument('-j', '--jump-rate', type=float, default=0.001, help='index jump rate (default: 0.001)')
+    parser.add_argument('-e', '--error-rate', type=float, default=0.001,
+                        help='per-base substitution rate (default: 0.001)')
+    parser.add_argument('--features', type=int, default=200, help='number of ASVs (default: 200)')
+    parser.add_argument('--all-combos', action='store_true', help='use all 48 x 48 tags of the 2304 combination set')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    simulate(args.path, n_reads=args.reads, read_length=args.read_length, jump_rate=args.jump_rate,
+             error_rate=args.error_rate, n_features=args.features, all_combos=args.all_combos, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
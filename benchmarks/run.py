@@ -0,0 +1,167 @@
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.generate import simulate
+from MetaPlex.index_jump import false_reads_per_index
+from MetaPlex.metrics import peak_rss
+
+
+STAGES = ['remultiplex', 'calculate', 'per_sample_filter', 'length_filter']
+
+# Interpreter arguments of the commands whose start-up is timed: the bare interpreter as a baseline, the metaplex
+# command, and a standalone console script that imports its whole module
+STARTUP = {'python': ['-c', 'pass'],
+           'metaplex --help': ['-m', 'MetaPlex', '--help'],
+           'metaplex calculate --help': ['-m', 'MetaPlex', 'calculate', '--help'],
+           'Metaplex-calculate-IJR --help': ['-m', 'MetaPlex.index_jump', '--help']}
+
+
+def _stage(name, files, workers, output_dir):
+    '''
+    Runs one MetaPlex stage on generated data, writing its outputs to output_dir
+
+    Return : number of reads in the generated run
+    '''
+    from MetaPlex import remultiplexing, index_jump, per_sample_filtering, length_filtering
+
+    if name == 'remultiplex':
+        remultiplexing.remultiplex(files['sequences'], files['indexes'], workers=workers, output_dir=output_dir,
+                                   work_dir=output_dir)
+    elif name == 'calculate':
+        index_jump.calculate(files['demux'], files['sample_map'], [files['calibrator']], output_dir=output_dir,
+                             work_dir=output_dir)
+    elif name == 'per_sample_filter':
+        per_sample_filtering.per_sample_filter(files['feature_table'], files['false_reads'], output_dir=output_dir)
+    elif name == 'length_filter':
+        length_filtering.length_filter(files['feature_table'], files['rep_seqs'], files['length'],
+                                       output_dir=output_dir)
+    else:
+        raise ValueError(f'Unknown stage {name}')
+
+    return files['reads']
+
+
+def _measure(name, files, workers, queue):
+    '''
+    Child process body: runs the stage with a fresh output directory and reports its wall time and peak RSS
+    '''
+    output_dir = tempfile.mkdtemp(prefix=f'{name}_', dir=files['path'])
+    start = time.perf_counter()
+    reads = _stage(name, files, workers, output_dir)
+    elapsed = time.perf_counter() - start
+
+    queue.put({'stage': name, 'seconds': elapsed, 'reads': reads, 'reads_per_second': reads / elapsed,
+               'peak_rss_mb': peak_rss() / (1 << 20)})
+
+
+def measure(name, files, workers=1):
+    '''
+    Times one stage in its own process, so that the peak RSS belongs to that stage alone
+
+    Return : dictionary of stage, seconds, reads, reads_per_second and peak_rss_mb
+    '''
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_measure, args=(name, files, workers, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+
+    return result
+
+
+def startup(repeats=10):
+    '''
+    Times the start-up of MetaPlex commands, each in a fresh interpreter as a workflow engine would call them
+
+    repeats : number of times each command is run
+
+    Return : list of result dictionaries with the median and minimum wall time of each command
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = []
+    for command, args in STARTUP.items():
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, *args], cwd=root, stdout=subprocess.DEVNULL, check=True)
+            times.append(time.perf_counter() - start)
+        result = {'stage': 'startup', 'command': command, 'seconds': statistics.median(times),
+                  'min_seconds': min(times)}
+        results.append(result)
+        print(f'{"startup":>10} {command:<32} {result["seconds"]:8.3f} s')
+
+    return results
+
+
+def benchmark(sizes, path, stages=STAGES, workers=1, read_length=200, jump_rate=0.001, error_rate=0.001, seed=0):
+    '''
+    Generates a synthetic run for each data size and times every stage on it
+
+    sizes  : list of read counts
+
+    path   : directory that the generated data and stage outputs are written to
+
+    stages : names of the stages to time
+
+    Return : list of result dictionaries, one per size and stage
+    '''
+    results = []
+    for n_reads in sizes:
+        data = os.path.join(path, f'{n_reads}_reads')
+        print(f'Generating {n_reads} reads...')
+        files = simulate(data, n_reads=n_reads, read_length=read_length, jump_rate=jump_rate, error_rate=error_rate,
+                         seed=seed)
+        files.update(path=data, reads=n_reads, calibrator=('01', '11'), length=read_length // 2)
+
+        # The per-sample filter reads the expected false reads that calculate would have written
+        false_reads = false_reads_per_index(files['demux'], files['sample_map'], [files['calibrator']])[0]
+        files['false_reads'] = os.path.join(data, 'Expected_False_Reads_Per_Index.csv')
+        false_reads.to_csv(files['false_reads'], index=False)
+
+        for name in stages:
+            result = measure(name, files, workers)
+            result['size'] = n_reads
+            results.append(result)
+            print(f'{n_reads:>10} {name:<18} {result["seconds"]:8.2f} s {result["reads_per_second"]:12.0f} reads/s '
+                  f'{result["peak_rss_mb"]:8.1f} MB')
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times every MetaPlex stage on synthetic data of several sizes')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='read counts to benchmark (default: 10000 100000 1000000)')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('-j', '--workers', type=int, default=1, help='remultiplex worker processes (default: 1)')
+    parser.add_argument('-l', '--read-length', type=int, default=200)
+    parser.add_argument('--jump-rate', type=float, default=0.001)
+    parser.add_argument('--error-rate', type=float, default=0.001)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-d', '--dir', default=None, help='working directory, a temporary one if not given')
+    parser.add_argument('-o', '--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--startup-repeats', type=int, default=10,
+                        help='runs of each command whose start-up is timed, 0 to skip (default: 10)')
+    args = parser.parse_args()
+
+    results = startup(args.startup_repeats) if args.startup_repeats else []
+    with tempfile.TemporaryDirectory(prefix='metaplex_bench_') as temp:
+        results += benchmark(args.sizes, args.dir or temp, stages=args.stages, workers=args.workers,
+                            read_length=args.read_length, jump_rate=args.jump_rate, error_rate=args.error_rate,
+                            seed=args.seed)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
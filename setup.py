@@ -11,17 +11,19 @@ setup(
     packages=['metaplex'],
     entry_points={
         'console_scripts': [
+            'metaplex=metaplex.cli:main',
             'Metaplex-remultiplex=metaplex.remultiplexing:main',
             'Metaplex-calculate-IJR=metaplex.index_jump:main',
+            'Metaplex-calculate-IJR-batch=metaplex.batch:main',
             'Metaplex-per-sample-filter=metaplex.per_sample_filtering:main',
             'Metaplex-length-filter=metaplex.length_filtering:main',
+            'Metaplex-run=metaplex.pipeline:main',
         ],
     },
     install_requires=['numpy',
                       'pandas',
-                      'cutadapt',
                       'biom-format',
-                      'biopython',
+                      'h5py',
                       ],
 
     classifiers=[